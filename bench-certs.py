@@ -0,0 +1,189 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Benchmark the data layer behind piccolo's certificate page.
+
+A synthetic database (using the schema from db.txt) is generated, and
+the latency of get_cert_details is compared with the former code path,
+which issued one query per relation, for a leaf certificate and for
+the most popular intermediate CA.
+
+Usage: bench-certs.py [-c N_LEAVES] [-a N_ANSWERS] [-r REPEAT] [-k]
+"""
+from __future__ import print_function
+
+import getopt
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BIN_DIR)
+
+import piccolo
+
+
+def schema_statements():
+    with open(os.path.join(BIN_DIR, "db.txt")) as f:
+        script = "\n".join(l for l in f.read().splitlines()
+                           if not l.startswith("--") and not l.startswith("."))
+    for statement in script.split(";"):
+        statement = statement.strip()
+        if re.match("create (table|index)", statement):
+            yield statement
+
+
+def fake_hash(kind, i):
+    return ("%s%038x" % (kind, i))[:40]
+
+
+def build_database(path, n_leaves, n_answers, seed=42):
+    rnd = random.Random(seed)
+    db = sqlite3.connect(path)
+    for statement in schema_statements():
+        db.execute(statement)
+
+    roots = [fake_hash("a0", i) for i in range(5)]
+    intermediates = [fake_hash("b0", i) for i in range(50)]
+    leaves = [fake_hash("e0", i) for i in range(n_leaves)]
+
+    certs, dns, names, links, tlinks = [], [], [], [], []
+
+    def add_cert(h, issuer, cn):
+        certs.append((h, 3, "01", h, issuer, "1300000000", "1700000000",
+                      "RSA", "00" + "ab" * 256, "10001", int(issuer != h)))
+        dns.append((h, "/C=FR/O=Concerto/CN=%s" % cn))
+        links.append((h, issuer))
+
+    for i, h in enumerate(roots):
+        add_cert(h, h, "Root %d" % i)
+    for i, h in enumerate(intermediates):
+        add_cert(h, roots[i % len(roots)], "Intermediate %d" % i)
+        tlinks.append((roots[i % len(roots)], h, 1))
+    for i, h in enumerate(leaves):
+        # A heavily skewed fan-in: a few intermediates issue most leaves
+        issuer = intermediates[min(int(rnd.expovariate(0.5)), len(intermediates) - 1)]
+        add_cert(h, issuer, "www%d.example.com" % i)
+        names.append((h, "DNS", "www%d.example.com" % i))
+        names.append((h, "DNS", "example%d.com" % i))
+        tlinks.append((issuer, h, 1))
+        tlinks.append((roots[intermediates.index(issuer) % len(roots)], h, 2))
+
+    db.executemany("insert into certs (hash, version, serial, subject_hash, issuer_hash, "
+                   "not_before, not_after, key_type, rsa_modulus, rsa_exponent, isCA) "
+                   "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", certs)
+    db.executemany("insert into dns values (?, ?)", dns)
+    db.executemany("insert into names values (?, ?, ?)", names)
+    db.executemany("insert into links values (?, ?)", links)
+    db.executemany("insert into transitive_links values (?, ?, ?)", tlinks)
+
+    chains = []
+    for i, leaf in enumerate(leaves):
+        issuer = links[len(roots) + len(intermediates) + i][1]
+        chains.append((fake_hash("c0", i), 0, leaf))
+        chains.append((fake_hash("c0", i), 1, issuer))
+    db.executemany("insert into chains values (?, ?, ?)", chains)
+
+    answers = []
+    for i in range(n_answers):
+        chain = fake_hash("c0", rnd.randrange(len(leaves)))
+        answers.append((2014010100, "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                        443, "", 1400000000 + i, 21, 771, chain))
+    db.executemany("insert into answers (campaign, ip, port, name, timestamp, "
+                   "answer_type, version, chain_hash) values (?, ?, ?, ?, ?, ?, ?, ?)", answers)
+    db.commit()
+
+    popular = db.execute("select issuer_hash from links where issuer_hash != subject_hash "
+                         "group by issuer_hash order by count(*) desc limit 1").fetchone()[0]
+    db.close()
+    return leaves[0], popular
+
+
+def legacy_cert_details(cert):
+    # The former implementation, kept here as a reference
+    query_db = piccolo.query_db
+    h = cert["hash"]
+    answers = query_db(["campaign", "ip", "name", "chain_hash", "position", "timestamp"],
+                       ["answers"], ["chains on chain_hash = hash"], ["cert_hash = ?"], [h])
+    for answer in answers:
+        answer["campaign"] = piccolo.campaign_str(answer["campaign"])
+        ts = int(answer["timestamp"])
+        answer["timestamp_str"] = piccolo.time_str(ts)
+        answer["valid_at_timestamp"] = str(int(cert["not_before"]) <= ts and ts <= int(cert["not_after"]))
+    query_db(["type", "name"], ["names"], [], ["cert_hash = ?"], [h])
+    query_db(["certs.hash as hash", "dns.name as name"], ["dns"],
+             ["certs on certs.subject_hash = dns.hash", "links on links.issuer_hash = certs.hash"],
+             ["links.subject_hash = ?"], [h])
+    query_db(["certs.hash as hash", "dns.name as name"], ["dns"],
+             ["certs on certs.subject_hash = dns.hash", "links on links.subject_hash = certs.hash"],
+             ["links.issuer_hash = ?"], [h])
+    query_db(["names.type as type", "names.name as name"], ["names"],
+             ["certs on certs.hash = names.cert_hash", "dns on certs.subject_hash = dns.hash",
+              "links on links.subject_hash = certs.hash"],
+             ["links.issuer_hash = ?"], [h])
+    query_db(["certs.hash as hash", "dns.name as name", "distance"], ["dns"],
+             ["certs on certs.subject_hash = dns.hash",
+              "transitive_links on transitive_links.issuer_hash = certs.hash"],
+             ["transitive_links.subject_hash = ?"], [h], order_by=["distance ASC"])
+    query_db(["certs.hash as hash", "dns.name as name", "distance"], ["dns"],
+             ["certs on certs.subject_hash = dns.hash",
+              "transitive_links on transitive_links.subject_hash = certs.hash"],
+             ["transitive_links.issuer_hash = ?"], [h], order_by=["distance ASC"])
+    query_db(["names.type as type", "names.name as name"], ["names"],
+             ["certs on certs.hash = names.cert_hash", "dns on certs.subject_hash = dns.hash",
+              "transitive_links on transitive_links.subject_hash = certs.hash"],
+             ["transitive_links.issuer_hash = ?"], [h])
+
+
+def measure(f, cert, repeat):
+    timings = []
+    for _ in range(repeat):
+        with piccolo.app.app_context():
+            start = time.time()
+            f(cert)
+            timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000, timings[-1] * 1000
+
+
+def main():
+    n_leaves, n_answers, repeat, keep = 20000, 100000, 20, False
+    opts, _ = getopt.getopt(sys.argv[1:], "c:a:r:k")
+    for o, v in opts:
+        if o == "-c":
+            n_leaves = int(v)
+        elif o == "-a":
+            n_answers = int(v)
+        elif o == "-r":
+            repeat = int(v)
+        elif o == "-k":
+            keep = True
+
+    fd, path = tempfile.mkstemp(suffix=".sql")
+    os.close(fd)
+    try:
+        print("Generating %d leaves and %d answers in %s..." % (n_leaves, n_answers, path))
+        leaf, popular = build_database(path, n_leaves, n_answers)
+        piccolo.create_app(path)
+
+        print("%-14s %-10s %12s %12s" % ("certificate", "path", "median (ms)", "max (ms)"))
+        for label, h in [("leaf", leaf), ("intermediate", popular)]:
+            with piccolo.app.app_context():
+                cert = piccolo.get_db().execute("select * from certs where hash = ?", [h]).fetchone()
+            for path_name, f in [("legacy", legacy_cert_details),
+                                 ("batched", piccolo.get_cert_details)]:
+                median, worst = measure(f, cert, repeat)
+                print("%-14s %-10s %12.2f %12.2f" % (label, path_name, median, worst))
+    finally:
+        if keep:
+            print("Database kept in %s" % path)
+        else:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
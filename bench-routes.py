@@ -0,0 +1,164 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Replay a weighted mix of piccolo routes on a database and report the
+latency percentiles of each route and the peak memory used.
+
+The URLs are derived from answers sampled in the database (see
+piccolo_bench.ROUTE_MIX for the routes and their default weights), and
+requested in a random order by CONCURRENCY threads, each with its own
+test client, through create_app(DATABASE, **CONFIG), the page cache
+being disabled unless -P is given. The results can
+be saved (-o) and compared with a previous run (-b): routes whose p95
+grew by more than TOLERANCE (a ratio, 0.2 by default), or which
+return errors they did not return before, are reported as
+regressions, and the exit status is then 2.
+
+Usage: bench-routes.py [-n REQUESTS] [-c CONCURRENCY] [-w ROUTE=WEIGHT]...
+                       [-k NAME=VALUE]... [-P] [-W WARMUP] [-S SAMPLES] [-s SEED]
+                       [-o RESULTS] [-b BASELINE] [-t TOLERANCE] DATABASE
+  -w: weight of a route (0 to leave it out)
+  -k: configuration value (parsed as JSON if possible),
+      e.g. -k GRAPH_CACHE_ENTRIES=0 to lay out every graph
+  -P: keep the page cache (most requests are then cache hits)
+"""
+from __future__ import print_function
+
+import getopt
+import json
+import os
+import sqlite3
+import sys
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BIN_DIR)
+
+import piccolo
+from piccolo_bench import ROUTE_MIX, NO_PAGE_CACHE, sample_answers, route_requests, replay, \
+    latency_summary, peak_rss_kb
+
+
+def config_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def print_summary(summary, baseline):
+    print("%-16s %7s %6s %10s %10s %10s %10s %9s" % ("route", "count", "errors", "p50 (ms)",
+                                                     "p95 (ms)", "p99 (ms)", "max (ms)", "p95 ratio"))
+    for name, s in summary.items():
+        ratio = ""
+        if baseline is not None and name in baseline:
+            ratio = "%8.2fx" % (s["p95"] / max(baseline[name]["p95"], 0.001))
+        print("%-16s %7d %6d %10.2f %10.2f %10.2f %10.2f %9s" % (name, s["count"], s["errors"], s["p50"],
+                                                                s["p95"], s["p99"], s["max"], ratio))
+
+
+def regressions(summary, baseline, tolerance):
+    result = []
+    for name, s in summary.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if s["p95"] > before["p95"] * (1 + tolerance):
+            result.append("%s: p95 %.2f ms, was %.2f ms" % (name, s["p95"], before["p95"]))
+        if s["errors"] > 0 and before["errors"] == 0:
+            result.append("%s: %d errors, none before" % (name, s["errors"]))
+    return result
+
+
+def usage():
+    print(__doc__.strip().split("\n\n")[-1], file=sys.stderr)
+    sys.exit(1)
+
+
+def main():
+    n_requests, concurrency, warmup, n_samples, seed = 2000, 4, 0, 1000, 0
+    results_path, baseline_path, tolerance = None, None, 0.2
+    weights, config, page_cache = dict(), dict(), False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:c:w:k:PW:S:s:o:b:t:")
+    except getopt.GetoptError:
+        usage()
+    try:
+        for o, v in opts:
+            if o == "-n":
+                n_requests = int(v)
+            elif o == "-c":
+                concurrency = int(v)
+            elif o == "-w":
+                name, weight = v.split("=", 1)
+                weights[name] = float(weight)
+            elif o == "-k":
+                name, value = v.split("=", 1)
+                config[name] = config_value(value)
+            elif o == "-P":
+                page_cache = True
+            elif o == "-W":
+                warmup = int(v)
+            elif o == "-S":
+                n_samples = int(v)
+            elif o == "-s":
+                seed = int(v)
+            elif o == "-o":
+                results_path = v
+            elif o == "-b":
+                baseline_path = v
+            elif o == "-t":
+                tolerance = float(v)
+    except ValueError:
+        usage()
+    if len(args) != 1 or concurrency < 1:
+        usage()
+    unknown = set(weights) - set(name for name, _, _ in ROUTE_MIX)
+    if unknown:
+        print("Unknown routes: %s" % ", ".join(sorted(unknown)), file=sys.stderr)
+        sys.exit(1)
+    mix = [(name, weights.get(name, weight), pattern) for name, weight, pattern in ROUTE_MIX]
+
+    db = sqlite3.connect(args[0])
+    samples = sample_answers(db, n_samples, seed)
+    db.close()
+    requests = route_requests(samples, mix, warmup + n_requests, seed)
+    if not page_cache:
+        config = dict(NO_PAGE_CACHE, **config)
+    app = piccolo.create_app(args[0], **config)
+
+    rss_before = peak_rss_kb()
+    if warmup > 0:
+        replay(app, requests[:warmup], concurrency)
+    results, elapsed = replay(app, requests[warmup:], concurrency)
+    if piccolo.layout_pool is not None:
+        # The layout processes are waited for, to count their memory
+        piccolo.layout_pool.close()
+    rss = peak_rss_kb()
+
+    baseline = None
+    if baseline_path is not None:
+        with open(baseline_path) as f:
+            baseline = json.load(f)["routes"]
+    summary = latency_summary(results)
+    print("%d requests (%d samples) in %.1f s with %d threads: %.1f requests/s" %
+          (len(results), len(samples), elapsed, concurrency, len(results) / max(elapsed, 0.001)))
+    print_summary(summary, baseline)
+    if rss is not None:
+        print("Peak RSS: %d kB (%d kB before the replay), %d kB for the child processes"
+              % (rss[0], rss_before[0], rss[1]))
+
+    if results_path is not None:
+        with open(results_path, "w") as f:
+            json.dump({"requests": len(results), "concurrency": concurrency,
+                       "elapsed": elapsed, "peak_rss_kb": rss, "config": config,
+                       "routes": summary}, f, indent=2)
+    if baseline is not None:
+        found = regressions(summary, baseline, tolerance)
+        for regression in found:
+            print("Regression: %s" % regression)
+        if found:
+            sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Build a database using the compact schema (db-compact.txt) from a
+database created with db.txt.
+
+Every table is copied with a single insert ... select statement,
+converting the columns according to their type in the compact schema:
+hexadecimal strings to blobs, and dates to integers. The statements of
+db-compact.txt following the table creations (indexes, summaries,
+search index) are run once the tables are filled, and the tables they
+fill themselves are not copied.
+
+Usage: compact-db.py SOURCE DESTINATION
+"""
+from __future__ import print_function
+
+import binascii
+import os
+import re
+import sqlite3
+import sys
+import time
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+HEX_RE = re.compile("^(?:[0-9a-fA-F]{2})+$")
+
+
+def unhex(value):
+    # Values which are not hexadecimal strings (e.g. the empty chain
+    # hash of answers without certificates) are kept as is
+    if isinstance(value, type(u"")) or isinstance(value, str):
+        if HEX_RE.match(value):
+            return sqlite3.Binary(binascii.unhexlify(value))
+    return value
+
+
+def schema_statements():
+    statement = ""
+    with open(os.path.join(BIN_DIR, "db-compact.txt")) as f:
+        for line in f:
+            if line.startswith("--") or line.startswith("."):
+                continue
+            statement += line
+            # Triggers hold semicolons inside their body
+            if sqlite3.complete_statement(statement):
+                yield statement.strip().rstrip(";")
+                statement = ""
+
+
+def column_conversions(db, table):
+    conversions = []
+    for _, name, decl_type, _, _, _ in db.execute("pragma main.table_info(%s)" % table):
+        if decl_type.lower() == "blob":
+            conversions.append("unhex(%s)" % name)
+        elif decl_type.lower() in ["int", "integer"]:
+            conversions.append("cast(%s as integer)" % name)
+        else:
+            conversions.append(name)
+    return conversions
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("Usage: compact-db.py SOURCE DESTINATION", file=sys.stderr)
+        sys.exit(1)
+    source, destination = sys.argv[1:]
+    if os.path.exists(destination):
+        print("%s already exists" % destination, file=sys.stderr)
+        sys.exit(1)
+
+    db = sqlite3.connect(destination)
+    db.create_function("unhex", 1, unhex)
+    db.execute("pragma journal_mode = off")
+    db.execute("pragma synchronous = off")
+    db.execute("attach database ? as src", [source])
+    source_tables = set(row[0] for row in
+                        db.execute("select name from src.sqlite_master where type = 'table'"))
+
+    statements = list(schema_statements())
+    filled_by_script = set(re.findall(r"^insert into (\w+)", "\n".join(statements), re.M))
+    for statement in statements:
+        if statement.startswith("create table"):
+            db.execute(statement)
+
+    tables = [row[0] for row in db.execute("select name from main.sqlite_master where type = 'table'")]
+    for table in tables:
+        if table not in source_tables or table in filled_by_script:
+            continue
+        start = time.time()
+        columns = [row[1] for row in db.execute("pragma main.table_info(%s)" % table)]
+        # Rows duplicated in the source (with respect to the primary
+        # keys of the compact schema) are only copied once
+        cur = db.execute("insert or ignore into main.%s (%s) select %s from src.%s" %
+                         (table, ", ".join(columns), ", ".join(column_conversions(db, table)), table))
+        print("%-24s %10d rows %8.1f s" % (table, cur.rowcount, time.time() - start))
+        db.commit()
+
+    start = time.time()
+    for statement in statements:
+        if not statement.startswith("create table"):
+            db.execute(statement)
+    db.commit()
+    print("%-24s %15s %8.1f s" % ("indexes", "", time.time() - start))
+    db.execute("detach database src")
+    db.execute("vacuum")
+    db.close()
+
+    print("%s: %d bytes, %s: %d bytes" % (source, os.path.getsize(source),
+                                          destination, os.path.getsize(destination)))
+
+
+if __name__ == "__main__":
+    main()
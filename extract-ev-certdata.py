@@ -1,25 +1,377 @@
 #!/usr/bin/env python2
 # -*- coding: utf-8 -*-
 """
-Dump EV certs SHA1 from the firefox nsIdentityChecking.cpp source file.
+Dump EV certs SHA1 from the firefox nsIdentityChecking.cpp source file,
+or store the roots of many revisions of the Mozilla certificate store
+in a database.
 
-WARNING: the first entry and last entries of the EV list are for debug purpose.
+Both files are read line by line. The EV roots are the entries of the
+myTrustedEVInfos array of nsIdentityChecking.cpp; the entries for
+debug purpose (within #ifdef DEBUG, or the sample entry, with the
+0.0.0.0 OID and no OID name) are left out, wherever they are. The
+roots of certdata.txt are its trust objects, with their trust for
+servers, emails and code (as extractCertdata); those naming their
+certificate by issuer and serial number only (distrusted intermediate
+CAs), without its hash, are left out.
+
+A revision is a directory holding certdata.txt and/or
+nsIdentityChecking.cpp, and possibly the hg summary of the revision in
+a revision file (see data-samples/2014-03-mozilla-certificate-store).
+Files are identified by the SHA-1 of their contents: the roots of each
+distinct file are stored once, in store_roots (by certdata_hash) and
+ev_roots (by ev_hash), and trust_store_revisions gives the files of
+each revision. Files already in the database, or in CACHE_DIR, are not
+parsed again; the others are parsed by JOBS processes.
+
+Usage: extract-ev-certdata.py NSIDENTITYCHECKING_CPP
+       extract-ev-certdata.py [-j JOBS] [-c CACHE_DIR] -o DATABASE REVISION_DIR...
 """
 from __future__ import print_function
 
+import binascii
+import getopt
+import hashlib
+import io
+import json
+import multiprocessing
+import os
 import re
+import sqlite3
 import sys
 
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BIN_DIR)
+
+from piccolo_db import schema_kind, to_compact
+
 PATTERN = re.compile(":".join(["([0-9A-F]{2})"] * 20))
 
-def extract_ev_sha1(filename):
-    with open(filename) as f:
-        for match in PATTERN.finditer(f.read()):
+EV_FILE = "nsIdentityChecking.cpp"
+CERTDATA_FILE = "certdata.txt"
+REVISION_FILE = "revision"
+
+EV_ARRAY_RE = re.compile(r"myTrustedEVInfos\s*\[\s*\]\s*=")
+TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|//.*|/\*.*?\*/|[{},]|[^\s{},"/]+')
+NULL_TOKENS = ["0", "nullptr", "NULL"]
+SAMPLE_OID = "0.0.0.0"
+
+REVISION_RE = re.compile(r"^(?:parent|changeset):\s*(\d+):([0-9a-f]+)\s*(.*)$")
+
+# Trust values of certdata.txt (CKT_NSS_... or, in old revisions,
+# CKT_NETSCAPE_...)
+TRUST_VALUES = {"TRUSTED_DELEGATOR": "trusted", "MUST_VERIFY_TRUST": "must_verify",
+                "NOT_TRUSTED": "distrusted", "TRUST_UNKNOWN": "unknown",
+                "VALID": "valid", "VALID_DELEGATOR": "valid_delegator"}
+TRUST_ATTRIBUTES = [("server_auth", "CKA_TRUST_SERVER_AUTH"),
+                    ("email_protection", "CKA_TRUST_EMAIL_PROTECTION"),
+                    ("code_signing", "CKA_TRUST_CODE_SIGNING")]
+
+TRUST_STORE_TABLES = ["trust_store_revisions", "store_roots", "ev_roots"]
+SCHEMA_OBJECT_RE = re.compile(r"^create (table|index) (\w+)(?:\s+on\s+(\w+))?", re.IGNORECASE)
+
+
+def trust_store_schema(schema):
+    """Yields the statements creating the trust store tables and their
+    indexes in schema (db.txt or db-compact.txt), when missing."""
+    statement = ""
+    with open(os.path.join(BIN_DIR, schema)) as f:
+        for line in f:
+            if line.startswith("--") or line.startswith("."):
+                continue
+            statement += line
+            if sqlite3.complete_statement(statement):
+                statement, complete = "", statement.strip().rstrip(";")
+                m = SCHEMA_OBJECT_RE.match(complete)
+                if m is not None and (m.group(3) or m.group(2)) in TRUST_STORE_TABLES:
+                    yield "create %s if not exists %s" % (m.group(1), complete[m.end(1) + 1:])
+
+
+def unquote(token):
+    if token in NULL_TOKENS:
+        return None
+    if token.startswith('"'):
+        return token[1:-1]
+    return token
+
+
+def ev_entries(lines):
+    """Yields the entries of the myTrustedEVInfos array, as dicts (oid,
+    oid_name, sha1, debug)."""
+    in_array, depth, fields = False, 0, None
+    # The #if blocks the current line is in: whether they test DEBUG,
+    # and whether the current branch only applies to DEBUG builds
+    conditions = []
+    for line in lines:
+        directive = line.strip()
+        if directive.startswith("#"):
+            words = directive[1:].split()
+            if not words:
+                continue
+            if words[0] in ["if", "ifdef", "ifndef", "elif"]:
+                on_debug = "DEBUG" in directive
+                branch = on_debug and words[0] != "ifndef" and "!" not in directive
+                if words[0] == "elif" and conditions:
+                    conditions[-1] = [on_debug, branch]
+                else:
+                    conditions.append([on_debug, branch])
+            elif words[0] == "else" and conditions:
+                conditions[-1][1] = conditions[-1][0] and not conditions[-1][1]
+            elif words[0] == "endif" and conditions:
+                conditions.pop()
+            continue
+        if not in_array:
+            in_array = EV_ARRAY_RE.search(line) is not None
+            continue
+        for token in TOKEN_RE.findall(line):
+            if token.startswith("//") or token.startswith("/*"):
+                continue
+            if token == "{":
+                depth += 1
+                if depth == 1:
+                    fields, debug = [[]], any(branch for _, branch in conditions)
+                else:
+                    fields[-1].append(token)
+            elif token == "}":
+                depth -= 1
+                if depth == 0:
+                    yield ev_entry(fields, debug)
+                    fields = None
+                elif depth < 0:
+                    return
+                else:
+                    fields[-1].append(token)
+            elif token == "," and depth == 1:
+                fields.append([])
+            elif fields is not None:
+                fields[-1].append(token)
+
+
+def ev_entry(fields, debug):
+    values = [[unquote(t) for t in f] for f in fields]
+    oid = values[0][0] if values and values[0] else None
+    oid_name = "".join(values[1]) if len(values) > 1 and None not in values[1] else None
+    sha1 = None
+    for value in values:
+        match = PATTERN.search("".join(v for v in value if v is not None))
+        if match is not None:
             sha1 = "".join(match.groups()).lower()
-            yield sha1
+            break
+    debug = debug or oid == SAMPLE_OID or oid_name is None
+    return {"oid": oid, "oid_name": oid_name, "sha1": sha1, "debug": debug}
+
+
+def extract_ev_sha1(filename):
+    with io.open(filename, encoding="latin-1") as f:
+        for entry in ev_entries(f):
+            if not entry["debug"] and entry["sha1"] is not None:
+                yield entry["sha1"]
+
+
+def decode_utf8(value):
+    if value.startswith('"') and value.endswith('"'):
+        value = value[1:-1]
+    value = re.sub(r"\\([0-7]{3})", lambda m: u"%c" % int(m.group(1), 8), value)
+    return value.encode("latin-1").decode("utf-8", "replace")
+
+
+def certdata_objects(lines):
+    """Yields the objects of a certdata.txt file, as dicts of their
+    attributes (with MULTILINE_OCTAL values decoded)."""
+    obj, name, value = dict(), None, None
+    for line in lines:
+        line = line.strip()
+        if value is not None:
+            if line == "END":
+                obj[name] = bytes(value)
+                value = None
+            else:
+                value.extend(int(o, 8) for o in line.split("\\")[1:])
+            continue
+        if not line or line.startswith("#"):
+            continue
+        parts = line.split(None, 2)
+        if parts[0] == "CKA_CLASS" and obj:
+            yield obj
+            obj = dict()
+        if len(parts) == 2 and parts[1] == "MULTILINE_OCTAL":
+            name, value = parts[0], bytearray()
+        elif len(parts) == 3:
+            obj[parts[0]] = decode_utf8(parts[2]) if parts[1] == "UTF8" else parts[2]
+    if obj:
+        yield obj
+
+
+def trust_value(value):
+    if value is None:
+        return None
+    for prefix in ["CKT_NSS_", "CKT_NETSCAPE_"]:
+        if value.startswith(prefix):
+            return TRUST_VALUES.get(value[len(prefix):], value)
+    return value
+
+
+def certdata_roots(lines):
+    """Yields the (cert_hash, label, server_auth, email_protection,
+    code_signing) of the trust objects of certdata.txt."""
+    for obj in certdata_objects(lines):
+        if not obj.get("CKA_CLASS", "").endswith("_TRUST") or "CKA_CERT_SHA1_HASH" not in obj:
+            continue
+        cert_hash = binascii.hexlify(obj["CKA_CERT_SHA1_HASH"]).decode("ascii")
+        yield tuple([cert_hash, obj.get("CKA_LABEL")] +
+                    [trust_value(obj.get(attribute)) for _, attribute in TRUST_ATTRIBUTES])
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def parse_file(job):
+    """Returns the rows of a certdata.txt or nsIdentityChecking.cpp
+    file (run by the worker processes)."""
+    kind, path, content_hash = job
+    with io.open(path, encoding="latin-1") as f:
+        if kind == "certdata":
+            rows = list(certdata_roots(f))
+        else:
+            rows = sorted(set((e["sha1"], e["oid"], e["oid_name"]) for e in ev_entries(f)
+                              if not e["debug"] and e["sha1"] is not None))
+    return kind, content_hash, rows
+
+
+def read_revision(directory):
+    """Returns the (revision, number, name, description) of a revision
+    directory, from its hg summary if any."""
+    name = os.path.basename(os.path.normpath(directory))
+    path = os.path.join(directory, REVISION_FILE)
+    if os.path.exists(path):
+        with io.open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                match = REVISION_RE.match(line.strip())
+                if match is not None:
+                    return match.group(2), int(match.group(1)), name, match.group(3)
+    return name, None, name, ""
+
+
+class Ingester(object):
+    TABLES = {"certdata": ("store_roots", "certdata_hash",
+                           ["cert_hash", "label", "server_auth", "email_protection", "code_signing"]),
+              "ev": ("ev_roots", "ev_hash", ["cert_hash", "oid", "oid_name"])}
+
+    def __init__(self, database, cache_dir=None):
+        self.db = sqlite3.connect(database)
+        self.compact = schema_kind(self.db) == "compact"
+        self.cache_dir = cache_dir
+        for statement in trust_store_schema("db-compact.txt" if self.compact else "db.txt"):
+            self.db.execute(statement)
+
+    def value(self, v):
+        return to_compact(v) if self.compact else v
+
+    def is_stored(self, kind, content_hash):
+        table, key, _ = self.TABLES[kind]
+        # A file without any root is recorded by its revision only
+        if self.db.execute("select 1 from %s where %s = ? limit 1" % (table, key),
+                           [self.value(content_hash)]).fetchone() is not None:
+            return True
+        return self.db.execute("select 1 from trust_store_revisions where %s = ? limit 1" % key,
+                               [self.value(content_hash)]).fetchone() is not None
+
+    def cache_path(self, kind, content_hash):
+        return os.path.join(self.cache_dir, "%s-%s.json" % (kind, content_hash))
+
+    def cached_rows(self, kind, content_hash):
+        if self.cache_dir is None or not os.path.exists(self.cache_path(kind, content_hash)):
+            return None
+        with open(self.cache_path(kind, content_hash)) as f:
+            return json.load(f)
+
+    def store(self, kind, content_hash, rows):
+        table, key, columns = self.TABLES[kind]
+        self.db.executemany("insert or ignore into %s (%s, %s) values (?, %s)" %
+                            (table, key, ", ".join(columns), ", ".join("?" * len(columns))),
+                            ([self.value(content_hash)] + [self.value(v) for v in row] for row in rows))
+        if self.cache_dir is not None and not os.path.exists(self.cache_path(kind, content_hash)):
+            tmp = self.cache_path(kind, content_hash) + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(rows, f)
+            os.rename(tmp, self.cache_path(kind, content_hash))
+
+    def ingest(self, directories, jobs):
+        revisions, files = [], dict()
+        for directory in directories:
+            hashes = dict()
+            for kind, filename in [("certdata", CERTDATA_FILE), ("ev", EV_FILE)]:
+                path = os.path.join(directory, filename)
+                if os.path.exists(path):
+                    hashes[kind] = file_hash(path)
+                    files.setdefault((kind, hashes[kind]), path)
+            revisions.append(read_revision(directory) + (hashes.get("certdata"), hashes.get("ev")))
+
+        parsed, cached, to_parse = 0, 0, []
+        for (kind, content_hash), path in sorted(files.items()):
+            if self.is_stored(kind, content_hash):
+                continue
+            rows = self.cached_rows(kind, content_hash)
+            if rows is not None:
+                self.store(kind, content_hash, rows)
+                cached += 1
+            else:
+                to_parse.append((kind, path, content_hash))
+        if to_parse:
+            pool = multiprocessing.Pool(max(1, min(jobs, len(to_parse))))
+            try:
+                for kind, content_hash, rows in pool.imap_unordered(parse_file, to_parse):
+                    self.store(kind, content_hash, rows)
+                    parsed += 1
+            finally:
+                pool.close()
+                pool.join()
+
+        self.db.executemany("insert or replace into trust_store_revisions values (?, ?, ?, ?, ?, ?)",
+                            ([self.value(v) for v in revision] for revision in revisions))
+        self.db.commit()
+        self.db.close()
+        return len(revisions), len(files), parsed, cached
+
+
+def usage():
+    print(__doc__.strip().split("\n\n")[-1], file=sys.stderr)
+    sys.exit(1)
+
+
+def main():
+    jobs, cache_dir, database = multiprocessing.cpu_count(), None, None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "j:c:o:")
+        for o, v in opts:
+            if o == "-j":
+                jobs = int(v)
+            elif o == "-c":
+                cache_dir = v
+            elif o == "-o":
+                database = v
+    except (getopt.GetoptError, ValueError):
+        usage()
+
+    if database is None:
+        if len(args) != 1:
+            usage()
+        for sha1 in extract_ev_sha1(args[0]):
+            print(sha1)
+        return
+
+    if not args:
+        usage()
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    n_revisions, n_files, parsed, cached = Ingester(database, cache_dir).ingest(args, jobs)
+    print("%d revisions, %d distinct files: %d parsed, %d from the cache, %d already stored"
+          % (n_revisions, n_files, parsed, cached, n_files - parsed - cached), file=sys.stderr)
+
 
 if __name__ == "__main__":
-    ev_certs = list(extract_ev_sha1(sys.argv[1]))
-    # XXX filter out debug certs
-    for sha1 in ev_certs[1:-1]:
-        print(sha1)
+    main()
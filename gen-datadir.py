@@ -0,0 +1,469 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Generate a synthetic data-dir (the CSV files imported by db.txt and
+the raw/certs packs) to measure load-db.py and piccolo at chosen sizes.
+
+The certificate graph has ROOTS self-signed roots (most of them
+trusted) and INTERMEDIATES CAs, issued by a root or by another
+intermediate, a fraction CROSS_SIGNED of which are cross-signed (a
+second certificate with the same subject, issued by another root).
+The LEAVES server certificates are spread over the intermediates with
+a Zipf distribution, so that a few intermediates issue most of them.
+Each leaf is sent in a chain that may lack its intermediates, be out
+of order, or carry the root or an unrelated certificate; the chains
+are then built, checked against the trusted roots and rated as
+buildChains, flagTrust and rateChains would.
+
+Each of the CAMPAIGNS campaigns (one per month from January 2014)
+contacts the IPS hosts. Most hosts keep their answer from one campaign
+to the next, but some disappear or come back, or change their answer
+type, protocol version or certificate. Popular leaves are served by
+many hosts.
+
+The output only depends on the options, so a command line always
+produces the same data-dir.
+
+Usage: gen-datadir.py [-c CAMPAIGNS] [-i IPS] [-l LEAVES] [-I INTERMEDIATES]
+                      [-r ROOTS] [-x CROSS_SIGNED] [-s SEED] [-L] DATA_DIR
+  -L: also create DATA_DIR/db.sql with load-db.py
+"""
+from __future__ import print_function
+
+import bisect
+import calendar
+import getopt
+import hashlib
+import os
+import random
+import re
+import struct
+import subprocess
+import sys
+import time
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BIN_DIR)
+
+from piccolo_pack import pack_record
+
+TRUST_FLAG = "trusted"
+TRUSTED_ROOTS = 0.85
+
+# Share of the CAs issued by another intermediate, and of those issued
+# by a DN absent from the data (their chains are incomplete)
+SUB_CA = 0.2
+UNKNOWN_ISSUER = 0.02
+
+# Exponent of the Zipf distribution of leaves over intermediates (and
+# of hosts over popular leaves)
+ZIPF_EXPONENT = 1.1
+
+# Variants of the chains sent with the leaves
+CHAIN_WITH_ROOT = 0.1
+CHAIN_WITHOUT_INTERMEDIATES = 0.05
+CHAIN_OUT_OF_ORDER = 0.04
+CHAIN_WITH_UNUSED = 0.03
+MAX_BUILT_CHAINS = 4
+
+# Hosts sharing a popular leaf, and changes between campaigns
+POPULAR_LEAF = 0.3
+HOST_WITH_NAME = 0.2
+HOST_DISAPPEARS = 0.03
+HOST_COMES_BACK = 0.5
+HOST_CHANGES_ANSWER = 0.1
+HOST_CHANGES_LEAF = 0.03
+
+# (weight, answer_type, alert_level, alert_type)
+ANSWER_TYPES = [(80, 21, "", ""), (8, 11, "2", "40"), (2, 11, "2", "70"),
+                (1, 20, "", ""), (1, 10, "", "1"), (4, 0, "", ""), (4, 1, "", "")]
+VERSIONS = [(60, 0x0303), (25, 0x0301), (12, 0x0302), (3, 0x0300)]
+CIPHERSUITES = [(40, 0xc02f), (20, 0xc013), (15, 0x002f), (10, 0x0035), (10, 0x0005), (5, 0x000a)]
+KEY_SIZES = [(80, 2048), (12, 4096), (8, 1024)]
+
+DOMAINS = ["com", "net", "org", "fr", "de", "io", "co.uk", "info"]
+
+CSV_FILES = ["answers", "chains", "certs", "dns", "names", "links", "built_chains",
+             "built_links", "unused_certs", "trusted_certs", "trusted_chains",
+             "trusted_built_chains", "rated_chains", "roots"]
+
+YEAR = 365 * 86400
+
+
+def sha1(label):
+    return hashlib.sha1(label.encode("utf-8")).hexdigest()
+
+
+def weighted(rnd, choices):
+    """Picks the item following the weight of one of choices."""
+    x = rnd.uniform(0, sum(c[0] for c in choices))
+    for choice in choices:
+        x -= choice[0]
+        if x <= 0:
+            break
+    return choice[1] if len(choice) == 2 else choice[1:]
+
+
+class Zipf(object):
+    def __init__(self, n, exponent=ZIPF_EXPONENT):
+        self.cumulative, total = [], 0.0
+        for rank in range(1, n + 1):
+            total += rank ** -exponent
+            self.cumulative.append(total)
+
+    def draw(self, rnd):
+        return bisect.bisect_left(self.cumulative, rnd.uniform(0, self.cumulative[-1]))
+
+
+# fileOps CSV dialect (see quote_csv_field in fileOps.ml)
+
+SPECIAL_CHARS_RE = re.compile(r'[^ -!#-\[\]-\x7f]')
+
+
+def quote_field(value):
+    s = str(value)
+    if SPECIAL_CHARS_RE.search(s):
+        s = "".join({"\n": "\\n", "\t": "\\t", "\\": "\\\\", '"': '""'}.get(c, c)
+                    if 32 <= ord(c) < 128 or c in "\n\t" else "\\x%02x" % ord(c)
+                    for c in s)
+    return s
+
+
+def csv_line(fields):
+    return '"' + '":"'.join(quote_field(f) for f in fields) + '"\n'
+
+
+class DataDir(object):
+    def __init__(self, path):
+        self.path = path
+        self.files = dict((name, open(os.path.join(path, name + ".csv"), "w"))
+                          for name in CSV_FILES)
+        self.packs = dict()
+        self.counts = dict((name, 0) for name in CSV_FILES)
+
+    def write(self, table, fields):
+        self.files[table].write(csv_line(fields))
+        self.counts[table] += 1
+
+    def write_raw(self, name, contents):
+        # raw/certs/<prefix>.pack records, as written by fileOps.ml
+        prefix = name[:2]
+        pack = self.packs.get(prefix)
+        if pack is None:
+            pack = self.packs[prefix] = open(os.path.join(self.path, "raw", "certs",
+                                                          prefix + ".pack"), "ab")
+        pack.write(pack_record(name, contents))
+
+    def close(self):
+        for f in list(self.files.values()) + list(self.packs.values()):
+            f.close()
+
+
+class Cert(object):
+    __slots__ = ["hash", "subject", "issuer", "not_before", "not_after", "is_ca", "key_size"]
+
+    def __init__(self, label, subject, issuer, not_before, not_after, is_ca, key_size):
+        self.hash = sha1("cert " + label)
+        self.subject, self.issuer = subject, issuer
+        self.not_before, self.not_after = not_before, not_after
+        self.is_ca, self.key_size = is_ca, key_size
+
+
+class Generator(object):
+    def __init__(self, out, seed, start):
+        self.out = out
+        self.rnd = random.Random(seed)
+        self.start = start
+        self.certs_by_subject = dict()
+        self.trusted_roots = set()
+        self.trusted_certs = set()
+        self.cas = []
+        self.paths_cache = dict()
+
+    def add_dn(self, dn):
+        h = sha1("dn " + dn)
+        self.out.write("dns", [h, dn])
+        return h
+
+    def add_cert(self, cert, names=()):
+        rnd = self.rnd
+        modulus = (hashlib.sha256(cert.hash.encode("ascii")).hexdigest() * 32)[:cert.key_size // 4]
+        self.out.write("certs", [cert.hash, 3, "%x" % rnd.getrandbits(64), cert.subject,
+                                 cert.issuer, cert.not_before, cert.not_after, "RSA", modulus,
+                                 "10001", int(cert.is_ca), "", "", "", "sha256WithRSAEncryption"])
+        for name in names:
+            self.out.write("names", [cert.hash, "DNS", name])
+        # A DER-like blob of a realistic size
+        length = 700 + cert.key_size // 8 + rnd.randrange(300)
+        body = (hashlib.sha1(cert.hash.encode("ascii")).digest() * (length // 20 + 1))[:length]
+        self.out.write_raw(cert.hash, b"\x30\x82" + struct.pack(">H", length) + body)
+        self.certs_by_subject.setdefault(cert.subject, []).append(cert)
+
+    def add_links(self, cert):
+        for issuer in self.certs_by_subject.get(cert.issuer, []):
+            self.out.write("links", [cert.hash, issuer.hash])
+
+    def build_cas(self, n_roots, n_intermediates, cross_signed):
+        rnd = self.rnd
+        roots = []
+        for i in range(n_roots):
+            dn = self.add_dn("/C=US/O=Root Authority %d/CN=Root CA %d" % (i, i))
+            root = Cert("root %d" % i, dn, dn, self.start - 15 * YEAR, self.start + 15 * YEAR,
+                        True, 4096 if i % 2 else 2048)
+            self.add_cert(root)
+            roots.append(root)
+            if i == 0 or rnd.random() < TRUSTED_ROOTS:
+                self.trusted_roots.add(root.hash)
+                self.out.write("roots", [root.hash, TRUST_FLAG])
+        unknown = self.add_dn("/C=US/O=Unknown Authority/CN=Unknown CA")
+
+        intermediates = []
+        for i in range(n_intermediates):
+            dn = self.add_dn("/C=US/O=Certification Company %d/CN=Intermediate CA %d" % (i % 97, i))
+            issuers = [rnd.choice(roots).subject]
+            if intermediates and rnd.random() < SUB_CA:
+                issuers = [rnd.choice(intermediates).subject]
+            elif rnd.random() < UNKNOWN_ISSUER:
+                issuers = [unknown]
+            elif rnd.random() < cross_signed and n_roots > 1:
+                issuers.append(rnd.choice([r.subject for r in roots if r.subject != issuers[0]]))
+            not_before = self.start - rnd.randrange(2 * YEAR, 8 * YEAR)
+            for j, issuer in enumerate(issuers):
+                ca = Cert("intermediate %d %d" % (i, j), dn, issuer, not_before,
+                          not_before + 10 * YEAR, True, 2048)
+                self.add_cert(ca)
+                intermediates.append(ca)
+
+        for cert in roots + intermediates:
+            self.add_links(cert)
+        self.cas = roots + intermediates
+        issuing_dns = []
+        for ca in intermediates:
+            if ca.subject not in issuing_dns[-1:]:
+                issuing_dns.append(ca.subject)
+        return issuing_dns
+
+    def build_leaves(self, n_leaves, issuing_dns):
+        rnd = self.rnd
+        zipf = Zipf(len(issuing_dns))
+        leaves = []
+        for i in range(n_leaves):
+            domain = "site%d.example.%s" % (i, DOMAINS[i % len(DOMAINS)])
+            dn = self.add_dn("/C=FR/O=Site %d/CN=www.%s" % (i, domain))
+            not_before = self.start - rnd.randrange(0, 2 * YEAR)
+            leaf = Cert("leaf %d" % i, dn, issuing_dns[zipf.draw(rnd)], not_before,
+                        not_before + rnd.choice([1, 1, 2, 3]) * YEAR, False, weighted(rnd, KEY_SIZES))
+            names = ["www." + domain, domain]
+            if rnd.random() < 0.1:
+                names.append("*." + domain)
+            self.add_cert(leaf, names)
+            self.add_links(leaf)
+            leaves.append(self.build_chain(leaf))
+        return leaves
+
+    def paths(self, cert, seen=()):
+        """Returns the paths from cert up to a root (or to a missing
+        issuer), at most MAX_BUILT_CHAINS of them."""
+        if cert.is_ca and cert.hash in self.paths_cache:
+            return self.paths_cache[cert.hash]
+        issuers = [c for c in self.certs_by_subject.get(cert.issuer, [])
+                   if c.hash not in seen and c is not cert]
+        if cert.subject == cert.issuer or not issuers:
+            result = [[cert]]
+        else:
+            result = []
+            for issuer in issuers:
+                for path in self.paths(issuer, seen + (cert.hash,)):
+                    result.append([cert] + path)
+            result = result[:MAX_BUILT_CHAINS]
+        if cert.is_ca and not seen:
+            self.paths_cache[cert.hash] = result
+        return result
+
+    def build_chain(self, leaf):
+        """Writes the chain sent with leaf, with its built chains, and
+        returns its hash."""
+        rnd = self.rnd
+        paths = self.paths(leaf)
+        message = list(paths[0])
+        root = message[-1]
+        if root.subject == root.issuer and rnd.random() >= CHAIN_WITH_ROOT:
+            message.pop()
+        if len(message) > 1 and rnd.random() < CHAIN_WITHOUT_INTERMEDIATES:
+            message = message[:1]
+        if len(message) > 1 and rnd.random() < CHAIN_OUT_OF_ORDER:
+            message = [message[0]] + message[:0:-1] if len(message) > 2 else message[::-1]
+        if rnd.random() < CHAIN_WITH_UNUSED:
+            message.append(rnd.choice(self.cas))
+        chain_hash = sha1("chain " + " ".join(c.hash for c in message))
+        for position, cert in enumerate(message):
+            self.out.write("chains", [chain_hash, position, cert.hash])
+
+        positions = dict((c.hash, p) for p, c in reversed(list(enumerate(message))))
+        trusted_chain = False
+        for n, path in enumerate(paths):
+            in_message = [positions.get(c.hash, -1) for c in path]
+            complete = path[-1].subject == path[-1].issuer
+            ordered = in_message[0] == 0 and \
+                all(a < b for a, b in zip([p for p in in_message if p >= 0],
+                                          [p for p in in_message if p >= 0][1:]))
+            n_transvalid = sum(1 for c, p in zip(path[1:], in_message[1:])
+                               if p < 0 and c.subject != c.issuer)
+            used = set(p for p in in_message if p >= 0)
+            unused = [p for p in range(len(message)) if p not in used]
+            trusted = complete and path[-1].hash in self.trusted_roots
+            self.out.write("built_chains", [chain_hash, n, len(path), int(complete), int(ordered),
+                                            n_transvalid, len(unused),
+                                            max(c.not_before for c in path),
+                                            min(c.not_after for c in path),
+                                            "RSA%d" % leaf.key_size])
+            for position, (cert, p) in enumerate(zip(path, in_message)):
+                self.out.write("built_links", [chain_hash, n, position, p, cert.hash])
+            for p in unused:
+                self.out.write("unused_certs", [chain_hash, n, p, message[p].hash])
+            if trusted:
+                trusted_chain = True
+                self.out.write("trusted_built_chains", [chain_hash, n, TRUST_FLAG])
+                for cert in path:
+                    self.trusted_certs.add(cert.hash)
+            self.out.write("rated_chains", [chain_hash, n, TRUST_FLAG,
+                                            grade(complete, trusted, ordered, len(unused), n_transvalid)])
+        if trusted_chain:
+            self.out.write("trusted_chains", [chain_hash, TRUST_FLAG])
+        return chain_hash
+
+    def build_campaigns(self, n_campaigns, n_ips, chains):
+        rnd = self.rnd
+        popular = Zipf(len(chains))
+        ips = set()
+        while len(ips) < n_ips:
+            ips.add(rnd.randrange(1 << 24, 224 << 24))
+        ips = sorted(ips)
+        rnd.shuffle(ips)
+
+        def draw_answer():
+            return weighted(rnd, ANSWER_TYPES) + (weighted(rnd, VERSIONS), weighted(rnd, CIPHERSUITES))
+
+        def draw_chain():
+            if rnd.random() < POPULAR_LEAF:
+                return popular.draw(rnd)
+            return rnd.randrange(len(chains))
+
+        # For each host: present, answer, chain index, name
+        hosts = []
+        for i in range(n_ips):
+            name = ""
+            if rnd.random() < HOST_WITH_NAME:
+                name = "host%d.example.net" % i
+            hosts.append([True, draw_answer(), draw_chain(), name])
+
+        for c in range(n_campaigns):
+            year, month = 2014 + c // 12, 1 + c % 12
+            campaign = int("%04d%02d0100" % (year, month))
+            timestamp = calendar.timegm((year, month, 1, 0, 0, 0))
+            for ip, host in zip(ips, hosts):
+                if c > 0:
+                    if host[0]:
+                        host[0] = rnd.random() >= HOST_DISAPPEARS
+                    else:
+                        host[0] = rnd.random() < HOST_COMES_BACK
+                    if rnd.random() < HOST_CHANGES_ANSWER:
+                        host[1] = draw_answer()
+                    if rnd.random() < HOST_CHANGES_LEAF:
+                        host[2] = draw_chain()
+                if not host[0]:
+                    continue
+                timestamp += rnd.randrange(3)
+                ip_str = "%d.%d.%d.%d" % (ip >> 24, ip >> 16 & 255, ip >> 8 & 255, ip & 255)
+                self.write_answer(campaign, ip_str, host, timestamp, chains)
+
+    def write_answer(self, campaign, ip, host, timestamp, chains):
+        (answer_type, alert_level, alert_type, version, ciphersuite) = host[1]
+        random_str, chain_hash = "", ""
+        if answer_type in (20, 21):
+            random_str = "%064x" % self.rnd.getrandbits(256)
+            chain_hash = chains[host[2]]
+        if answer_type in (0, 1, 10):
+            version, ciphersuite = "", ""
+        elif answer_type == 11:
+            ciphersuite = ""
+        elif answer_type == 20:
+            version, ciphersuite = 2, 0x010080
+        self.out.write("answers", [campaign, ip, 443, host[3], timestamp, answer_type, version,
+                                   random_str, ciphersuite, alert_level, alert_type, chain_hash,
+                                   "", "", "", "", ""])
+
+
+def grade(complete, trusted, ordered, n_unused, n_transvalid):
+    # See rate_chain in rateChains.ml
+    if not complete:
+        return "F"
+    if trusted:
+        if n_transvalid > 0:
+            return "D"
+        if not ordered:
+            return "C"
+        return "A" if n_unused == 0 else "B"
+    if n_transvalid > 0:
+        return "E"
+    if ordered and n_unused == 0:
+        return "C"
+    return "D"
+
+
+def usage():
+    print(__doc__.strip().split("\n\n")[-1], file=sys.stderr)
+    sys.exit(1)
+
+
+def main():
+    n_campaigns, n_ips, n_leaves, n_intermediates, n_roots = 2, 100000, None, 200, 30
+    cross_signed, seed, load = 0.1, 42, False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "c:i:l:I:r:x:s:L")
+    except getopt.GetoptError:
+        usage()
+    for o, v in opts:
+        if o == "-c":
+            n_campaigns = int(v)
+        elif o == "-i":
+            n_ips = int(v)
+        elif o == "-l":
+            n_leaves = int(v)
+        elif o == "-I":
+            n_intermediates = int(v)
+        elif o == "-r":
+            n_roots = int(v)
+        elif o == "-x":
+            cross_signed = float(v)
+        elif o == "-s":
+            seed = int(v)
+        elif o == "-L":
+            load = True
+    if len(args) != 1 or n_roots < 1 or n_intermediates < 1:
+        usage()
+    if n_leaves is None:
+        n_leaves = max(1, n_ips // 2)
+    data_dir = args[0]
+
+    os.makedirs(os.path.join(data_dir, "raw", "certs"))
+    out = DataDir(data_dir)
+    generator = Generator(out, seed, calendar.timegm((2014, 1, 1, 0, 0, 0)))
+    start = time.time()
+    issuing_dns = generator.build_cas(n_roots, n_intermediates, cross_signed)
+    chains = generator.build_leaves(n_leaves, issuing_dns)
+    for h in sorted(generator.trusted_certs):
+        out.write("trusted_certs", [h, TRUST_FLAG])
+    generator.build_campaigns(n_campaigns, n_ips, chains)
+    out.close()
+    for name in CSV_FILES:
+        print("%-22s %10d rows" % (name, out.counts[name]))
+    print("Data-dir generated in %s in %.1f s" % (data_dir, time.time() - start))
+    sys.stdout.flush()
+
+    if load:
+        subprocess.check_call([sys.executable, os.path.join(BIN_DIR, "load-db.py"), data_dir])
+
+
+if __name__ == "__main__":
+    main()
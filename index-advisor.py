@@ -0,0 +1,290 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Derive the indexes needed by the queries piccolo issues, create them
+and measure the effect on every route.
+
+Each route is requested on a sample URL, which records the shapes of
+the queries it runs, with their plans (see piccolo_db.QueryStats).
+For each table read with a full scan (or with an automatic index that
+sqlite builds for every statement), the equality and range constraints
+on the table are extracted from the query text, and an index covering
+them (and, for narrow tables, every column the query reads) is
+proposed. Proposals sharing their leading columns are merged, and
+proposals already served by an existing index are dropped.
+
+The indexes are then created, ANALYZE is run, and the latency of every
+route before and after is reported.
+
+Usage: index-advisor.py [-n] [-r REPEAT] DATABASE
+  -n: only print the create index statements
+"""
+from __future__ import print_function
+
+import getopt
+import os
+import re
+import sqlite3
+import sys
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BIN_DIR)
+
+import piccolo
+from piccolo_bench import NO_PAGE_CACHE, sample_routes, measure_routes
+
+
+# Covering indexes are only proposed when they stay that narrow
+MAX_COVERING_COLUMNS = 5
+
+# A lookup is also considered served by an index whose leading columns
+# (all part of the lookup) leave at most that many rows per value
+SELECTIVE_ROWS = 16
+
+SQL_KEYWORDS = ["on", "where", "join", "left", "inner", "cross", "group", "order",
+                "limit", "union", "select", "natural", "using"]
+
+SCAN_RE = re.compile(r"^SCAN (\w+)$")
+AUTOMATIC_RE = re.compile(r"^SEARCH (\w+) USING AUTOMATIC (?:COVERING |PARTIAL )*INDEX")
+TABLE_RE = re.compile(r"\b(?:from|join)\s+(\w+)(?:\s+(?:as\s+)?(?!(?:%s)\b)(\w+))?" % "|".join(SQL_KEYWORDS),
+                      re.IGNORECASE)
+UNION_RE = re.compile(r"\bunion(?:\s+all)?\b", re.IGNORECASE)
+EQ_OPS = r"(?:==|(?<![<>!])=|\bin\b)"
+RANGE_OPS = r"(?:>=|<=|(?<!<)>|<(?![>=]))"
+JOIN_OPERAND_RE = re.compile(r"^[A-Za-z_]\w*\.\w+$")
+
+
+def table_columns(db, table):
+    return [row[1] for row in db.execute("pragma table_info(%s)" % table)]
+
+
+def existing_indexes(db, table):
+    indexes = []
+    for row in db.execute("pragma index_list(%s)" % table).fetchall():
+        indexes.append([r[2] for r in db.execute("pragma index_info(%s)" % row[1])])
+    return indexes
+
+
+def scanned_tables(plan):
+    """Returns the names (or aliases) of the tables the plan reads
+    without a usable index."""
+    names = set()
+    for step in plan:
+        m = SCAN_RE.match(step) or AUTOMATIC_RE.match(step)
+        if m:
+            names.add(m.group(1))
+    return names
+
+
+def table_aliases(part):
+    aliases = dict()
+    for table, alias in TABLE_RE.findall(part):
+        if alias:
+            aliases[alias] = table
+        aliases[table] = table
+    return aliases
+
+
+def column_refs(part, table, aliases, columns, other_columns):
+    """Yields the textual references to the columns of table in part
+    (alias.column, or column alone when no other table of the query
+    has a column with this name)."""
+    names = [a for (a, t) in aliases.items() if t == table]
+    for column in columns:
+        for name in names:
+            yield column, r"\b%s\.%s\b" % (re.escape(name), re.escape(column))
+        if column not in other_columns:
+            yield column, r"(?<![.\w:@$'])%s\b" % re.escape(column)
+
+
+def requirement(part, table, aliases, columns, other_columns):
+    """Returns (parameter columns, join columns, range column, read
+    columns) for the references to table in this part of a query:
+    parameter columns are compared for equality with a value, and join
+    columns with a column of another table."""
+    params, joins, ranges, read = [], [], [], []
+    for column, ref in column_refs(part, table, aliases, columns, other_columns):
+        if not re.search(ref, part):
+            continue
+        if column not in read:
+            read.append(column)
+        operands = (re.findall(r"%s\s*%s\s*([\w.:?@$']+)" % (ref, EQ_OPS), part) +
+                    re.findall(r"([\w.:?@$']+)\s*%s\s*%s" % (EQ_OPS.replace(r"|\bin\b", ""), ref), part))
+        for o in operands:
+            if JOIN_OPERAND_RE.match(o) and o.split(".")[0] not in aliases_of(table, aliases):
+                joins.append(column)
+            else:
+                params.append(column)
+        if not operands and (re.search(r"%s\s*%s" % (ref, RANGE_OPS), part) or
+                             re.search(r"%s\s*%s" % (RANGE_OPS, ref), part)):
+            ranges.append(column)
+    return unique(params), unique(joins), ranges[:1], read
+
+
+def unique(columns):
+    result = []
+    for c in columns:
+        if c not in result:
+            result.append(c)
+    return result
+
+
+def aliases_of(table, aliases):
+    return [a for (a, t) in aliases.items() if t == table]
+
+
+def serves(index, key, ranges):
+    # An index serves a lookup when its leading columns are the key
+    # columns (in any order) followed by the range column
+    n = len(key)
+    return (len(index) >= n + len(ranges) and set(index[:n]) == set(key) and
+            index[n:n + len(ranges)] == ranges)
+
+
+def narrowing_prefix(db, table, index, key, cache):
+    """Tells whether the leading columns of index found in key leave
+    at most SELECTIVE_ROWS rows per value, on average."""
+    prefix = []
+    for c in index:
+        if c not in key:
+            break
+        prefix.append(c)
+    if not prefix:
+        return False
+    prefix = tuple(prefix)
+    if (table, prefix) not in cache:
+        cache[table, prefix] = db.execute("select avg(n) from (select count(*) as n from %s group by %s)" %
+                                          (table, ", ".join(prefix))).fetchone()[0]
+    rows = cache[table, prefix]
+    return rows is not None and rows <= SELECTIVE_ROWS
+
+
+def advise(db, shapes):
+    """Returns the list of (table, columns) of the indexes to create
+    for the given query shapes (as returned by QueryStats.snapshot)."""
+    schema_tables = set(row[0] for row in db.execute("select name from sqlite_master where type = 'table'"))
+    columns = dict((t, table_columns(db, t)) for t in schema_tables)
+
+    selectivity = dict()
+    requirements = dict()
+    for shape in shapes:
+        scanned = scanned_tables(shape["plan"] or [])
+        if not scanned:
+            continue
+        # Each part of a compound query is analysed separately
+        for part in UNION_RE.split(shape["query"]):
+            aliases = table_aliases(part)
+            tables = set(t for t in aliases.values() if t in schema_tables)
+            found = dict()
+            for table in tables:
+                other_columns = set(c for t in tables if t != table for c in columns[t])
+                found[table] = requirement(part, table, aliases, columns[table], other_columns)
+            for name in scanned:
+                table = aliases.get(name)
+                if table not in tables:
+                    continue
+                params, joins, ranges, read = found[table]
+                # A table is looked up by its own parameters when it
+                # is the only one having some (it is then read first);
+                # otherwise, it is read from the join loop, where both
+                # join and parameter columns are known
+                if params and not any(found[t][0] for t in tables if t != table):
+                    key = params
+                else:
+                    key = unique(joins + params)
+                if key or ranges:
+                    requirements.setdefault(table, []).append((key, ranges, read))
+
+    proposals = []
+    for table, reqs in sorted(requirements.items()):
+        # Columns used by most lookups come first
+        frequency = dict()
+        for key, _, _ in reqs:
+            for c in key:
+                frequency[c] = frequency.get(c, 0) + 1
+        order = lambda cs: sorted(cs, key=lambda c: (-frequency[c], columns[table].index(c)))
+        narrows = lambda index, key: narrowing_prefix(db, table, index, key, selectivity)
+        existing = existing_indexes(db, table)
+        # Proposals are built from the smallest keys: an index whose
+        # columns are a subset of a key is extended to serve it too
+        indexes = []
+        for key, ranges, read in sorted(reqs, key=lambda r: len(r[0]) + len(r[1])):
+            if any(serves(index, key, ranges) for index in existing):
+                continue
+            candidates = ([i for i in indexes if serves(i["key"], key, ranges)] +
+                          [i for i in indexes if not i["closed"] and set(i["key"]) <= set(key)] +
+                          [i for i in indexes if narrows(i["key"], key)])
+            if not candidates and any(narrows(index, key) for index in existing):
+                continue
+            if candidates:
+                index = candidates[0]
+                if not serves(index["key"], key, ranges) and set(index["key"]) <= set(key):
+                    index["key"] += order(set(key) - set(index["key"])) + ranges
+                    index["closed"] = bool(ranges)
+            else:
+                index = {"key": order(key) + ranges, "closed": bool(ranges), "read": []}
+                indexes.append(index)
+            index["read"].extend(read)
+        for index in indexes:
+            cover = []
+            for c in index["read"]:
+                if c not in index["key"] and c not in cover:
+                    cover.append(c)
+            if len(index["key"]) + len(cover) > MAX_COVERING_COLUMNS:
+                cover = []
+            proposals.append((table, index["key"] + cover))
+    return proposals
+
+
+def index_statement(table, columns):
+    return "create index %s_%s_idx on %s (%s);" % (table, "_".join(columns[:3]), table, ", ".join(columns))
+
+
+def measure(path, repeat):
+    app = piccolo.create_app(path, DATABASE_IMMUTABLE=False, LAYOUT_PROCESSES=0,
+                             GRAPH_CACHE_ENTRIES=0, **NO_PAGE_CACHE)
+    piccolo.answer_types_cache.clear()
+    with app.app_context():
+        routes = sample_routes(piccolo.get_db())
+    return measure_routes(app, routes, repeat), piccolo.get_query_stats().snapshot()
+
+
+def main():
+    dry_run, repeat = False, 5
+    opts, args = getopt.getopt(sys.argv[1:], "nr:")
+    for o, v in opts:
+        if o == "-n":
+            dry_run = True
+        elif o == "-r":
+            repeat = int(v)
+    if len(args) != 1:
+        print(__doc__.strip().splitlines()[-2], file=sys.stderr)
+        sys.exit(1)
+    path = args[0]
+
+    before, shapes = measure(path, repeat)
+    db = sqlite3.connect(path)
+    statements = [index_statement(t, c) for (t, c) in advise(db, shapes)]
+    for statement in statements:
+        print(statement)
+    if not statements:
+        print("-- No index to create")
+    if dry_run:
+        return
+    for statement in statements:
+        db.execute(statement)
+    db.execute("analyze")
+    db.commit()
+    db.close()
+
+    after, _ = measure(path, repeat)
+    print()
+    print("%-44s %6s %12s %12s %8s" % ("route", "status", "before (ms)", "after (ms)", "speedup"))
+    for label, (status, median, _) in before.items():
+        new_status, new_median, _ = after[label]
+        print("%-44s %6s %12.2f %12.2f %7.1fx" % (label, new_status, median, new_median,
+                                                 median / max(new_median, 0.001)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,478 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Create db.sql from the CSV files of a data-dir, replacing the
+`sqlite3 db.sql < db.txt` step of maestro.sh.
+
+The schema script (db.txt by default) is interpreted as the sqlite3
+shell would: SQL statements are run in order, and each sequence of
+.import commands is run by the loader. The CSV files, written by
+fileOps.ml (quoted fields separated by colons, with "" and backslash
+escapes), are split in chunks parsed by a pool of worker processes,
+while the main process inserts the rows with executemany, one
+transaction per table. Since the indexes are created by the
+statements following the imports, they are built once the tables are
+filled.
+
+With db-compact.txt as schema, the hexadecimal strings of the blob
+columns are converted while loading.
+
+With -a, the data-dir (e.g. a new campaign) is added to an existing
+database, which can be served by piccolo meanwhile (unless
+DATABASE_IMMUTABLE is set): the CSV files are first loaded in
+temporary tables, then, in a single transaction, the rows whose
+natural key (see NATURAL_KEYS) is absent from the database are
+inserted, the indexes being updated along, and the campaign summaries
+are recomputed for the campaigns found in answers.csv. The database
+is switched to WAL mode, so that readers keep seeing the previous
+state until the transaction commits. The schema script defaults to
+db-compact.txt for databases using the compact schema.
+
+Every load increments the generation counter stored in concerto_meta.
+
+Usage: load-db.py [-a] [-j JOBS] [-b CHUNK_BYTES] [-s SCHEMA] [-o DATABASE] DATA_DIR
+"""
+from __future__ import print_function
+
+import binascii
+import getopt
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+import time
+from collections import deque
+
+from piccolo_db import schema_kind
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CHUNK_BYTES = 8 * 1024 * 1024
+
+LOAD_PRAGMAS = ["pragma journal_mode = off",
+                "pragma synchronous = off",
+                "pragma locking_mode = exclusive",
+                "pragma cache_size = -262144"]
+
+APPEND_PRAGMAS = ["pragma journal_mode = wal",
+                  "pragma synchronous = normal",
+                  "pragma cache_size = -262144"]
+
+# Rows examined per index by ANALYZE during an incremental load, to
+# keep its cost independent of the size of the database
+APPEND_ANALYSIS_LIMIT = 1000
+
+# Natural keys of the imported tables: an incremental load only
+# inserts the rows whose key is absent from the database
+NATURAL_KEYS = {
+    "answers": ["campaign", "ip", "port", "name"],
+    "chains": ["hash", "position"],
+    "certs": ["hash"],
+    "dns": ["hash"],
+    "names": ["cert_hash", "type", "name"],
+    "links": ["subject_hash", "issuer_hash"],
+    "built_chains": ["chain_hash", "built_chain_number"],
+    "built_links": ["chain_hash", "built_chain_number", "position_in_chain"],
+    "unused_certs": ["chain_hash", "built_chain_number", "position_in_msg"],
+    "trusted_certs": ["cert_hash", "trust_flag"],
+    "trusted_chains": ["chain_hash", "trust_flag"],
+    "trusted_built_chains": ["chain_hash", "built_chain_number", "trust_flag"],
+    "rated_chains": ["chain_hash", "built_chain_number", "trust_flag"],
+    "roots": ["cert_hash", "trust_flag"],
+}
+
+CREATE_RE = re.compile(r"^create\s+(table|index|view|trigger|virtual\s+table)\s+(?!if\s)",
+                       re.IGNORECASE)
+DERIVED_RE = re.compile(r"^(?:create\s+table\s+(\w+)\s+as|insert\s+into\s+(\w+))\s+(select\b.*)$",
+                        re.IGNORECASE | re.DOTALL)
+INSERT_VALUES_RE = re.compile(r"^insert\s+into\s+(?=\w+\s+values\b)", re.IGNORECASE)
+
+
+def read_script(path):
+    """Returns the steps of a sqlite3 shell script: ("sql", statement)
+    or ("import", csv_file, table). The other dot commands (.mode and
+    .separator) only describe the fileOps CSV dialect and are ignored."""
+    steps, statement = [], []
+    with open(path) as f:
+        for line in f:
+            stripped = line.strip()
+            if stripped.startswith("--") or (not statement and not stripped):
+                continue
+            if not statement and stripped.startswith("."):
+                args = stripped.split()
+                if args[0] == ".import":
+                    steps.append(("import", args[1], args[2]))
+                continue
+            statement.append(line)
+            if stripped.endswith(";"):
+                steps.append(("sql", "".join(statement).strip()))
+                statement = []
+    return steps
+
+
+# fileOps CSV dialect (see quote_csv_field in fileOps.ml)
+
+FIELD_RE = re.compile(br'"((?:[^"\\]|""|\\[nt\\]|\\x[0-9a-fA-F]{2})*)"(:?)')
+ESCAPE_RE = re.compile(br'""|\\[nt\\]|\\x[0-9a-fA-F]{2}')
+ESCAPES = {b'""': b'"', b"\\n": b"\n", b"\\t": b"\t", b"\\\\": b"\\"}
+HEX_RE = re.compile(br"^(?:[0-9a-fA-F]{2})+$")
+HEX_STR_RE = re.compile("^(?:[0-9a-fA-F]{2})+$")
+
+# Under Python 2, ASCII byte strings are stored as text by sqlite3
+ASCII_IS_STR = str is bytes
+
+
+def unescape(match):
+    s = match.group(0)
+    if s in ESCAPES:
+        return ESCAPES[s]
+    return binascii.unhexlify(s[2:])
+
+
+def simple_fields(line):
+    """Returns the fields of line as strings when it holds no escape
+    (hence no quote inside the fields, and only ASCII characters),
+    None otherwise."""
+    if b"\\" in line or line[-1:] != b'"':
+        return None
+    if not ASCII_IS_STR:
+        line = line.decode("ascii")
+    fields = line[1:-1].split('":"')
+    if line.count('"') != 2 * len(fields):
+        return None
+    return fields
+
+
+def unquote_csv_line(line):
+    """Returns the list of the (still escaped) fields of line."""
+    fields, pos = [], 0
+    while True:
+        m = FIELD_RE.match(line, pos)
+        if m is None:
+            raise ValueError("invalid CSV line: %r" % line)
+        fields.append(m.group(1))
+        pos = m.end()
+        if not m.group(2):
+            if pos != len(line):
+                raise ValueError("invalid CSV line: %r" % line)
+            return fields
+        if pos == len(line):
+            raise ValueError("unexpected colon at the end of line: %r" % line)
+
+
+def field_value(field, blob):
+    if b"\\" in field or b'"' in field:
+        value = ESCAPE_RE.sub(unescape, field)
+    else:
+        value = field
+    if blob and HEX_RE.match(value):
+        return bytearray(binascii.unhexlify(value))
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        # Stored escaped, as the sqlite3 shell did
+        return field.replace(b'""', b'"').decode("ascii")
+
+
+def parse_chunk(task):
+    # Runs in a worker process
+    path, start, end, n_columns, blob_columns = task
+    rows, malformed = [], 0
+    with open(path, "rb") as f:
+        if start > 0:
+            # The line overlapping start belongs to the previous chunk
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            line = line.rstrip(b"\r\n")
+            if not line:
+                continue
+            fields = simple_fields(line)
+            if fields is not None:
+                for i in blob_columns:
+                    if i < len(fields) and HEX_STR_RE.match(fields[i]):
+                        fields[i] = bytearray(binascii.unhexlify(fields[i]))
+            else:
+                fields = [field_value(field, i in blob_columns)
+                          for (i, field) in enumerate(unquote_csv_line(line))]
+            if len(fields) != n_columns:
+                # As the sqlite3 shell, missing fields are NULL and
+                # extra ones are ignored
+                malformed += 1
+                fields = (fields + [None] * n_columns)[:n_columns]
+            rows.append(tuple(fields))
+    return rows, malformed
+
+
+def table_layout(db, table):
+    columns = db.execute("pragma main.table_info(%s)" % table).fetchall()
+    blob_columns = frozenset(i for (i, c) in enumerate(columns) if c[2].lower() == "blob")
+    return len(columns), blob_columns
+
+
+def import_tables(db, pool, data_dir, imports, chunk_bytes, window, target="%s"):
+    """Loads the (csv_file, table) of imports, parsing chunks in the
+    pool while inserting the parsed ones, in order. The rows are
+    inserted in the table named target % table."""
+    tasks = deque()
+    tables = []
+    for csv_file, table in imports:
+        path = os.path.join(data_dir, csv_file)
+        n_columns, blob_columns = table_layout(db, table)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        chunks = [(path, start, min(start + chunk_bytes, size), n_columns, blob_columns)
+                  for start in range(0, size, chunk_bytes)]
+        tables.append({"table": table, "n_chunks": len(chunks), "size": size, "rows": 0,
+                       "malformed": 0, "ignored": 0, "start": None,
+                       # As the sqlite3 shell, rows violating a constraint
+                       # (duplicated primary keys) are skipped
+                       "query": "insert or ignore into %s values (%s)" %
+                       (target % table, ", ".join(["?"] * n_columns)), "blob_columns": blob_columns})
+        tasks.extend((len(tables) - 1, chunk) for chunk in chunks)
+
+    pending = deque()
+    done_chunks = [0] * len(tables)
+    last_progress = time.time()
+    for i, t in enumerate(tables):
+        if t["n_chunks"] == 0:
+            report(t, 0.0)
+    while tasks or pending:
+        while tasks and len(pending) < window:
+            i, chunk = tasks.popleft()
+            pending.append((i, chunk, pool.apply_async(parse_chunk, (chunk,))))
+        i, chunk, result = pending.popleft()
+        rows, malformed = result.get()
+        t = tables[i]
+        if t["start"] is None:
+            t["start"] = time.time()
+        if t["blob_columns"]:
+            # Blobs are sent by the workers as bytearrays
+            rows = [tuple(sqlite3.Binary(bytes(v)) if isinstance(v, bytearray) else v for v in row)
+                    for row in rows]
+        cur = db.executemany(t["query"], rows)
+        t["rows"] += cur.rowcount
+        t["ignored"] += len(rows) - cur.rowcount
+        t["malformed"] += malformed
+        done_chunks[i] += 1
+        if done_chunks[i] == t["n_chunks"]:
+            db.commit()
+            report(t, time.time() - t["start"])
+        elif time.time() - last_progress > 10:
+            last_progress = time.time()
+            print("  %s: %d%% (%d rows)" % (t["table"], 100 * chunk[2] // t["size"], t["rows"]))
+            sys.stdout.flush()
+
+
+def report(t, duration):
+    print("%-24s %12d rows %8.1f s %10.0f rows/s" %
+          (t["table"], t["rows"], duration, t["rows"] / max(duration, 0.001)))
+    if t["malformed"]:
+        print("  %s: %d lines without the expected number of fields" % (t["table"], t["malformed"]))
+    if t["ignored"]:
+        print("  %s: %d rows violating a constraint ignored" % (t["table"], t["ignored"]))
+    sys.stdout.flush()
+
+
+def run_statement(db, statement, commit=True):
+    start = time.time()
+    db.execute(statement)
+    if commit:
+        db.commit()
+    summary = " ".join(statement.split()[:4])
+    print("%-60s %8.1f s" % (summary[:60], time.time() - start))
+    sys.stdout.flush()
+
+
+def bump_generation(db):
+    db.execute("insert or replace into concerto_meta values ('generation', "
+               "coalesce((select cast(value as integer) from concerto_meta "
+               "where key = 'generation'), 0) + 1)")
+
+
+# Incremental loads
+
+STAGED = "temp.staged_%s"
+
+
+def main_tables(db):
+    return set(row[0] for row in db.execute("select name from main.sqlite_master where type = 'table'"))
+
+
+def main_columns(db, table):
+    return [row[1] for row in db.execute("pragma main.table_info(%s)" % table)]
+
+
+def stage_tables(db, pool, data_dir, imports, chunk_bytes, window):
+    """Loads the CSV files of imports in temporary tables, without
+    writing to the database."""
+    for _, table in imports:
+        db.execute("create table %s as select * from main.%s where 0" % (STAGED % table, table))
+    import_tables(db, pool, data_dir, imports, chunk_bytes, window, STAGED)
+    if any(table == "answers" for (_, table) in imports):
+        db.execute("create temp table ingested_campaigns as select distinct campaign from %s" %
+                   (STAGED % "answers"))
+    db.commit()
+
+
+def merge_table(db, table):
+    """Inserts the staged rows of table whose natural key is absent
+    from the database (and from the previous staged rows)."""
+    start = time.time()
+    columns = main_columns(db, table)
+    key = NATURAL_KEYS.get(table, columns)
+    staged = STAGED % table
+    cur = db.execute("insert or ignore into main.%s (%s) select %s from %s s "
+                     "left join main.%s t on %s "
+                     "where t.%s is null and s.rowid in (select min(rowid) from %s group by %s)" %
+                     (table, ", ".join(columns), ", ".join("s.%s" % c for c in columns), staged,
+                      table, " and ".join("t.%s = s.%s" % (c, c) for c in key),
+                      key[0], staged, ", ".join(key)))
+    print("%-24s %12d new rows %8.1f s" % (table, cur.rowcount, time.time() - start))
+    sys.stdout.flush()
+
+
+def refresh_derived(db, table, select):
+    """Recomputes the rows of a table derived from the others (e.g.
+    campaign_answer_types). When it has a campaign column, only the
+    ingested campaigns are recomputed: the select is then run with
+    answers shadowed by a temporary view restricted to them."""
+    if table not in main_tables(db):
+        db.execute("create table %s as %s" % (table, select))
+    elif "campaign" in main_columns(db, table):
+        db.execute("create temp table if not exists ingested_campaigns (campaign)")
+        db.execute("delete from main.%s where campaign in (select campaign from ingested_campaigns)" % table)
+        db.execute("create temp view answers as select * from main.answers "
+                   "where campaign in (select campaign from ingested_campaigns)")
+        try:
+            db.execute("insert into main.%s %s" % (table, select))
+        finally:
+            db.execute("drop view temp.answers")
+    else:
+        db.execute("delete from main.%s" % table)
+        db.execute("insert into main.%s %s" % (table, select))
+
+
+def append_statement(db, statement):
+    """Runs a statement of the schema script against an existing
+    database: objects are only created when missing, derived tables
+    are refreshed, and single rows are only inserted when absent."""
+    m = DERIVED_RE.match(statement)
+    if m:
+        start = time.time()
+        table = m.group(1) or m.group(2)
+        refresh_derived(db, table, m.group(3))
+        print("%-60s %8.1f s" % ("refresh " + table, time.time() - start))
+        return
+    if statement.lower().rstrip(";").strip() == "analyze":
+        db.execute("pragma analysis_limit = %d" % APPEND_ANALYSIS_LIMIT)
+    statement = CREATE_RE.sub(lambda m: "create %s if not exists " % m.group(1), statement)
+    statement = INSERT_VALUES_RE.sub("insert or ignore into ", statement)
+    run_statement(db, statement, commit=False)
+
+
+def is_table_creation(step):
+    return (step[0] == "sql" and step[1].lower().startswith("create table ") and
+            not DERIVED_RE.match(step[1]))
+
+
+def append(db, pool, steps, data_dir, chunk_bytes, window):
+    # The missing tables are created first, then the CSV files are
+    # loaded in temporary tables, and everything else is done in a
+    # single write transaction
+    for step in steps:
+        if is_table_creation(step):
+            append_statement(db, step[1])
+    db.commit()
+    imports = [step[1:] for step in steps if step[0] == "import"]
+    stage_tables(db, pool, data_dir, imports, chunk_bytes, window)
+
+    db.isolation_level = None
+    db.execute("begin immediate")
+    try:
+        for step in steps:
+            if step[0] == "import":
+                merge_table(db, step[2])
+            elif not is_table_creation(step):
+                append_statement(db, step[1])
+        bump_generation(db)
+        db.execute("commit")
+    except BaseException:
+        db.execute("rollback")
+        raise
+
+
+def load(db, pool, steps, data_dir, chunk_bytes, window):
+    imports = []
+    for step in steps + [("end",)]:
+        if step[0] == "import":
+            imports.append(step[1:])
+            continue
+        if imports:
+            import_tables(db, pool, data_dir, imports, chunk_bytes, window)
+            imports = []
+        if step[0] == "sql":
+            run_statement(db, step[1])
+    bump_generation(db)
+    db.commit()
+
+
+def usage():
+    print("Usage: load-db.py [-a] [-j JOBS] [-b CHUNK_BYTES] [-s SCHEMA] [-o DATABASE] DATA_DIR",
+          file=sys.stderr)
+    sys.exit(1)
+
+
+def main():
+    jobs, chunk_bytes = multiprocessing.cpu_count(), CHUNK_BYTES
+    schema, database, incremental = None, None, False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "aj:b:s:o:")
+    except getopt.GetoptError:
+        usage()
+    for o, v in opts:
+        if o == "-a":
+            incremental = True
+        elif o == "-j":
+            jobs = int(v)
+        elif o == "-b":
+            chunk_bytes = int(v)
+        elif o == "-s":
+            schema = v
+        elif o == "-o":
+            database = v
+    if len(args) != 1:
+        usage()
+    data_dir = args[0]
+    if database is None:
+        database = os.path.join(data_dir, "db.sql")
+    if os.path.exists(database) != incremental:
+        print("%s %s" % (database, "does not exist" if incremental else "already exists"),
+              file=sys.stderr)
+        sys.exit(1)
+
+    db = sqlite3.connect(database)
+    if schema is None:
+        compact = incremental and schema_kind(db) == "compact"
+        schema = os.path.join(BIN_DIR, "db-compact.txt" if compact else "db.txt")
+    for pragma in APPEND_PRAGMAS if incremental else LOAD_PRAGMAS:
+        db.execute(pragma)
+    pool = multiprocessing.Pool(jobs)
+    start = time.time()
+    try:
+        if incremental:
+            append(db, pool, read_script(schema), data_dir, chunk_bytes, 2 * jobs)
+        else:
+            load(db, pool, read_script(schema), data_dir, chunk_bytes, 2 * jobs)
+    finally:
+        pool.terminate()
+        pool.join()
+    db.close()
+    print("%s %s in %.1f s" % (database, "updated" if incremental else "created", time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
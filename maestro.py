@@ -0,0 +1,753 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Run the concerto pipeline on answer dumps, as maestro.sh does, from
+the stages declared in make_stages with the files each of them reads
+and writes and the stages it follows.
+
+A stage starts as soon as the stages it follows are done, and up to
+JOBS processes (one per CPU by default) run at once. parseCerts runs
+over JOBS shards of the 256 hash prefixes, and checkLinks over the
+possible_links_<n>.csv files written by prepareLinks -M JOBS. Since
+fileOps locks the packs and the CSV files a program opens until it
+exits, each shard runs in its own data-dir under tmp/shards, holding
+links to the packs of its prefixes (parseCerts) or a copy of the
+certificates its possible links need (checkLinks). Once every shard
+succeeded, their CSV files are appended to those of the data-dir, in
+order, duplicate DNs being dropped as a single parseCerts would.
+
+A stage is skipped when its options, its input files (their size and
+modification time) and the stages it follows did not change since it
+last succeeded, and its outputs still exist (-f runs every stage).
+Otherwise, as the programs append to their CSV files, its outputs are
+removed before it runs. The possible links, removed once checked, are
+only computed again when checkLinks has to run.
+
+Every stage is recorded in operations.csv, with its command, start and
+end times, wall and CPU time, peak memory and the number of rows of
+the CSV files it wrote. At the end of each run, the operations of the
+data-dir are copied to the operations table of the database, which
+piccolo shows on /operations.
+
+Usage: maestro.py -d DATA_DIR [-D TRUSTED_CA_DIR|-C TRUSTED_CA]... [-T MAX_TRANSVALID]
+                  [-t TRUST_FLAG] [-j JOBS] [-n] [-A] [-L] [-S] [-I DATABASE] [-f] [-v]
+                  ANSWER_DUMPS
+  -n: do not create the database
+  -A: create the indexes needed by piccolo (index-advisor.py)
+  -L: compute the transitive links (transitive-links.py)
+  -S: load the database with the sqlite3 shell instead of load-db.py
+  -I: add the data-dir to DATABASE (load-db.py -a) instead of creating db.sql
+  -f: run every stage, even those whose inputs did not change
+"""
+from __future__ import print_function
+
+import getopt
+import hashlib
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import sqlite3
+import sys
+import time
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BIN_DIR)
+
+from piccolo_pack import PackStore, pack_record
+
+PREFIXES = ["%2.2x" % i for i in range(256)]
+
+OPERATIONS_FILE = "operations.csv"
+OPERATIONS_COLUMNS = ["run", "stage", "status", "command", "shards", "started", "finished",
+                      "wall_time", "cpu_time", "max_rss", "rows", "fingerprint"]
+
+
+# fileOps CSV dialect (see quote_csv_field in fileOps.ml), for
+# operations.csv and the files merged from the shards
+
+FIELD_RE = re.compile(r'"((?:[^"\\]|""|\\[nt\\]|\\x[0-9a-fA-F]{2})*)"(:?)')
+ESCAPE_RE = re.compile(r'""|\\[nt\\]|\\x[0-9a-fA-F]{2}')
+ESCAPES = {'""': '"', "\\n": "\n", "\\t": "\t", "\\\\": "\\"}
+SPECIAL_CHARS_RE = re.compile(r'[^ -!#-\[\]-~]')
+
+
+def quote_field(value):
+    s = str(value)
+    if SPECIAL_CHARS_RE.search(s):
+        s = "".join({"\n": "\\n", "\t": "\\t", "\\": "\\\\", '"': '""'}.get(c, c)
+                    if 32 <= ord(c) < 128 or c in "\n\t" else "\\x%02x" % ord(c)
+                    for c in s)
+    return '"' + s + '"'
+
+
+def csv_line(fields):
+    return ":".join(quote_field(f) for f in fields) + "\n"
+
+
+def unquote_csv_line(line):
+    fields, pos = [], 0
+    while True:
+        m = FIELD_RE.match(line, pos)
+        if m is None:
+            raise ValueError("invalid CSV line: %r" % line)
+        fields.append(ESCAPE_RE.sub(lambda e: ESCAPES.get(e.group(0)) or chr(int(e.group(0)[2:], 16)),
+                                    m.group(1)))
+        pos = m.end()
+        if not m.group(2):
+            return fields
+
+
+def first_field(line):
+    # The key of the lines of dns.csv (a hash, hence without escape)
+    return line[:line.find(b'":"') + 1]
+
+
+def count_lines(path):
+    n = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            n += block.count(b"\n")
+    return n
+
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+class Task(object):
+    """A process run by a stage."""
+
+    def __init__(self, argv, log, cwd=None, stdin=None):
+        self.argv, self.log, self.cwd, self.stdin = argv, log, cwd, stdin
+
+    def start(self):
+        stdin = open(self.stdin, "rb") if self.stdin is not None else None
+        log = open(self.log, "ab")
+        try:
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    if stdin is not None:
+                        os.dup2(stdin.fileno(), 0)
+                    os.dup2(log.fileno(), 1)
+                    os.dup2(log.fileno(), 2)
+                    if self.cwd is not None:
+                        os.chdir(self.cwd)
+                    os.execvp(self.argv[0], self.argv)
+                finally:
+                    os._exit(127)
+            return pid
+        finally:
+            log.close()
+            if stdin is not None:
+                stdin.close()
+
+
+class Stage(object):
+    """A step of the pipeline: the command it runs, the files (relative
+    to the data-dir) it reads and writes, and the stages it follows.
+    Directories in inputs stand for the files they hold; outputs which
+    are directories (packs) are never removed."""
+
+    shards = 1
+    temporary_outputs = ()
+
+    def __init__(self, name, title, argv, inputs=(), outputs=(), after=(), cwd=None, stdin=None):
+        self.name, self.title, self.argv = name, title, argv
+        self.inputs, self.outputs, self.after = list(inputs), list(outputs), list(after)
+        self.cwd, self.stdin = cwd, stdin
+
+    def command(self):
+        return " ".join(self.argv)
+
+    def tasks(self, ctx):
+        return [Task(self.argv, ctx.log_path(self.name), self.cwd, self.stdin)]
+
+    def prepare(self, ctx):
+        for output in self.outputs:
+            path = ctx.path(output)
+            if not os.path.isdir(path):
+                remove(path)
+
+    def finish(self, ctx):
+        pass
+
+
+class ShardedStage(Stage):
+    """A stage whose tasks run in the data-dirs tmp/shards/<name>-<n>,
+    the listed CSV files of which are then appended to the data-dir."""
+
+    merged_files = ()
+    unique_files = ()
+
+    def __init__(self, name, title, argv, shards, **kwargs):
+        Stage.__init__(self, name, title, argv, **kwargs)
+        self.shards = shards
+
+    def shard_dir(self, ctx, n):
+        return ctx.path(os.path.join("tmp", "shards", "%s-%d" % (self.name, n)))
+
+    def prepare(self, ctx):
+        Stage.prepare(self, ctx)
+        for n in range(self.shards):
+            remove(self.shard_dir(ctx, n))
+            os.makedirs(os.path.join(self.shard_dir(ctx, n), "raw", "certs"))
+
+    def shard_files(self, n, csv_name):
+        return [csv_name]
+
+    def finish(self, ctx):
+        for csv_name in self.merged_files:
+            seen = set() if csv_name in self.unique_files else None
+            with open(ctx.path(csv_name + ".csv"), "ab") as out:
+                for n in range(self.shards):
+                    for name in self.shard_files(n, csv_name):
+                        path = os.path.join(self.shard_dir(ctx, n), name + ".csv")
+                        if not os.path.exists(path):
+                            continue
+                        with open(path, "rb") as f:
+                            if seen is None:
+                                shutil.copyfileobj(f, out)
+                                continue
+                            for line in f:
+                                key = first_field(line)
+                                if key not in seen:
+                                    seen.add(key)
+                                    out.write(line)
+        for n in range(self.shards):
+            remove(self.shard_dir(ctx, n))
+        try:
+            os.rmdir(os.path.dirname(self.shard_dir(ctx, 0)))
+        except OSError:
+            pass
+
+
+class ParseCertsStage(ShardedStage):
+    merged_files = ["certs", "dns", "names", "unparsed_certs", "crldps"]
+    unique_files = ["dns"]
+
+    def prefixes(self, n):
+        return PREFIXES[n * len(PREFIXES) // self.shards:(n + 1) * len(PREFIXES) // self.shards]
+
+    def command(self):
+        return " ".join(self.argv + ["00..ff"])
+
+    def tasks(self, ctx):
+        return [Task(self.argv + ["-d", self.shard_dir(ctx, n)] + self.prefixes(n),
+                     ctx.log_path(self.name, n))
+                for n in range(self.shards)]
+
+    def prepare(self, ctx):
+        ShardedStage.prepare(self, ctx)
+        packs = ctx.path(os.path.join("raw", "certs"))
+        for n in range(self.shards):
+            shard_dir = self.shard_dir(ctx, n)
+            for prefix in self.prefixes(n):
+                pack = os.path.join(packs, prefix + ".pack")
+                if os.path.exists(pack):
+                    os.symlink(pack, os.path.join(shard_dir, "raw", "certs", prefix + ".pack"))
+            if os.path.exists(ctx.path("v1cas.csv")):
+                os.symlink(ctx.path("v1cas.csv"), os.path.join(shard_dir, "v1cas.csv"))
+
+
+class CheckLinksStage(ShardedStage):
+    merged_files = ["links"]
+
+    def __init__(self, name, title, argv, shards, **kwargs):
+        ShardedStage.__init__(self, name, title, argv, shards, **kwargs)
+        self.inputs.append(os.path.join("raw", "certs"))
+
+    def suffix(self, n):
+        return "" if self.shards < 2 else "_%d" % n
+
+    def shard_files(self, n, csv_name):
+        return [csv_name + self.suffix(n)]
+
+    def command(self):
+        if self.shards < 2:
+            return " ".join(self.argv)
+        return " ".join(self.argv + ["--suffix", "_0.._%d" % (self.shards - 1)])
+
+    def tasks(self, ctx):
+        return [Task(self.argv + ["-d", self.shard_dir(ctx, n), "--suffix", self.suffix(n)],
+                     ctx.log_path(self.name, n))
+                for n in range(self.shards)]
+
+    def prepare(self, ctx):
+        ShardedStage.prepare(self, ctx)
+        store = PackStore(ctx.data_dir, "certs", save_index=False)
+        for n in range(self.shards):
+            shard_dir = self.shard_dir(ctx, n)
+            possible_links = "possible_links%s.csv" % self.suffix(n)
+            # prepareLinks deals the links out round-robin, and does not
+            # create the files of the shards it has no link for
+            if not os.path.exists(ctx.path(possible_links)):
+                open(ctx.path(possible_links), "a").close()
+            os.symlink(ctx.path(possible_links), os.path.join(shard_dir, possible_links))
+            # The certificates of the possible links, in the packs of
+            # the shard
+            hashes = set()
+            with open(ctx.path(possible_links)) as f:
+                for line in f:
+                    if line.strip():
+                        hashes.update(unquote_csv_line(line.rstrip("\r\n")))
+            packs = dict()
+            try:
+                for h in sorted(hashes):
+                    contents = store.get(h)
+                    if contents is None:
+                        continue
+                    prefix = h[:2] if len(h) >= 2 else "_"
+                    if prefix not in packs:
+                        packs[prefix] = open(os.path.join(shard_dir, "raw", "certs", prefix + ".pack"), "wb")
+                    packs[prefix].write(pack_record(h, bytes(contents)))
+            finally:
+                for f in packs.values():
+                    f.close()
+
+    def finish(self, ctx):
+        ShardedStage.finish(self, ctx)
+        for n in range(self.shards):
+            remove(ctx.path("possible_links%s.csv" % self.suffix(n)))
+
+
+class LoadStage(Stage):
+    """The load of the database, which is only removed beforehand when
+    it is created from scratch."""
+
+    def __init__(self, name, title, argv, database, incremental, **kwargs):
+        Stage.__init__(self, name, title, argv, **kwargs)
+        self.database, self.incremental = database, incremental
+
+    def prepare(self, ctx):
+        if not self.incremental:
+            for suffix in ["", "-wal", "-shm", "-journal"]:
+                remove(self.database + suffix)
+
+
+def schema_imports(schema):
+    """Returns the CSV files imported by a schema script."""
+    with open(schema) as f:
+        return re.findall(r"^\.import\s+(\S+)\s+\S+", f.read(), re.MULTILINE)
+
+
+def make_stages(ctx):
+    """Returns the stages to run."""
+    d, bin_dir, python = ctx.data_dir, BIN_DIR, sys.executable
+    trust = bool(ctx.trusted_cas)
+    stages = [
+        Stage("answers", "Extracting answers",
+              [os.path.join(bin_dir, "injectAnswerDump"), "-d", d] + ctx.dumps,
+              inputs=ctx.dumps, outputs=["campaigns.csv", "answers.csv", "chains.csv", "raw/certs"]),
+    ]
+    parse_after = ["answers"]
+    if trust:
+        stages += [
+            # After answers, since both append to the packs
+            Stage("inject_cas", "Injecting certs",
+                  [os.path.join(bin_dir, "inject"), "-d", d, "-t", "certs"] + ctx.trusted_cas,
+                  inputs=ctx.trusted_cas, outputs=["raw/certs"], after=["answers"]),
+            Stage("v1cas", "Marking v1 trusted certs",
+                  [os.path.join(bin_dir, "listV1certs"), "-d", d] + ctx.trusted_cas,
+                  inputs=ctx.trusted_cas, outputs=["v1cas.csv"]),
+        ]
+        parse_after = ["answers", "inject_cas", "v1cas"]
+    possible_links = ["possible_links"] if ctx.jobs < 2 else \
+        ["possible_links_%d" % n for n in range(ctx.jobs)]
+    prepare_links = Stage("prepare_links", "Preparing possible links",
+                          [os.path.join(bin_dir, "prepareLinks"), "-d", d, "-M", str(ctx.jobs)],
+                          inputs=["certs.csv"], outputs=[p + ".csv" for p in possible_links],
+                          after=["parse"])
+    prepare_links.temporary_outputs = prepare_links.outputs
+    stages += [
+        # The index of the packs, used by piccolo and check_links
+        Stage("pack_index", "Indexing raw certificates",
+              [python, os.path.join(bin_dir, "piccolo_pack.py"), d, "certs"],
+              inputs=["raw/certs"], outputs=["raw/certs.index"], after=parse_after[:2]),
+        ParseCertsStage("parse", "Parsing certs", [os.path.join(bin_dir, "parseCerts")], ctx.jobs,
+                        inputs=["raw/certs", "v1cas.csv"],
+                        outputs=["certs.csv", "dns.csv", "names.csv", "unparsed_certs.csv", "crldps.csv"],
+                        after=parse_after),
+        prepare_links,
+        CheckLinksStage("check_links", "Checking links", [os.path.join(bin_dir, "checkLinks")], ctx.jobs,
+                        outputs=["links.csv"], after=["prepare_links", "pack_index"]),
+        Stage("build_chains", "Building chains",
+              [os.path.join(bin_dir, "buildChains"), "-d", d, "-T", str(ctx.max_transvalid)],
+              inputs=["links.csv", "chains.csv"],
+              outputs=["built_chains.csv", "built_links.csv", "unused_certs.csv"],
+              after=["answers", "check_links"]),
+    ]
+    trust_outputs = ["trusted_certs.csv", "trusted_chains.csv", "trusted_built_chains.csv",
+                     "roots.csv", "rated_chains.csv"]
+    load_after = ["build_chains"]
+    if trust:
+        stages += [
+            Stage("flag_trust", "Flagging trusted certs",
+                  [os.path.join(bin_dir, "flagTrust"), "-d", d, "-t", ctx.trust_flag, "--der"] + ctx.trusted_cas,
+                  inputs=["built_links.csv", "links.csv", "chains.csv"] + ctx.trusted_cas,
+                  outputs=trust_outputs[:4], after=["build_chains"]),
+            Stage("rate_chains", "Rating chains",
+                  [os.path.join(bin_dir, "rateChains"), "-d", d, "-t", ctx.trust_flag],
+                  inputs=["built_chains.csv", "trusted_built_chains.csv"],
+                  outputs=trust_outputs[4:], after=["flag_trust"]),
+        ]
+        load_after = ["flag_trust", "rate_chains"]
+    if ctx.no_database:
+        return stages
+
+    schema = os.path.join(bin_dir, "db.txt")
+    load_inputs = schema_imports(schema)
+    if ctx.ingest_into is not None:
+        load = LoadStage("load", "Injecting data into the database",
+                         [python, os.path.join(bin_dir, "load-db.py"), "-a", "-o", ctx.ingest_into, d],
+                         ctx.database, True)
+    elif ctx.sqlite_import:
+        load = LoadStage("load", "Injecting data into the database", ["sqlite3", "db.sql"],
+                         ctx.database, False, cwd=d, stdin=schema)
+    else:
+        load = LoadStage("load", "Injecting data into the database",
+                         [python, os.path.join(bin_dir, "load-db.py"), d], ctx.database, False)
+    load.inputs, load.outputs, load.after = load_inputs, [ctx.database], load_after
+    stages.append(load)
+    if ctx.transitive_links:
+        stages.append(Stage("transitive_links", "Computing the transitive links",
+                            [python, os.path.join(bin_dir, "transitive-links.py"), ctx.database],
+                            after=["load"]))
+    if ctx.advise_indexes:
+        stages.append(Stage("advise_indexes", "Creating the indexes needed by piccolo",
+                            [python, os.path.join(bin_dir, "index-advisor.py"), ctx.database],
+                            after=["load"] + (["transitive_links"] if ctx.transitive_links else [])))
+    return stages
+
+
+class Context(object):
+    def __init__(self):
+        self.data_dir = None
+        self.trusted_cas, self.dumps = [], []
+        self.trust_flag, self.max_transvalid = "trusted", 3
+        self.jobs = multiprocessing.cpu_count()
+        self.no_database = self.advise_indexes = self.transitive_links = False
+        self.sqlite_import, self.force, self.verbose = False, False, False
+        self.ingest_into = None
+
+    @property
+    def database(self):
+        return self.ingest_into or self.path("db.sql")
+
+    def path(self, name):
+        return os.path.join(self.data_dir, name)
+
+    def log_path(self, stage, shard=None):
+        name = stage if shard is None else "%s-%d" % (stage, shard)
+        return self.path(os.path.join("logs", name + ".log"))
+
+
+class Operations(object):
+    """The operations.csv file of a data-dir."""
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = []
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    line = line.rstrip("\r\n")
+                    if line:
+                        self.rows.append(dict(zip(OPERATIONS_COLUMNS, unquote_csv_line(line))))
+
+    def append(self, row):
+        self.rows.append(row)
+        with open(self.path, "a") as f:
+            f.write(csv_line([row[c] for c in OPERATIONS_COLUMNS]))
+
+    def last(self, stage, status=None):
+        for row in reversed(self.rows):
+            if row["stage"] == stage and status in [None, row["status"]]:
+                return row
+        return None
+
+    def save_to_database(self, database, data_dir):
+        db = sqlite3.connect(database)
+        try:
+            db.execute("create table if not exists operations (data_dir text, %s)" %
+                       ", ".join(OPERATIONS_COLUMNS))
+            db.execute("delete from operations where data_dir = ?", [data_dir])
+            db.executemany("insert into operations (data_dir, %s) values (?, %s)" %
+                           (", ".join(OPERATIONS_COLUMNS), ", ".join("?" * len(OPERATIONS_COLUMNS))),
+                           [[data_dir] + [row[c] for c in OPERATIONS_COLUMNS] for row in self.rows])
+            db.commit()
+        finally:
+            db.close()
+
+
+class Run(object):
+    """The tasks of a stage being run, and the resources they used."""
+
+    def __init__(self, stage, started, tasks, cpu_time):
+        self.stage, self.started = stage, started
+        self.pending = len(tasks)
+        self.cpu_time, self.max_rss = cpu_time, 0
+        self.ok = True
+
+
+def self_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Pipeline(object):
+    def __init__(self, stages, ctx, operations):
+        self.stages = stages
+        self.ctx = ctx
+        self.operations = operations
+        self.by_name = dict((s.name, s) for s in stages)
+        self.state = dict((s.name, "pending") for s in stages)
+        self.fingerprints = dict()
+        self.forced = set()
+        self.produced = set(o for s in stages for o in s.outputs)
+        self.run_id = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.failed = False
+
+    def input_files(self, stage):
+        for name in stage.inputs:
+            path = self.ctx.path(name)
+            if os.path.isdir(path):
+                for dirpath, _, filenames in sorted(os.walk(path)):
+                    for filename in sorted(filenames):
+                        yield os.path.join(dirpath, filename)
+            else:
+                yield path
+
+    def fingerprint(self, stage):
+        state = [stage.command()]
+        for path in self.input_files(stage):
+            try:
+                st = os.stat(path)
+                state.append((path, st.st_size, int(st.st_mtime * 1000)))
+            except OSError:
+                state.append((path, None))
+        # A stage also runs again after the stages it follows did
+        for name in stage.after:
+            last = self.operations.last(name, "ok")
+            state.append((name, last and last["started"]))
+        return hashlib.sha1(repr(state).encode("utf-8")).hexdigest()
+
+    def up_to_date(self, stage, fingerprint):
+        if self.ctx.force or stage.name in self.forced:
+            return False
+        last = self.operations.last(stage.name)
+        if last is None or last["status"] not in ["ok", "skipped"] or last["fingerprint"] != fingerprint:
+            return False
+        return all(os.path.exists(self.ctx.path(o)) for o in stage.outputs
+                   if o not in stage.temporary_outputs)
+
+    def missing_temporary_inputs(self, stage):
+        """Returns the skipped stages whose temporary outputs, needed by
+        stage, were removed."""
+        result = []
+        for name in stage.after:
+            producer = self.by_name.get(name)
+            if producer is not None and self.state[name] == "skipped" and \
+               not all(os.path.exists(self.ctx.path(o)) for o in producer.temporary_outputs):
+                result.append(producer)
+        return result
+
+    def ready(self, stage):
+        return self.state[stage.name] == "pending" and \
+            all(self.state.get(name) in ["done", "skipped"] for name in stage.after if name in self.by_name)
+
+    def record(self, stage, status, started, finished=None, cpu_time=0.0, max_rss=0):
+        finished = finished or started
+        rows = []
+        if status == "ok":
+            for output in stage.outputs:
+                path = self.ctx.path(output)
+                if output.endswith(".csv") and os.path.exists(path):
+                    rows.append("%s=%d" % (output[:-4], count_lines(path)))
+        self.operations.append({
+            "run": self.run_id, "stage": stage.name, "status": status,
+            "command": stage.command(), "shards": stage.shards,
+            "started": "%.3f" % started, "finished": "%.3f" % finished,
+            "wall_time": "%.3f" % (finished - started), "cpu_time": "%.3f" % cpu_time,
+            "max_rss": max_rss, "rows": " ".join(rows),
+            "fingerprint": self.fingerprints.get(stage.name, "")})
+
+    def start(self, stage):
+        """Returns the Run of stage, or None if it is skipped or has to
+        wait for the temporary files it needs."""
+        started = time.time()
+        # As maestro.sh, the CSV files no stage writes (e.g. when there
+        # is no trusted CA) are created empty, before the fingerprint
+        # so that it does not change on the next run
+        for name in stage.inputs:
+            path = self.ctx.path(name)
+            if name.endswith(".csv") and name not in self.produced and not os.path.exists(path):
+                open(path, "a").close()
+        fingerprint = self.fingerprint(stage)
+        self.fingerprints[stage.name] = fingerprint
+        if self.up_to_date(stage, fingerprint):
+            self.state[stage.name] = "skipped"
+            self.record(stage, "skipped", started)
+            print("= %s = skipped (unchanged)" % stage.title)
+            return None
+        producers = self.missing_temporary_inputs(stage)
+        if producers:
+            for producer in producers:
+                self.state[producer.name] = "pending"
+                self.forced.add(producer.name)
+            return None
+        self.state[stage.name] = "running"
+        print("= %s =" % stage.title)
+        if self.ctx.verbose:
+            print(stage.command())
+        sys.stdout.flush()
+        cpu_time = self_cpu_time()
+        try:
+            stage.prepare(self.ctx)
+            tasks = stage.tasks(self.ctx)
+        except (IOError, OSError) as e:
+            print("%s: %s" % (stage.name, e), file=sys.stderr)
+            tasks = None
+        run = Run(stage, started, tasks or [], self_cpu_time() - cpu_time)
+        if tasks is None:
+            run.ok = False
+        return run, tasks or []
+
+    def complete(self, run):
+        stage = run.stage
+        if run.ok:
+            cpu_time = self_cpu_time()
+            try:
+                stage.finish(self.ctx)
+                for output in stage.outputs:
+                    # Programs do not create the CSV files they have
+                    # nothing to write to
+                    if output.endswith(".csv") and output not in stage.temporary_outputs \
+                       and not os.path.exists(self.ctx.path(output)):
+                        open(self.ctx.path(output), "a").close()
+            except (IOError, OSError) as e:
+                print("%s: %s" % (stage.name, e), file=sys.stderr)
+                run.ok = False
+            run.cpu_time += self_cpu_time() - cpu_time
+        finished = time.time()
+        self.state[stage.name] = "done" if run.ok else "failed"
+        self.record(stage, "ok" if run.ok else "failed", run.started, finished, run.cpu_time, run.max_rss)
+        print("= %s = %s (%.1f s, %.1f s CPU, %d kB)" % (stage.title, "OK" if run.ok else "NOK",
+                                                        finished - run.started, run.cpu_time, run.max_rss))
+        sys.stdout.flush()
+        if not run.ok:
+            self.failed = True
+
+    def start_ready_stages(self, queue):
+        progress = True
+        while progress and not self.failed:
+            progress = False
+            for stage in self.stages:
+                if not self.ready(stage):
+                    continue
+                progress = True
+                started = self.start(stage)
+                if started is None:
+                    continue
+                run, tasks = started
+                if run.pending == 0:
+                    self.complete(run)
+                queue.extend((run, task) for task in tasks)
+
+    def run(self):
+        """Runs the stages, JOBS processes at a time, and returns whether
+        they all succeeded. After a failure, no stage is started, but
+        those already started are completed."""
+        queue, running = [], dict()
+        while True:
+            self.start_ready_stages(queue)
+            while queue and len(running) < self.ctx.jobs:
+                run, task = queue.pop(0)
+                running[task.start()] = run
+            if not running:
+                return not self.failed
+            pid, status, usage = os.wait4(-1, 0)
+            run = running.pop(pid, None)
+            if run is None:
+                continue
+            run.pending -= 1
+            run.cpu_time += usage.ru_utime + usage.ru_stime
+            run.max_rss = max(run.max_rss, usage.ru_maxrss)
+            if status != 0 and run.ok:
+                run.ok = False
+                run.pending -= sum(1 for (r, _) in queue if r is run)
+                queue = [(r, t) for (r, t) in queue if r is not run]
+            if run.pending == 0:
+                self.complete(run)
+
+
+def usage():
+    print(__doc__.strip().split("\n\n")[-1], file=sys.stderr)
+    sys.exit(1)
+
+
+def main():
+    ctx = Context()
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "d:C:D:vT:t:j:nALSI:f")
+    except getopt.GetoptError:
+        usage()
+    for o, v in opts:
+        if o == "-d":
+            ctx.data_dir = os.path.abspath(v)
+        elif o == "-D":
+            ctx.trusted_cas = [os.path.abspath(os.path.join(v, f)) for f in sorted(os.listdir(v))] + \
+                ctx.trusted_cas
+        elif o == "-C":
+            ctx.trusted_cas = [os.path.abspath(v)] + ctx.trusted_cas
+        elif o == "-v":
+            ctx.verbose = True
+        elif o == "-T":
+            ctx.max_transvalid = int(v)
+        elif o == "-t":
+            ctx.trust_flag = v
+        elif o == "-j":
+            ctx.jobs = max(1, int(v))
+        elif o == "-n":
+            ctx.no_database = True
+        elif o == "-A":
+            ctx.advise_indexes = True
+        elif o == "-L":
+            ctx.transitive_links = True
+        elif o == "-S":
+            ctx.sqlite_import = True
+        elif o == "-I":
+            ctx.ingest_into = os.path.abspath(v)
+        elif o == "-f":
+            ctx.force = True
+    if ctx.data_dir is None:
+        usage()
+    ctx.dumps = [os.path.abspath(a) for a in args]
+    for directory in ["", "logs", "tmp"]:
+        if not os.path.isdir(ctx.path(directory)):
+            os.makedirs(ctx.path(directory))
+    # As maestro.sh, temporary files (e.g. of sqlite) go to the data-dir
+    os.environ["TMPDIR"] = ctx.path("tmp")
+
+    stages = make_stages(ctx)
+    if ctx.verbose:
+        print("DATA_DIR=%s" % ctx.data_dir)
+        print("TRUSTED_CAS=%s" % " ".join(ctx.trusted_cas))
+        print("ANSWER_DUMPS (%d)=%s" % (len(ctx.dumps), " ".join(ctx.dumps)))
+        print("JOBS=%d" % ctx.jobs)
+        print("STAGES=%s" % " ".join(s.name for s in stages))
+    operations = Operations(ctx.path(OPERATIONS_FILE))
+    pipeline = Pipeline(stages, ctx, operations)
+    ok = pipeline.run()
+    if not ctx.no_database and os.path.exists(ctx.database):
+        operations.save_to_database(ctx.database, ctx.data_dir)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
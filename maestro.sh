@@ -2,7 +2,7 @@
 
 error () {
       echo "Error: $1" >&2
-      echo "Usage: maestro -d OUT_DIR [-D TRUSTED_CA_DIR|-C TRUSTED_CA] ANSWER_DUMPS"
+      echo "Usage: maestro -d OUT_DIR [-D TRUSTED_CA_DIR|-C TRUSTED_CA] [-A] [-L] [-S] [-I DATABASE] ANSWER_DUMPS"
       exit 1
 }
 
@@ -12,10 +12,14 @@ DATA_DIR=
 TRUSTED_CAS=
 VERBOSE=
 NO_DATABASE=
+ADVISE_INDEXES=
+TRANSITIVE_LINKS=
+SQLITE_IMPORT=
+INGEST_INTO=
 TRUST_FLAG=trusted
 MAX_TRANSVALID=3
 
-while getopts "d:C:D:vT:nt:" option; do
+while getopts "d:C:D:vT:nt:ALSI:" option; do
     case "$option" in
         d)
             DATA_DIR="$OPTARG"
@@ -38,6 +42,18 @@ while getopts "d:C:D:vT:nt:" option; do
         n)
             NO_DATABASE=1
             ;;
+        A)
+            ADVISE_INDEXES=1
+            ;;
+        L)
+            TRANSITIVE_LINKS=1
+            ;;
+        S)
+            SQLITE_IMPORT=1
+            ;;
+        I)
+            INGEST_INTO="$OPTARG"
+            ;;
         *)
             error "Invalid option \"$option\""
             ;;
@@ -61,6 +77,7 @@ if [ -n "$VERBOSE" ]; then
     echo "MAX_TRANSVALID=$MAX_TRANSVALID"
     echo "TRUST_FLAG=$TRUST_FLAG"
     echo "NO_DATABASE=$NO_DATABASE"
+    echo "ADVISE_INDEXES=$ADVISE_INDEXES"
 fi
 
 
@@ -126,6 +143,28 @@ if [ -z "$NO_DATABASE" ]; then
     echo "= Injecting data into the database ="
     mkdir "$DATA_DIR/tmp"
     export TMPDIR="$DATA_DIR/tmp"
-    cat "$BIN_DIR/db.txt" | { cd "$DATA_DIR"; time sqlite3 "db.sql" &> /dev/null; }
+    if [ -n "$INGEST_INTO" ]; then
+        time python "$BIN_DIR/load-db.py" -a -o "$INGEST_INTO" "$DATA_DIR"
+    elif [ -n "$SQLITE_IMPORT" ]; then
+        cat "$BIN_DIR/db.txt" | { cd "$DATA_DIR"; time sqlite3 "db.sql" &> /dev/null; }
+    else
+        time python "$BIN_DIR/load-db.py" "$DATA_DIR"
+    fi
     handle_ret_code
+
+    echo "= Indexing raw certificates ="
+    time python "$BIN_DIR/piccolo_pack.py" "$DATA_DIR" certs
+    handle_ret_code
+
+    if [ -n "$TRANSITIVE_LINKS" ]; then
+        echo "= Computing the transitive links ="
+        time python "$BIN_DIR/transitive-links.py" "${INGEST_INTO:-$DATA_DIR/db.sql}"
+        handle_ret_code
+    fi
+
+    if [ -n "$ADVISE_INDEXES" ]; then
+        echo "= Creating the indexes needed by piccolo ="
+        time python "$BIN_DIR/index-advisor.py" "${INGEST_INTO:-$DATA_DIR/db.sql}"
+        handle_ret_code
+    fi
 fi
@@ -1,28 +1,112 @@
 #!/usr/bin/python
 
-import sqlite3, sys, re, tempfile
+import sqlite3, sys, os, re, tempfile, getopt, time, logging
+import itertools, base64, json, functools, threading
 from pygraphviz import AGraph
 from datetime import datetime
-from flask import g, Flask, Response, render_template, abort, session, redirect, url_for
+from piccolo_cache import TieredCache, LRUCache, key_digest
+from piccolo_layout import LayoutPool, LayoutError
+from piccolo_pack import PackStore
+from piccolo_diff import DiffSummary, TRANSITION_KINDS, merge_hosts, protocol_version, transitions
+from piccolo_stats import STATS_KINDS, load_summaries
+from piccolo_db import ConnectionPool, QueryStats, connect_ro, schema_kind, database_generation, from_db, to_compact, compact_args
+from flask import g, Flask, Response, render_template, abort, session, redirect, url_for, request, stream_with_context, jsonify
 app = Flask(__name__)
 
-DATABASE = sys.argv[1]
-
 trust_flag = "trusted" # TODO: Add code to choose the default trust flag
 
 
 def make_dicts(cursor, row):
-    return dict((cursor.description[idx][0], value)
+    return dict((cursor.description[idx][0], from_db(value))
                 for idx, value in enumerate(row))
 
+# Connections are taken from a pool of long-lived read-only
+# connections (see piccolo_db), configured by the DATABASE_* settings.
+# DATABASE_IMMUTABLE (immutable=1) is only safe when nothing writes to
+# the database while it is served: sqlite then ignores the WAL, where
+# load-db.py -a and transitive-links.py commit.
+
+app.config.setdefault("DATABASE", os.environ.get("PICCOLO_DATABASE"))
+app.config.setdefault("DATABASE_IMMUTABLE", False)
+app.config.setdefault("DATABASE_POOL_SIZE", 8)
+app.config.setdefault("DATABASE_CACHE_SIZE", 64 * 1024)
+app.config.setdefault("DATABASE_MMAP_SIZE", 1024 * 1024 * 1024)
+
+db_pool = None
+
+def connect_db():
+    db = connect_ro (app.config["DATABASE"],
+                     immutable = app.config["DATABASE_IMMUTABLE"],
+                     cache_size_kib = app.config["DATABASE_CACHE_SIZE"],
+                     mmap_size = app.config["DATABASE_MMAP_SIZE"])
+    db.row_factory = make_dicts
+    db.create_function ("hash_hex", 1, from_db)
+    # Hashes bound within JSON arrays (see the API) are converted by
+    # hash_arg, as execute_db converts the hashes given as arguments
+    db.create_function ("hash_arg", 1, to_compact if schema_kind (db) == "compact" else (lambda h: h))
+    return db
+
 def get_db():
+    global db_pool
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = make_dicts
+        if db_pool is None:
+            db_pool = ConnectionPool (connect_db, app.config["DATABASE_POOL_SIZE"])
+        db = g._database = db_pool.acquire()
     return db
 
-def query_db(fields, tables, joins, conditions, args=[], order_by=[], group_by=[], offset=None, limit=None):
+# Databases using the compact schema (db-compact.txt) store hashes as
+# blobs: rows are converted back to hex by make_dicts, and hex hashes
+# given to execute_db are converted to blobs. SQL expressions building
+# strings from hashes must use hash_hex() to work with both schemas.
+
+database_schema = None
+
+def get_schema():
+    global database_schema
+    if database_schema is None:
+        database_schema = schema_kind (get_db())
+    return database_schema
+
+# Queries are run through execute_db, which records per-shape
+# statistics (exposed on /_stats) and logs the queries slower than
+# SLOW_QUERY_MS (to SLOW_QUERY_LOG if set). Query texts built by
+# build_query are kept in a bounded cache, and limits and offsets are
+# bound as parameters, so that sqlite's statement cache can reuse the
+# compiled statements.
+
+app.config.setdefault("QUERY_STATS_SHAPES", 512)
+app.config.setdefault("SLOW_QUERY_MS", None)
+app.config.setdefault("SLOW_QUERY_LOG", None)
+
+query_stats = None
+query_shapes = LRUCache (512)
+
+def get_query_stats():
+    global query_stats
+    if query_stats is None:
+        slow_query_ms = app.config["SLOW_QUERY_MS"]
+        logger = logging.getLogger ("piccolo.slow_queries")
+        if app.config["SLOW_QUERY_LOG"] is not None and not logger.handlers:
+            logger.addHandler (logging.FileHandler (app.config["SLOW_QUERY_LOG"]))
+            logger.setLevel (logging.WARNING)
+        query_stats = QueryStats (app.config["QUERY_STATS_SHAPES"],
+                                  None if slow_query_ms is None else slow_query_ms / 1000.0,
+                                  logger)
+    return query_stats
+
+def execute_db(query, args=[]):
+    if get_schema() == "compact":
+        args = compact_args (args)
+    return get_query_stats().execute (get_db(), query, args)
+
+def build_query(fields, tables, joins, conditions, order_by=[], group_by=[], offset=None, limit=None):
+    shape = (tuple(fields), tuple(tables), tuple(joins), tuple(conditions),
+             tuple(order_by), tuple(group_by), offset is None, limit is None)
+    query = query_shapes.get (shape)
+    if query is not None:
+        return query
+
     if len(joins) > 0:
         join_str = "join %s" % (", ".join(joins))
     else:
@@ -42,24 +126,32 @@ def query_db(fields, tables, joins, conditions, args=[], order_by=[], group_by=[
     if limit is None:
         limit_str = ""
     else:
-        limit_str = "limit %d" % limit
+        limit_str = "limit ?"
     if offset is None:
         offset_str = ""
     else:
-        offset_str = "offset %d" % offset
+        offset_str = "offset ?"
     query = ("select %s from %s %s %s %s %s %s %s" %
              (", ".join(fields), ", ".join(tables), join_str, cond_str,
               group_by_str, order_by_str, limit_str, offset_str))
-    cur = get_db().execute(query, args)
-    rv = cur.fetchall()
-    cur.close()
-    return rv
+    query_shapes.put (shape, query)
+    return query
+
+def iter_db(fields, tables, joins, conditions, args=[], order_by=[], group_by=[], offset=None, limit=None):
+    query = build_query (fields, tables, joins, conditions, order_by, group_by, offset, limit)
+    args = list(args) + [x for x in [limit, offset] if x is not None]
+    return execute_db (query, args)
+
+def query_db(fields, tables, joins, conditions, args=[], order_by=[], group_by=[], offset=None, limit=None):
+    return list (iter_db (fields, tables, joins, conditions, args, order_by, group_by, offset, limit))
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    # Streamed pages tear the context down twice (stream_with_context):
+    # the connection must only go back to the pool once
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        db_pool.release(db)
 
 def campaign_str(cid):
     cid_s = "%s" % cid
@@ -73,120 +165,630 @@ def time_str(ts):
     return dt.strftime("%Y-%m-%d %H:%M:%S")
 
 
+def stream_template(template_name, **context):
+    app.update_template_context(context)
+    t = app.jinja_env.get_template(template_name)
+    return Response(stream_with_context(t.stream(context)))
+
+
+# Listings are paginated using a key (the page_key column of the
+# rows): each page is requested with the key of the last row of the
+# previous page ("after" parameter), instead of an offset.
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def page_args():
+    try:
+        n = int(request.args.get("n", PAGE_SIZE))
+    except ValueError:
+        n = PAGE_SIZE
+    return request.args.get("after"), max(1, min(n, MAX_PAGE_SIZE))
+
+def paginate(key, after, conditions, args):
+    if after is None:
+        return conditions, args
+    return conditions + ["%s > ?" % key], args + [after]
+
+class Page(object):
+    """Lazily iterates over the (n+1) rows fetched for a page, so
+    that they can be streamed to the client; once the iteration is
+    over, next_after is the key to request the next page, if any.
+    head holds the rows already read from rows, if any. rows is
+    closed as soon as the page is complete, so that the query is
+    finished (and accounted for) within the request."""
+
+    def __init__(self, rows, n, decorate=None, head=()):
+        self.rows = rows
+        self.head = head
+        self.n = n
+        self.decorate = decorate
+        self.count = 0
+        self.next_after = None
+
+    def __iter__(self):
+        last_key = None
+        try:
+            for row in itertools.chain(self.head, self.rows):
+                if self.count == self.n:
+                    self.next_after = last_key
+                    break
+                last_key = row["page_key"]
+                if self.decorate:
+                    self.decorate(row)
+                self.count += 1
+                yield row
+        finally:
+            self.rows.close()
+
+    def url_args(self):
+        args = dict((k, v) for (k, v) in request.args.items() if k not in ["after", "n", "format"])
+        args.update(request.view_args)
+        return args
+
+    def next_url(self):
+        return url_for(request.endpoint, after=self.next_after, n=self.n, **self.url_args())
+
+    def export_url(self, fmt):
+        return url_for(request.endpoint, format=fmt, **self.url_args())
+
+
+# Listings can also be exported as a whole (from the after key, if
+# given) with ?format=csv or ?format=ndjson: the rows are streamed from
+# the cursor, with the fields computed by piccolo (decorate), in
+# batches of EXPORT_BATCH rows.
+
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+EXPORT_BATCH = 1000
+
+def export_format():
+    fmt = request.args.get("format")
+    if fmt is not None and fmt not in EXPORT_FORMATS:
+        abort(400)
+    return fmt
+
+def field_name(field):
+    return field.rsplit(" as ", 1)[-1].split(".")[-1]
+
+CSV_QUOTED_RE = re.compile(u'[,"\r\n]')
+
+def csv_field(value):
+    if value is None:
+        return u""
+    value = u"%s" % value
+    if CSV_QUOTED_RE.search(value):
+        return u'"%s"' % value.replace(u'"', u'""')
+    return value
+
+def csv_line(values):
+    return u",".join(map(csv_field, values)) + u"\r\n"
+
+def export_response(fmt, rows, fields, derived_fields, decorate, title):
+    columns = [field_name(f) for f in fields if field_name(f) != "page_key"] + derived_fields
+    def lines():
+        if fmt == "csv":
+            yield csv_line(columns)
+        for row in rows:
+            if decorate:
+                decorate(row)
+            values = [row.get(c) for c in columns]
+            if fmt == "csv":
+                yield csv_line(values)
+            else:
+                yield json.dumps(dict(zip(columns, values))) + "\n"
+    def chunks():
+        try:
+            batch = []
+            for line in lines():
+                batch.append(line)
+                if len(batch) == EXPORT_BATCH:
+                    yield u"".join(batch).encode("utf-8")
+                    batch = []
+            yield u"".join(batch).encode("utf-8")
+        finally:
+            rows.close()
+    response = Response(stream_with_context(chunks()), mimetype=EXPORT_FORMATS[fmt])
+    filename = re.sub("[^A-Za-z0-9_.-]+", "_", title).strip("_")
+    response.headers["Content-Disposition"] = 'attachment; filename="%s.%s"' % (filename, fmt)
+    return response
+
+
+# Whole pages are kept in page_cache (in memory, and in PAGE_CACHE_DIR
+# if set, which several processes can share), addressed by the digest
+# of (path, query arguments, trust flag, database identity). This
+# digest is also the ETag of the pages: a repeated request is answered
+# from the cache, or with a 304 when the client has the page, without
+# running any query. Streamed pages are kept as they are sent, unless
+# they exceed PAGE_CACHE_MAX_ENTRY bytes; exports are never kept.
+
+app.config.setdefault("PAGE_CACHE_ENTRIES", 1024)
+app.config.setdefault("PAGE_CACHE_BYTES", 64 * 1024 * 1024)
+app.config.setdefault("PAGE_CACHE_DIR", None)
+app.config.setdefault("PAGE_CACHE_DIR_SIZE", 1024 * 1024 * 1024)
+app.config.setdefault("PAGE_CACHE_MAX_ENTRY", 4 * 1024 * 1024)
+
+page_cache = None
+
+def get_page_cache():
+    global page_cache
+    if page_cache is None:
+        page_cache = TieredCache (app.config["PAGE_CACHE_ENTRIES"], app.config["PAGE_CACHE_BYTES"],
+                                  directory = app.config["PAGE_CACHE_DIR"],
+                                  directory_max_bytes = app.config["PAGE_CACHE_DIR_SIZE"])
+    return page_cache
+
+def page_digest():
+    args = sorted (request.args.items (multi=True))
+    return key_digest (("page", request.path, args, trust_flag, database_identity ()))
+
+def keep_page(cache, digest, response):
+    max_bytes = app.config["PAGE_CACHE_MAX_ENTRY"]
+    header = response.content_type.encode ("ascii") + b"\n"
+    if not response.is_streamed:
+        body = response.get_data ()
+        if len (body) <= max_bytes:
+            cache.put (digest, header + body)
+        return
+    original, chunks = response.response, response.iter_encoded ()
+    def body():
+        kept, size = [], 0
+        try:
+            for chunk in chunks:
+                if kept is not None:
+                    size += len (chunk)
+                    if size <= max_bytes:
+                        kept.append (chunk)
+                    else:
+                        kept = None
+                yield chunk
+        finally:
+            if hasattr (original, "close"):
+                original.close ()
+        if kept is not None:
+            cache.put (digest, header + b"".join (kept))
+    response.response = body ()
+
+def cached_page(view):
+    @functools.wraps (view)
+    def cached_view(*args, **kwargs):
+        if "format" in request.args:
+            return view (*args, **kwargs)
+        digest = page_digest ()
+        if digest in request.if_none_match:
+            response = Response (status=304)
+        else:
+            cache = get_page_cache ()
+            entry = cache.get (digest)
+            if entry is not None:
+                content_type, body = entry.split (b"\n", 1)
+                response = Response (body, content_type=content_type.decode ("ascii"))
+            else:
+                response = app.make_response (view (*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                keep_page (cache, digest, response)
+        response.set_etag (digest)
+        return response
+    return cached_view
+
+
+# Everything displayed on a certificate page is fetched using two
+# constant statements (which sqlite keeps prepared in its statement
+# cache): one for the answers, and one gathering every other relation
+# with a union, each part being bounded by CERT_RELATION_LIMIT.
+
+CERT_RELATION_LIMIT = 1000
+
+CERT_ANSWERS_QUERY = """
+select campaign, ip, name, chain_hash, position, timestamp
+  from chains join answers on answers.chain_hash = chains.hash
+  where chains.cert_hash = :hash
+  limit :limit
+"""
+
+# The status of the certificate in each revision of the Mozilla store
+# (see extract-ev-certdata.py)
+
+CERT_TRUST_STORES_QUERY = """
+select revision, number, name, description,
+       store_roots.label as label, server_auth, email_protection, code_signing,
+       (select group_concat(oid_name, ', ') from ev_roots
+          where ev_roots.ev_hash = trust_store_revisions.ev_hash and ev_roots.cert_hash = :hash) as ev
+  from trust_store_revisions
+  left join store_roots on store_roots.certdata_hash = trust_store_revisions.certdata_hash
+                       and store_roots.cert_hash = :hash
+  order by number, revision
+"""
+
+CERT_RELATIONS = ["names", "issuers", "issued", "issued_names",
+                  "transitive_issuers", "transitive_issued", "transitive_issued_names"]
+
+CERT_RELATIONS_QUERY = """
+select * from (select 'names' as relation, null as hash, type, name, null as distance
+                 from names
+                 where cert_hash = :hash
+                 limit :limit)
+union all
+select * from (select 'issuers', certs.hash, null, dns.name, null
+                 from links
+                 join certs on certs.hash = links.issuer_hash
+                 join dns on dns.hash = certs.subject_hash
+                 where links.subject_hash = :hash
+                 limit :limit)
+union all
+select * from (select 'issued', certs.hash, null, dns.name, null
+                 from links
+                 join certs on certs.hash = links.subject_hash
+                 join dns on dns.hash = certs.subject_hash
+                 where links.issuer_hash = :hash
+                 limit :limit)
+union all
+select * from (select 'issued_names', null, names.type, names.name, null
+                 from links
+                 join certs on certs.hash = links.subject_hash
+                 join dns on dns.hash = certs.subject_hash
+                 join names on names.cert_hash = certs.hash
+                 where links.issuer_hash = :hash
+                 limit :limit)
+union all
+select * from (select 'transitive_issuers', certs.hash, null, dns.name, distance
+                 from transitive_links
+                 join certs on certs.hash = transitive_links.issuer_hash
+                 join dns on dns.hash = certs.subject_hash
+                 where transitive_links.subject_hash = :hash
+                 order by distance asc
+                 limit :limit)
+union all
+select * from (select 'transitive_issued', certs.hash, null, dns.name, distance
+                 from transitive_links
+                 join certs on certs.hash = transitive_links.subject_hash
+                 join dns on dns.hash = certs.subject_hash
+                 where transitive_links.issuer_hash = :hash
+                 order by distance asc
+                 limit :limit)
+union all
+select * from (select 'transitive_issued_names', null, names.type, names.name, null
+                 from transitive_links
+                 join certs on certs.hash = transitive_links.subject_hash
+                 join dns on dns.hash = certs.subject_hash
+                 join names on names.cert_hash = certs.hash
+                 where transitive_links.issuer_hash = :hash
+                 limit :limit)
+"""
+
+# The transitive relations are read from the transitive_links table
+# when it has been filled (see transitive-links.py). Otherwise (or when
+# TRANSITIVE_LINKS is "query"), they are computed for the certificate
+# being displayed by recursive queries over links, bounded to
+# TRANSITIVE_LINKS_DEPTH levels and TRANSITIVE_LINKS_ROWS rows in each
+# direction: the result is named transitive_links, which shadows the
+# table in CERT_RELATIONS_QUERY.
+
+app.config.setdefault("TRANSITIVE_LINKS", None)
+app.config.setdefault("TRANSITIVE_LINKS_DEPTH", 8)
+app.config.setdefault("TRANSITIVE_LINKS_ROWS", 10 * CERT_RELATION_LIMIT)
+
+TRANSITIVE_LINKS_CTE = """
+with recursive
+ancestors(hash, distance) as (
+  select :hash, 0
+  union
+  select links.issuer_hash, ancestors.distance + 1
+    from ancestors join links on links.subject_hash = ancestors.hash
+    where links.issuer_hash != links.subject_hash and ancestors.distance < :depth
+  limit :closure_rows),
+descendants(hash, distance) as (
+  select :hash, 0
+  union
+  select links.subject_hash, descendants.distance + 1
+    from descendants join links on links.issuer_hash = descendants.hash
+    where links.issuer_hash != links.subject_hash and descendants.distance < :depth
+  limit :closure_rows),
+transitive_links(issuer_hash, subject_hash, distance) as (
+  select :hash, :hash, 0 from links
+    where subject_hash = :hash and issuer_hash = :hash
+  union all
+  select hash, :hash, min(distance) from ancestors
+    where hash != :hash group by hash
+  union all
+  select :hash, hash, min(distance) from descendants
+    where hash != :hash group by hash)
+"""
+
+CERT_RELATIONS_CTE_QUERY = TRANSITIVE_LINKS_CTE + CERT_RELATIONS_QUERY
+
+transitive_links_mode = None
+
+def get_transitive_links_mode():
+    global transitive_links_mode
+    if transitive_links_mode is None:
+        transitive_links_mode = app.config["TRANSITIVE_LINKS"]
+        if transitive_links_mode is None:
+            filled = execute_db ("select 1 from transitive_links limit 1")
+            transitive_links_mode = "table" if list (filled) else "query"
+    return transitive_links_mode
+
+def get_cert_details(cert, limit=CERT_RELATION_LIMIT):
+    # One more row than displayed is fetched to know whether a list
+    # has been truncated
+    params = {"hash": cert["hash"], "limit": limit + 1}
+    answers = list (execute_db (CERT_ANSWERS_QUERY, params))
+    for answer in answers:
+        answer["campaign"] = campaign_str(answer["campaign"])
+        ts = int(answer["timestamp"])
+        answer["timestamp_str"] = time_str (ts)
+        answer["valid_at_timestamp"] = str (int(cert["not_before"]) <= ts and ts <= int(cert["not_after"]))
+
+    details = dict((r, []) for r in CERT_RELATIONS)
+    if get_transitive_links_mode() == "table":
+        relations = execute_db (CERT_RELATIONS_QUERY, params)
+    else:
+        params["depth"] = app.config["TRANSITIVE_LINKS_DEPTH"]
+        params["closure_rows"] = app.config["TRANSITIVE_LINKS_ROWS"]
+        relations = execute_db (CERT_RELATIONS_CTE_QUERY, params)
+    for row in relations:
+        details[row.pop("relation")].append(row)
+
+    details["answers"] = answers
+    details["trust_stores"] = []
+    if has_table ("trust_store_revisions"):
+        revisions = list (execute_db (CERT_TRUST_STORES_QUERY, {"hash": cert["hash"]}))
+        if any (r["label"] is not None or r["ev"] is not None for r in revisions):
+            details["trust_stores"] = revisions
+    details["truncated"] = [r for r in details if len(details[r]) > limit]
+    for r in details["truncated"]:
+        del details[r][limit:]
+    return details
+
+def decorate_cert(cert):
+    cert["not_before_str"] = time_str (int(cert["not_before"]))
+    cert["not_after_str"] = time_str (int(cert["not_after"]))
+
+    if cert['key_type'] == "RSA":
+        n = cert['rsa_modulus']
+        if n[:2] == "00":
+            n = n[2:]
+        cert['key_len'] = len (n) * 4
+    else:
+        cert['key_len'] = 0
+
+CERT_DERIVED_FIELDS = ["not_before_str", "not_after_str", "key_len"]
+
 def get_certs(sup_joins, conditions, args, title, group_by_list = []):
     fields = ["certs.hash as hash", "version", "serial",
               "issuer_hash", "dn_i.name as issuer",
               "subject_hash", "dn_s.name as subject",
               "not_before", "not_after",
               "key_type", "rsa_modulus", "rsa_exponent",
-              "isCA" ]
+              "isCA", "certs.hash as page_key"]
     tables = ["certs"]
     joins = ["dns as dn_i on issuer_hash = dn_i.hash",
              "dns as dn_s on subject_hash = dn_s.hash"] + sup_joins
-    rv = query_db (fields, tables, joins, conditions, args, group_by = group_by_list)
-    if rv:
-        if len(rv) == 1:
-            cert = rv[0]
-
-            cert["not_before_str"] = time_str (int(cert["not_before"]))
-            cert["not_after_str"] = time_str (int(cert["not_after"]))
-
-            if cert['key_type'] == "RSA":
-                n = cert['rsa_modulus']
-                if n[:2] == "00":
-                    n = n[2:]
-                cert['key_len'] = len (n) * 4
-            else:
-                cert['key_len'] = 0
-
-            answers = query_db (["campaign", "ip", "name", "chain_hash", "position", "timestamp"],
-                                ["answers"],
-                                ["chains on chain_hash = hash"],
-                                ["cert_hash = ?"], [cert["hash"]])
-            for answer in answers:
-                answer["campaign"] = campaign_str(answer["campaign"])
-                ts = int(answer["timestamp"])
-                answer["timestamp_str"] = time_str (ts)
-                answer["valid_at_timestamp"] = str (int(cert["not_before"]) <= ts and ts <= int(cert["not_after"]))
-
-            names = query_db (["type", "name"], ["names"], [], ["cert_hash = ?"], [cert["hash"]])
-            issuers = query_db (["certs.hash as hash", "dns.name as name"], ["dns"],
-                                ["certs on certs.subject_hash = dns.hash",
-                                 "links on links.issuer_hash = certs.hash"],
-                                ["links.subject_hash = ?"], [cert["hash"]])
-            issued = query_db (["certs.hash as hash", "dns.name as name"], ["dns"],
-                                ["certs on certs.subject_hash = dns.hash",
-                                 "links on links.subject_hash = certs.hash"],
-                                ["links.issuer_hash = ?"], [cert["hash"]])
-            issued_names = query_db (["names.type as type", "names.name as name"],
-                                     ["names"],
-                                     ["certs on certs.hash = names.cert_hash",
-                                      "dns on certs.subject_hash = dns.hash",
-                                      "links on links.subject_hash = certs.hash"],
-                                     ["links.issuer_hash = ?"], [cert["hash"]])
-
-            transitive_issuers = query_db (["certs.hash as hash", "dns.name as name", "distance"], ["dns"],
-                                ["certs on certs.subject_hash = dns.hash",
-                                 "transitive_links on transitive_links.issuer_hash = certs.hash"],
-                                ["transitive_links.subject_hash = ?"], [cert["hash"]],
-                                order_by = ["distance ASC"])
-            transitive_issued = query_db (["certs.hash as hash", "dns.name as name", "distance"], ["dns"],
-                                ["certs on certs.subject_hash = dns.hash",
-                                 "transitive_links on transitive_links.subject_hash = certs.hash"],
-                                ["transitive_links.issuer_hash = ?"], [cert["hash"]],
-                                order_by = ["distance ASC"])
-            transitive_issued_names = query_db (["names.type as type", "names.name as name"],
-                                     ["names"],
-                                     ["certs on certs.hash = names.cert_hash",
-                                      "dns on certs.subject_hash = dns.hash",
-                                      "transitive_links on transitive_links.subject_hash = certs.hash"],
-                                     ["transitive_links.issuer_hash = ?"], [cert["hash"]])
-
-            return render_template ("certificate.html", cert=cert, answers=answers, names=names,
-                                    issuers = issuers, issued = issued, issued_names = issued_names,
-                                    transitive_issuers = transitive_issuers, transitive_issued = transitive_issued,
-                                    transitive_issued_names = transitive_issued_names)
-        else:
-            return render_template ("certificates.html", certs = rv, title = title)
-    else:
+    after, page_size = page_args()
+    conditions, args = paginate ("certs.hash", after, conditions, args)
+    fmt = export_format ()
+    if fmt is not None:
+        rows = iter_db (fields, tables, joins, conditions, args, group_by = group_by_list,
+                        order_by = ["certs.hash"])
+        return export_response (fmt, rows, fields, CERT_DERIVED_FIELDS, decorate_cert, title)
+    rows = iter_db (fields, tables, joins, conditions, args, group_by = group_by_list,
+                    order_by = ["certs.hash"], limit = page_size + 1)
+    first_rows = list (itertools.islice (rows, 2))
+    if not first_rows:
+        rows.close()
         abort(404)
 
+    if len(first_rows) == 1 and after is None:
+        rows.close()
+        cert = first_rows[0]
+        decorate_cert (cert)
+        details = get_cert_details (cert)
+        return render_template ("certificate.html", cert=cert, limit=CERT_RELATION_LIMIT, **details)
+    else:
+        page = Page (rows, page_size, head = first_rows)
+        return stream_template ("certificates.html", page = page, title = title)
+
 @app.route('/certs/<certhash>')
 @app.route('/certs/by-hash/<certhash>')
+@cached_page
 def cert_by_hash(certhash):
     return get_certs ([], ["certs.hash = ?"], [certhash], certhash)
 
 @app.route('/certs/by-subject/<subject>')
+@cached_page
 def cert_by_subject(subject):
     return get_certs ([], ["dn_s.name = ?"], [subject], "subject=%s" % subject)
 
 @app.route('/certs/by-subject-hash/<subject_hash>')
+@cached_page
 def cert_by_subject_hash(subject_hash):
     return get_certs ([], ["certs.subject_hash = ?"], [subject_hash], "subject_hash=%s" % subject_hash)
 
 @app.route('/certs/by-https-name/<name>')
+@cached_page
 def cert_by_https_name(name):
     return get_certs (["names on names.cert_hash = certs.hash"],
                       ["names.name = ?"], [name], name, ["certs.hash"])
 @app.route('/certs/by-https-name/<type>/<name>')
+@cached_page
 def cert_by_https_name_bis(type, name):
     return get_certs (["names on names.cert_hash = certs.hash"],
                       ["names.type = ?", "names.name = ?"],
                       [type, name], "%s:%s" % (type, name), ["certs.hash"])
 
 @app.route('/certs/by-exact-https-name/<name>')
+@cached_page
 def cert_by_exact_https_name(name):
     return get_certs (["names on names.cert_hash = certs.hash"],
                       ["names.name = ?"], [name], name, ["certs.hash"])
 @app.route('/certs/by-exact-https-name/<type>/<name>')
+@cached_page
 def cert_by_exact_https_name_bis(type, name):
     return get_certs (["names on names.cert_hash = certs.hash"],
                       ["names.type = ?", "names.name = ?"],
                       [type, name], "%s:%s" % (type, name), ["certs.hash"])
 
 
+# Names (DNs and certificate names) are searched with the trigram
+# index search_index (see db.txt). A search is a substring, or, when it
+# holds a *, a pattern where * matches any sequence (e.g. *.example.com
+# for the names of a domain). Each search gives a LIKE pattern, answered
+# by the index, and a GLOB pattern checking the candidates exactly (the
+# index cannot be used with an ESCAPE clause, so % and _ remain
+# wildcards in the LIKE pattern). Results are paginated by rowid.
+
+SEARCH_KINDS = {"all": [], "dn": ["kind = 'dn'"], "name": ["kind != 'dn'"]}
+
+search_index_available = None
+
+def has_search_index():
+    global search_index_available
+    if search_index_available is None:
+        rows = execute_db ("select 1 from sqlite_master where name = 'search_index'")
+        search_index_available = bool (list (rows))
+    return search_index_available
+
+# Tables which may be added to a database while it is served (by
+# extract-ev-certdata.py -o or maestro.py -I): the list is read again
+# whenever the database changes.
+
+database_tables = None
+
+def has_table(name):
+    global database_tables
+    identity = database_identity ()
+    if database_tables is None or database_tables[0] != identity:
+        rows = execute_db ("select name from sqlite_master where type = 'table'")
+        database_tables = (identity, set (r["name"] for r in rows))
+    return name in database_tables[1]
+
+def ascii_lower(s):
+    # As sqlite's lower()
+    return re.sub ("[A-Z]+", lambda m: m.group(0).lower(), s)
+
+def search_patterns(q):
+    """Returns the LIKE pattern of the search q, and the GLOB pattern
+    to match against the lowercased terms."""
+    if "*" in q:
+        parts = q.split ("*")
+    else:
+        parts = ["", q, ""]
+    glob_parts = [re.sub (r"([][*?])", r"[\1]", ascii_lower (p)) for p in parts]
+    return "%".join (parts), "*".join (glob_parts)
+
+def search_conditions(q):
+    like, glob = search_patterns (q)
+    return ["term like ?", "lower(term) glob ?"], [like, glob]
 
-def get_chains(sup_joins, sup_conditions, args, title, group_by = []):
+def decorate_search_result(result):
+    if result["kind"] == "dn":
+        result["url"] = url_for ("cert_by_subject_hash", subject_hash=result["hash"])
+    else:
+        result["url"] = url_for ("cert_by_https_name_bis", type=result["kind"], name=result["term"])
+
+@app.route('/search')
+@cached_page
+def search():
+    q = request.args.get ("q", "").strip ()
+    kind = request.args.get ("kind", "all")
+    if kind not in SEARCH_KINDS:
+        kind = "all"
+    if not q or not has_search_index ():
+        return render_template ("search.html", q=q, kind=kind, page=None,
+                                available=has_search_index ())
+    after, page_size = page_args ()
+    try:
+        after = None if after is None else int (after)
+    except ValueError:
+        abort (400)
+    conditions, args = search_conditions (q)
+    conditions, args = paginate ("rowid", after, conditions + SEARCH_KINDS[kind], args)
+    # DNs are linked to using their hash, as they start with a /
+    fields = ["rowid as page_key", "term", "kind",
+              "case when kind = 'dn' then (select hash from dns where name = term limit 1) end as hash"]
+    rows = iter_db (fields, ["search_index"], [],
+                    conditions, args, order_by = ["rowid"], limit = page_size + 1)
+    page = Page (rows, page_size, decorate_search_result)
+    return stream_template ("search.html", q=q, kind=kind, page=page, available=True)
+
+
+# Raw certificates are read from the packs of the data-dir (DATA_DIR,
+# the directory of the database by default) through a PackStore, which
+# keeps an index of the records. Since certificates are addressed by
+# their hash, the responses never change.
+
+app.config.setdefault("DATA_DIR", None)
+
+pack_store = None
+
+def get_pack_store():
+    global pack_store
+    if pack_store is None:
+        data_dir = app.config["DATA_DIR"] or os.path.dirname (os.path.abspath (app.config["DATABASE"]))
+        pack_store = PackStore (data_dir, "certs")
+    return pack_store
+
+def raw_cert_response(certhash, mimetype, encode, extension):
+    if certhash in request.if_none_match:
+        response = Response (status=304)
+    else:
+        der = get_pack_store().get (certhash.lower())
+        if der is None:
+            abort(404)
+        response = Response (encode (der), mimetype=mimetype)
+        response.headers["Content-Disposition"] = "inline; filename=%s.%s" % (certhash, extension)
+    response.set_etag (certhash)
+    response.headers["Cache-Control"] = "public, max-age=31536000"
+    return response
+
+def pem_of_der(der):
+    b64 = base64.b64encode (bytes (der)).decode ("ascii")
+    lines = [b64[i:i+64] for i in range (0, len(b64), 64)]
+    return "\n".join (["-----BEGIN CERTIFICATE-----"] + lines + ["-----END CERTIFICATE-----", ""])
+
+@app.route('/certs/<certhash>/der')
+def raw_cert_der(certhash):
+    return raw_cert_response (certhash, "application/pkix-cert", bytes, "der")
+
+@app.route('/certs/<certhash>/pem')
+def raw_cert_pem(certhash):
+    return raw_cert_response (certhash, "application/x-pem-file", pem_of_der, "pem")
+
+
+
+def decorate_answer_chain(result):
+    result["campaign"] = campaign_str(result["campaign"])
+    ts = int(result["timestamp"])
+    result["timestamp_str"] = time_str (ts)
+    result["valid_at_timestamp"] = str (int(result["not_before"]) <= ts and ts <= int(result["not_after"]))
+
+def iter_chain_listing(sup_joins, sup_conditions, args, group_by, key, after, limit=None):
+    """Returns the fields and the rows of the listing of the answers
+    whose chains match (see get_chains)."""
+    fields = ["answers.campaign as campaign", "answers.name as name", "answers.ip as ip",
+              "answers.chain_hash as chain_hash", "answers.timestamp as timestamp", "dns.name as subject",
+              "built_chains.built_chain_number as built_chain_number",
+              "built_chains.not_before as not_before", "built_chains.not_after as not_after",
+              "chain_length", "complete", "ordered", "n_transvalid",
+              "%s as page_key" % key]
+    tables = ["answers"]
+    joins = ["built_chains on built_chains.chain_hash = answers.chain_hash",
+             "built_links on built_links.chain_hash = built_chains.chain_hash " +
+             "and built_links.built_chain_number = built_chains.built_chain_number",
+             "certs on built_links.cert_hash = certs.hash",
+             "dns on certs.subject_hash = dns.hash"] + \
+             [j for j in sup_joins if j != "answers on built_chains.chain_hash = answers.chain_hash"]
+    conditions, args = paginate (key, after, ["built_links.position_in_msg = 0"] + sup_conditions, args)
+    return fields, iter_db (fields, tables, joins, conditions, args,
+                            group_by = group_by, order_by = [key], limit = limit)
+
+def get_chains(sup_joins, sup_conditions, args, title, group_by = [], key = "answers.rowid"):
+    after, page_size = page_args()
+    fmt = export_format ()
+    if fmt is not None:
+        fields, rows = iter_chain_listing (sup_joins, sup_conditions, args, group_by, key, after)
+        return export_response (fmt, rows, fields, ["timestamp_str", "valid_at_timestamp"],
+                                decorate_answer_chain, title)
     fields = ["built_chains.chain_hash as chain_hash", "dns.name as subject",
               "built_chains.built_chain_number as built_chain_number",
               "chain_length", "complete", "ordered", "n_transvalid",
@@ -197,10 +799,13 @@ def get_chains(sup_joins, sup_conditions, args, title, group_by = []):
              "certs on built_links.cert_hash = certs.hash",
              "dns on certs.subject_hash = dns.hash"] + sup_joins
     conditions = ["built_links.position_in_msg = 0"] + sup_conditions
-    rv = query_db (fields, tables, joins, conditions, args,
-                   group_by = group_by)
-    if rv:
-        if len(rv) == 1:
+    if after is None:
+        rv = query_db (fields, tables, joins, conditions, args,
+                       group_by = group_by, limit = 2)
+    else:
+        rv = None
+    if rv or after is not None:
+        if rv and len(rv) == 1:
             chain = rv[0]
 
             for s in ["complete", "ordered"]:
@@ -257,28 +862,10 @@ def get_chains(sup_joins, sup_conditions, args, title, group_by = []):
                                     certs=certs, unused_certs=unused_certs, alt_chains=alt_chains,
                                     grades=grades)
         else:
-            fields = ["answers.campaign as campaign", "answers.name as name", "answers.ip as ip",
-                      "answers.chain_hash as chain_hash", "answers.timestamp as timestamp", "dns.name as subject",
-                      "built_chains.built_chain_number as built_chain_number",
-                      "built_chains.not_before as not_before", "built_chains.not_after as not_after",
-                      "chain_length", "complete", "ordered", "n_transvalid"]
-            tables = ["answers"]
-            joins = ["built_chains on built_chains.chain_hash = answers.chain_hash",
-                     "built_links on built_links.chain_hash = built_chains.chain_hash " +
-                     "and built_links.built_chain_number = built_chains.built_chain_number",
-                     "certs on built_links.cert_hash = certs.hash",
-                     "dns on certs.subject_hash = dns.hash"] + \
-                     filter (lambda j : j != "answers on built_chains.chain_hash = answers.chain_hash", sup_joins)
-            conditions = ["built_links.position_in_msg = 0"] + sup_conditions
-            rv = query_db (fields, tables, joins, conditions, args,
-                           group_by = group_by)
-            for result in rv:
-                result["campaign"] = campaign_str(result["campaign"])
-                ts = int(result["timestamp"])
-                result["timestamp_str"] = time_str (ts)
-                result["valid_at_timestamp"] = str (int(result["not_before"]) <= ts and ts <= int(result["not_after"]))
-            
-            return render_template ("chains.html", chains = rv, title = title)
+            _, rows = iter_chain_listing (sup_joins, sup_conditions, args, group_by, key, after,
+                                          limit = page_size + 1)
+            page = Page (rows, page_size, decorate_answer_chain)
+            return stream_template ("chains.html", page = page, title = title)
     else:
         abort(404)
 
@@ -295,6 +882,7 @@ def chain_by_hash(chainhash):
     return redirect (url_for ("chain_by_hash_and_number", chainhash=chainhash, pos=n))
 
 @app.route('/chains/by-hash/<chainhash>/<int:pos>')
+@cached_page
 def chain_by_hash_and_number(chainhash, pos):
     return get_chains ([], ["built_chains.chain_hash = ?", "built_chains.built_chain_number = ?"],
                        [chainhash, pos], "%s - %d" % (chainhash, pos))
@@ -312,19 +900,27 @@ def chain_by_ip(ip):
     return redirect (url_for ("chain_by_ip_and_number", ip=ip, pos=n))
 
 @app.route('/chains/by-ip/<ip>/<int:pos>')
+@cached_page
 def chain_by_ip_and_number(ip, pos):
     return get_chains (["answers on built_chains.chain_hash = answers.chain_hash"],
                        ["answers.ip = ?", "built_chains.built_chain_number = ?"],
                        [ip, pos], "%s - %d" % (ip, pos))
 
-@app.route('/chains/by-subject-in-chain/<subject>')
+@app.route('/chains/by-subject-in-chain/<path:subject>')
+@cached_page
 def chain_by_subject_in_chain(subject):
+    if has_search_index ():
+        conditions, subject_args = search_conditions (subject)
+        subject_condition = ("bldns.name in (select term from search_index where %s and kind = 'dn')" %
+                             " and ".join (conditions))
+    else:
+        subject_condition, subject_args = "bldns.name LIKE ?", ["%%%s%%" % subject]
     return get_chains(["built_links as bl on bl.chain_hash = built_chains.chain_hash "
                          "and bl.built_chain_number = built_chains.built_chain_number",
                        "certs as blc on blc.hash = bl.cert_hash",
                        "dns as bldns on bldns.hash = blc.subject_hash"],
-                      ["bldns.name LIKE ?", "built_chains.built_chain_number = ?"],
-                      ["%%%s%%" % subject, 0], subject, ["bl.chain_hash"])
+                      [subject_condition, "built_chains.built_chain_number = ?"],
+                      subject_args + [0], subject, ["bl.chain_hash"], key = "bl.chain_hash")
 
 # TODO: validite
 
@@ -367,49 +963,519 @@ def str_of_answer_type(answer):
     except:
         return "Unexpected error while processing answer description"
 
-def get_answers(conditions, args, title, offset=None, limit=None):
+def decorate_answer(answer):
+    answer["timestamp_str"] = time_str (int(answer["timestamp"]))
+    answer['type_str'] = str_of_answer_type(answer)
+
+
+# The answer type summary of a campaign is read from the
+# campaign_answer_types table computed when the database is built.
+# Older databases lack this table: the summary is then computed once
+# per campaign and kept in answer_types_cache.
+
+ANSWER_TYPE_FIELDS = ["answer_type", "version", "ciphersuite", "alert_level", "alert_type"]
+
+answer_types_cache = dict()
+
+def count_answer_types(conditions, args):
+    return query_db (ANSWER_TYPE_FIELDS + ["count(*) as count"], ["answers"], [],
+                     conditions, args, group_by = ANSWER_TYPE_FIELDS)
+
+def campaign_answer_types(cid):
+    try:
+        return query_db (ANSWER_TYPE_FIELDS + ["count"], ["campaign_answer_types"], [],
+                         ["campaign = ?"], [cid])
+    except sqlite3.OperationalError:
+        key = (app.config["DATABASE"], cid)
+        if key not in answer_types_cache:
+            answer_types_cache[key] = count_answer_types (["campaign = ?"], [cid])
+        return answer_types_cache[key]
+
+# The rest of a campaign summary (handshake versions and ciphersuites,
+# derived from its answer types, and the proportion of trusted chains)
+# also comes from tables computed when the database is built.
+
+HANDSHAKE_ANSWER_TYPES = [20, 21]
+
+def distribution(counts):
+    total = sum(counts.values())
+    rows = [(n, label, "%.1f" % (n * 100.0 / total)) for (label, n) in counts.items()]
+    rows.sort(reverse=True)
+    return rows
+
+def campaign_summary(cid, type_counts):
+    versions = dict()
+    ciphersuites = dict()
+    for row in type_counts:
+        if row["answer_type"] not in HANDSHAKE_ANSWER_TYPES:
+            continue
+        v = "SSLv2" if row["answer_type"] == 20 else tls_version (row["version"])
+        versions[v] = versions.get(v, 0) + row["count"]
+        c = row["ciphersuite"]
+        ciphersuites[c] = ciphersuites.get(c, 0) + row["count"]
+    summary = {"versions": distribution (versions),
+               "ciphersuites": distribution (ciphersuites),
+               "trust": [], "grades": []}
+    try:
+        campaigns = query_db (["answers_with_chain"], ["campaign_summaries"], [], ["campaign = ?"], [cid])
+        with_chain = campaigns[0]["answers_with_chain"] if campaigns else 0
+        trusted = query_db (["trust_flag", "count"], ["campaign_trusted_chains"], [],
+                            ["campaign = ?"], [cid], order_by = ["trust_flag"])
+        grades = query_db (["trust_flag", "grade", "count"], ["campaign_chain_grades"], [],
+                           ["campaign = ?"], [cid], order_by = ["trust_flag", "grade"])
+    except sqlite3.OperationalError:
+        return summary
+    summary["trust"] = [(t["trust_flag"], t["count"], "%.1f" % (t["count"] * 100.0 / max(with_chain, 1)))
+                        for t in trusted]
+    summary["grades"] = [(g["trust_flag"], g["grade"], g["count"]) for g in grades]
+    return summary
+
+def summarize_answer_types(type_counts):
+    types = dict()
+    for row in type_counts:
+        t = str_of_answer_type(row)
+        types[t] = types.get(t, 0) + row["count"]
+    types_list = [(n, t) for (t, n) in types.items()]
+    types_list.sort(reverse=True)
+    return sum(types.values()), types_list
+
+# Answers are listed by (ip, chain_hash), within a campaign, which is
+# also the key used to paginate them ("<ip>_<chain_hash>"). Exports list
+# every answer instead, with the best grade of its chain for the trust
+# flag (none for the answers without a chain).
+
+ANSWER_EXPORT_GRADE = ("(select min(grade) from rated_chains"
+                       " where rated_chains.chain_hash = answers.chain_hash and trust_flag = ?) as grade")
+
+def get_answers(conditions, args, title, type_counts, summary=None):
+    after, page_size = page_args()
     fields = ["answers.name as name", "ip", "port", "timestamp",
               "answers.chain_hash as chain_hash", "min(grade) as grade",
               "answer_type", "answers.version as version",
-              "ciphersuite", "alert_level", "alert_type"]
+              "ciphersuite", "alert_level", "alert_type",
+              "answers.ip || '_' || hash_hex(answers.chain_hash) as page_key"]
     tables = ["answers"]
     joins = ["rated_chains on answers.chain_hash = rated_chains.chain_hash"]
-    group_by_list = ["answers.ip", "rated_chains.chain_hash"]
-    rv = query_db (fields, tables, joins, conditions, args, group_by = group_by_list, offset=offset, limit=limit)
-    if rv:
-        for answer in rv:
-            answer["timestamp_str"] = time_str (int(answer["timestamp"]))
-            answer['type_str'] = str_of_answer_type(answer)
-
-        if len(rv) == 1:
-            return render_template ("answer.html", answer=rv[0], title=title)
-        else:
-            types = dict()
-            for answer in rv:
-                t = str_of_answer_type(answer)
-                if t in types:
-                    n = types[t][0]
-                else:
-                    n = 0
-                types[t] = (n+1, t)
-                types_list = types.values()
-                types_list.sort(reverse=True)
-            return render_template ("answers.html", answers=rv, title=title, types = types_list, total=len(rv))
-    else:
+    group_by_list = ["answers.ip", "answers.chain_hash"]
+    if after is not None:
+        if "_" not in after:
+            abort (400)
+        ip, chain_hash = after.rsplit("_", 1)
+        conditions = conditions + ["(answers.ip > ? or (answers.ip = ? and answers.chain_hash > ?))"]
+        args = args + [ip, ip, chain_hash]
+    fmt = export_format ()
+    if fmt is not None:
+        fields = [ANSWER_EXPORT_GRADE if f == "min(grade) as grade" else f for f in fields[:-1]]
+        rows = iter_db (fields, tables, [], conditions, [trust_flag] + args,
+                        order_by = group_by_list + ["answers.rowid"])
+        return export_response (fmt, rows, fields, ["timestamp_str", "type_str"], decorate_answer, title)
+    rows = iter_db (fields, tables, joins, conditions, args, group_by = group_by_list,
+                    order_by = group_by_list, limit = page_size + 1)
+    first_rows = list (itertools.islice (rows, 2))
+    if not first_rows:
+        rows.close()
         abort(404)
 
+    if len(first_rows) == 1 and after is None:
+        rows.close()
+        decorate_answer (first_rows[0])
+        return render_template ("answer.html", answer=first_rows[0], title=title)
+    else:
+        counts = type_counts()
+        total, types_list = summarize_answer_types (counts)
+        page = Page (rows, page_size, decorate_answer, head = first_rows)
+        return stream_template ("answers.html", page=page, title=title, types = types_list, total=total,
+                                summary = summary (counts) if summary else None)
+
 @app.route('/answers/<cid>')
+@cached_page
 def answer_by_campaign(cid):
-    return redirect (url_for ("answer_by_campaign_general", cid=cid, start=0, n=100))
+    return get_answers (["answers.campaign = ?"], [cid], "Answers in campaign %s" % cid,
+                        lambda: campaign_answer_types (cid),
+                        lambda counts: campaign_summary (cid, counts))
 
 @app.route('/answers/<cid>/by-ip/<ip>')
+@cached_page
 def answer_by_ip(cid, ip):
-    return get_answers (["answers.ip = ?", "answers.campaign = ?"], [ip, cid], "Answer(s) from %s in campaign %s" % (ip, cid))
+    conditions = ["answers.ip = ?", "answers.campaign = ?"]
+    return get_answers (conditions, [ip, cid], "Answer(s) from %s in campaign %s" % (ip, cid),
+                        lambda: count_answer_types (conditions, [ip, cid]))
 
 @app.route('/answers/<cid>/<int:start>/<int:n>')
 def answer_by_campaign_general(cid, start, n):
-    return get_answers (["answers.campaign = ?"], [cid], "Answers in campaign %s" % cid,
-                        offset=start, limit=n)
+    # Legacy offset-based URL: the key of the row preceding the
+    # requested one is looked up once, and the client redirected
+    if start == 0:
+        return redirect (url_for ("answer_by_campaign", cid=cid, n=n))
+    rv = query_db (["answers.ip || '_' || hash_hex(answers.chain_hash) as page_key"], ["answers"],
+                   ["rated_chains on answers.chain_hash = rated_chains.chain_hash"],
+                   ["answers.campaign = ?"], [cid],
+                   group_by = ["answers.ip", "answers.chain_hash"],
+                   order_by = ["answers.ip", "answers.chain_hash"],
+                   limit = 1, offset = start - 1)
+    if not rv:
+        abort(404)
+    return redirect (url_for ("answer_by_campaign", cid=cid, after=rv[0]["page_key"], n=n))
+
+
+# JSON API (/api/v1): batches of certificate hashes, chain hashes or
+# IPs are looked up at once, given as a JSON body ({"hashes": [...],
+# "include": [...]}, or {"ips": [...]}) or as repeated query arguments
+# (?hashes=...&hashes=...&include=names,issuers). include selects the
+# relations returned along each item.
+#
+# Each relation is fetched for the whole batch by one constant
+# statement, the keys being bound as a single JSON array read with
+# json_each (hash_arg converts them as execute_db converts hashes).
+# Answers are bounded per key (a CA certificate or a common chain can
+# appear in millions): they are numbered by key with row_number(), and
+# only the first API_RELATION_LIMIT of each key are returned.
+
+app.config.setdefault("API_MAX_BATCH", 1000)
+app.config.setdefault("API_RELATION_LIMIT", 100)
+
+API_CERTS_QUERY = """
+select certs.hash as key, version, serial,
+       subject_hash, dn_s.name as subject, issuer_hash, dn_i.name as issuer,
+       not_before, not_after, key_type, rsa_modulus, rsa_exponent, isCA
+  from certs
+  left join dns as dn_s on dn_s.hash = certs.subject_hash
+  left join dns as dn_i on dn_i.hash = certs.issuer_hash
+  where certs.hash in (select hash_arg(value) from json_each(:keys))
+"""
+
+API_CHAINS_QUERY = """
+select hash as key, position, cert_hash
+  from chains
+  where hash in (select hash_arg(value) from json_each(:keys))
+  order by hash, position
+"""
+
+API_RELATION_QUERIES = {
+    "cert_names": """
+select cert_hash as key, type, name
+  from names
+  where cert_hash in (select hash_arg(value) from json_each(:keys))
+""",
+    "cert_issuers": """
+select subject_hash as key, issuer_hash
+  from links
+  where subject_hash in (select hash_arg(value) from json_each(:keys))
+""",
+    "chain_built_chains": """
+select chain_hash as key, built_chain_number, chain_length, complete, ordered,
+       n_transvalid, n_unused, not_before, not_after, key_typesize
+  from built_chains
+  where chain_hash in (select hash_arg(value) from json_each(:keys))
+  order by chain_hash, built_chain_number
+""",
+    "chain_grades": """
+select chain_hash as key, built_chain_number, trust_flag, grade
+  from rated_chains
+  where chain_hash in (select hash_arg(value) from json_each(:keys))
+""",
+    "cert_answers": """
+select key, campaign, ip, name, chain_hash, position, timestamp
+  from (select chains.cert_hash as key, campaign, ip, name, answers.chain_hash as chain_hash,
+               position, timestamp, row_number() over (partition by chains.cert_hash) as n
+          from chains join answers on answers.chain_hash = chains.hash
+          where chains.cert_hash in (select hash_arg(value) from json_each(:keys)))
+  where n <= :limit
+""",
+    "chain_answers": """
+select key, campaign, ip, port, name, timestamp
+  from (select chain_hash as key, campaign, ip, port, name, timestamp,
+               row_number() over (partition by chain_hash) as n
+          from answers
+          where chain_hash in (select hash_arg(value) from json_each(:keys)))
+  where n <= :limit
+""",
+    "ip_answers": """
+select ip as key, campaign, port, name, timestamp, answer_type, version,
+       ciphersuite, alert_level, alert_type, chain_hash
+  from answers
+  where ip in (select value from json_each(:keys))
+  order by ip, campaign, timestamp
+""",
+    "ip_grades": """
+select answers.ip as key, rated_chains.chain_hash as chain_hash,
+       rated_chains.trust_flag as trust_flag, min(grade) as grade
+  from answers
+  join rated_chains on rated_chains.chain_hash = answers.chain_hash
+  where answers.ip in (select value from json_each(:keys))
+  group by answers.ip, rated_chains.chain_hash, rated_chains.trust_flag
+""",
+}
+
+class ApiError(Exception):
+    pass
+
+@app.errorhandler(ApiError)
+def api_error(e):
+    response = jsonify (error = str(e))
+    response.status_code = 400
+    return response
+
+def api_request(key, relations, default_relations):
+    """Returns the keys and the relations to include of an API
+    request."""
+    body = request.get_json (silent = True)
+    if body is None and request.method == "POST":
+        raise ApiError ("the request body must be JSON")
+    if body is None:
+        body = {key: request.args.getlist (key)}
+        if "include" in request.args:
+            body["include"] = request.args.get ("include").split (",")
+    if not isinstance (body, dict):
+        raise ApiError ("the request body must be a JSON object")
+    keys = body.get (key, [])
+    include = body.get ("include", default_relations)
+    if not isinstance (keys, list) or not all (isinstance (k, type(u"")) or isinstance (k, str) for k in keys):
+        raise ApiError ("%s must be a list of strings" % key)
+    if len (keys) > app.config["API_MAX_BATCH"]:
+        raise ApiError ("at most %d %s can be requested at once" % (app.config["API_MAX_BATCH"], key))
+    if not isinstance (include, list) or not set (include) <= set (relations):
+        raise ApiError ("include must be a list of relations among %s" % ", ".join (relations))
+    # Duplicates are looked up once, keeping the order of the request
+    seen = set()
+    keys = [k for k in keys if not (k in seen or seen.add (k))]
+    return keys, include
+
+def api_relation(relation, keys):
+    """Returns the rows of relation for keys, grouped by key."""
+    result = dict()
+    params = {"keys": json.dumps (keys), "limit": app.config["API_RELATION_LIMIT"]}
+    for row in execute_db (API_RELATION_QUERIES[relation], params):
+        result.setdefault (row.pop("key"), []).append (row)
+    return result
+
+def api_response(name, items, keys):
+    found = set (item["hash"] if "hash" in item else item["ip"] for item in items)
+    return jsonify ({name: items, "missing": [k for k in keys if k not in found]})
+
+CERT_API_RELATIONS = ["names", "issuers", "answers"]
+
+@app.route('/api/v1/certs', methods = ['GET', 'POST'])
+def api_certs():
+    keys, include = api_request ("hashes", CERT_API_RELATIONS, ["names", "issuers"])
+    certs = list (execute_db (API_CERTS_QUERY, {"keys": json.dumps (keys)}))
+    found = [cert["key"] for cert in certs]
+    relations = dict((r, api_relation ("cert_" + r, found)) for r in include)
+    for cert in certs:
+        cert["hash"] = cert.pop("key")
+        for r in include:
+            cert[r] = relations[r].get (cert["hash"], [])
+    if "issuers" in include:
+        for cert in certs:
+            cert["issuers"] = [link["issuer_hash"] for link in cert["issuers"]]
+    return api_response ("certs", certs, keys)
+
+CHAIN_API_RELATIONS = ["built_chains", "grades", "answers"]
+
+@app.route('/api/v1/chains', methods = ['GET', 'POST'])
+def api_chains():
+    keys, include = api_request ("hashes", CHAIN_API_RELATIONS, ["built_chains", "grades"])
+    chains = dict()
+    for row in execute_db (API_CHAINS_QUERY, {"keys": json.dumps (keys)}):
+        chains.setdefault (row["key"], []).append ({"position": row["position"], "cert_hash": row["cert_hash"]})
+    found = [k for k in keys if k in chains]
+    relations = dict((r, api_relation ("chain_" + r, found)) for r in include)
+    items = []
+    for k in found:
+        chain = {"hash": k, "certs": chains[k]}
+        for r in include:
+            chain[r] = relations[r].get (k, [])
+        items.append (chain)
+    return api_response ("chains", items, keys)
+
+IP_API_RELATIONS = ["grades"]
+
+@app.route('/api/v1/ips', methods = ['GET', 'POST'])
+def api_ips():
+    # The answers of an IP are always returned
+    keys, include = api_request ("ips", IP_API_RELATIONS, [])
+    answers = api_relation ("ip_answers", keys)
+    relations = dict((r, api_relation ("ip_" + r, keys)) for r in include)
+    items = []
+    for k in keys:
+        if k in answers:
+            ip = {"ip": k, "answers": answers[k]}
+            for r in include:
+                ip[r] = relations[r].get (k, [])
+            items.append (ip)
+    return api_response ("ips", items, keys)
+
+
+# Campaigns are compared host by host with piccolo_diff: the answers of
+# each campaign (with the best grade of their chain) are streamed in ip
+# order by DIFF_ANSWERS_QUERY and merged. The host pages only read the
+# campaigns from their after key on, until a page of hosts with
+# transitions is found.
+#
+# The summary of a comparison reads the campaigns entirely (seconds to
+# minutes): it is computed by a background thread, a single one for
+# concurrent requests of the same comparison, and kept in
+# diff_summaries (by database identity). A request waits at most
+# DIFF_WAIT seconds for it, then gets a page saying that it is being
+# computed (with Retry-After, and out of the page cache). A failed
+# comparison is not computed again for DIFF_FAILURE_TTL seconds.
+
+DIFF_ANSWERS_QUERY = """
+select ip, name, port, answer_type, version, ciphersuite, alert_level, alert_type, chain_hash,
+       (select min(grade) from rated_chains
+          where rated_chains.chain_hash = answers.chain_hash and trust_flag = :trust_flag) as grade
+  from answers
+  where campaign = :campaign and ip >= :ip
+  order by ip
+"""
+
+DIFF_TOP_VALUES = 20
+
+app.config.setdefault("DIFF_WAIT", 5)
+app.config.setdefault("DIFF_FAILURE_TTL", 300)
+
+diff_summaries = LRUCache (64)
+diff_jobs = dict()
+diff_failures = dict()
+diff_jobs_lock = threading.Lock()
+
+def diff_campaigns(campaigns):
+    try:
+        cids = [int (c) for c in campaigns.split (",")]
+    except ValueError:
+        abort (404)
+    if len (cids) < 2 or len (set (cids)) != len (cids):
+        abort (404)
+    return cids
+
+def describe_transition_state(kind, answer):
+    if answer is None:
+        return "-"
+    if kind in ["version_downgrade", "version_upgrade"]:
+        return tls_version (protocol_version (answer))
+    if kind == "chain":
+        return answer["chain_hash"]
+    if kind == "grade":
+        return answer["grade"] or "-"
+    return str_of_answer_type (answer)
+
+def diff_hosts(cids, start_ip=""):
+    """Yields (ip, name, states, transitions) for the hosts of the
+    campaigns cids, from start_ip on."""
+    streams = [execute_db (DIFF_ANSWERS_QUERY, {"campaign": cid, "ip": start_ip, "trust_flag": trust_flag})
+               for cid in cids]
+    try:
+        for ip, name, states in merge_hosts (streams):
+            yield ip, name, states, transitions (states)
+    finally:
+        for stream in streams:
+            stream.close()
+
+def diff_transition_rows(cids, host_transitions):
+    return [{"kind": kind, "from_campaign": cids[i - 1], "to_campaign": cids[i],
+             "before": describe_transition_state (kind, before),
+             "after": describe_transition_state (kind, after)}
+            for (kind, i, before, after) in host_transitions]
+
+def compute_diff_summary(cids, digest):
+    # Runs in the thread of the job of digest
+    try:
+        with app.app_context ():
+            counts = DiffSummary (len (cids), describe_transition_state)
+            for _, _, states, host_transitions in diff_hosts (cids):
+                counts.add (states, host_transitions)
+        summary = {"hosts": counts.hosts,
+                   "kinds": [(cids[i - 1], cids[i], kind, counts.kinds.get ((i, kind), 0))
+                             for i in range (1, len (cids)) for kind in TRANSITION_KINDS],
+                   "values": [(cids[i - 1], cids[i], kind, before, after, count)
+                              for (i, kind, before, after, count) in counts.top_values (DIFF_TOP_VALUES)]}
+        diff_summaries.put (digest, summary)
+    except Exception:
+        app.logger.exception ("diff %s: summary failed" % ",".join (str (c) for c in cids))
+        with diff_jobs_lock:
+            diff_failures[digest] = time.time ()
+    finally:
+        with diff_jobs_lock:
+            diff_jobs.pop (digest, None)
+
+def get_diff_summary(cids, wait):
+    """Returns the summary of the comparison of cids, or None if it is
+    still being computed after wait seconds."""
+    digest = key_digest (("diff", database_identity (), cids, trust_flag))
+    summary = diff_summaries.get (digest)
+    if summary is not None:
+        return summary
+    with diff_jobs_lock:
+        now = time.time ()
+        for d in [d for (d, t) in diff_failures.items () if t + app.config["DIFF_FAILURE_TTL"] < now]:
+            del diff_failures[d]
+        if digest in diff_failures:
+            abort (500)
+        job = diff_jobs.get (digest)
+        if job is None:
+            # The previous job may have just finished
+            summary = diff_summaries.get (digest)
+            if summary is not None:
+                return summary
+            job = threading.Thread (target=compute_diff_summary, args=(cids, digest))
+            job.daemon = True
+            diff_jobs[digest] = job
+            job.start ()
+    job.join (wait)
+    if digest in diff_failures:
+        abort (500)
+    return diff_summaries.get (digest)
+
+@app.route('/diff/<campaigns>')
+@cached_page
+def diff_summary(campaigns):
+    cids = diff_campaigns (campaigns)
+    summary = get_diff_summary (cids, app.config["DIFF_WAIT"])
+    if summary is None:
+        retry = max (app.config["DIFF_WAIT"], 1)
+        response = app.make_response ((render_template ("diff_pending.html", campaigns=campaigns,
+                                                        retry=retry), 202))
+        response.headers["Cache-Control"] = "no-store"
+        response.headers["Retry-After"] = "%d" % retry
+        return response
+    return render_template ("diff.html", campaigns=campaigns, cids=cids, kinds=TRANSITION_KINDS,
+                            hosts=zip (cids, summary["hosts"]), counts=summary["kinds"],
+                            values=summary["values"])
+
+@app.route('/diff/<campaigns>/hosts')
+@cached_page
+def diff_host_list(campaigns):
+    cids = diff_campaigns (campaigns)
+    kind = request.args.get ("kind")
+    if kind is not None and kind not in TRANSITION_KINDS:
+        abort (404)
+    after, page_size = page_args ()
+    after_host = tuple (after.split (" ", 1)) if after is not None and " " in after else None
+    def rows():
+        hosts = diff_hosts (cids, after_host[0] if after_host else "")
+        try:
+            for ip, name, states, host_transitions in hosts:
+                if after_host is not None and (ip, name) <= after_host:
+                    continue
+                if kind is not None:
+                    host_transitions = [t for t in host_transitions if t[0] == kind]
+                if host_transitions:
+                    yield {"ip": ip, "name": name, "page_key": "%s %s" % (ip, name),
+                           "transitions": diff_transition_rows (cids, host_transitions)}
+        finally:
+            hosts.close()
+    title = "Transitions between campaigns %s" % ", ".join (str (c) for c in cids)
+    fmt = export_format ()
+    if fmt is not None:
+        def transition_rows():
+            for host in rows():
+                for t in host["transitions"]:
+                    t.update (ip=host["ip"], name=host["name"])
+                    yield t
+        fields = ["ip", "name", "kind", "from_campaign", "to_campaign", "before", "after"]
+        return export_response (fmt, transition_rows (), fields, [], None, title)
+    page = Page (rows (), page_size)
+    return stream_template ("diff_hosts.html", page=page, title=title, campaigns=campaigns, kind=kind)
 
 
 def extract_name (hash, name, short = False):
@@ -422,30 +1488,59 @@ def extract_name (hash, name, short = False):
     else:
         return (re.sub (r'/([A-Z]+)=', r'\n\1=', name)[1:])
 
+# The nodes of a chain graph are the certificates sent in the chain
+# and the ones used in the built chains. Edges and roots are fetched
+# for the whole node set at once.
+
+CHAIN_GRAPH_NODES = """
+with graph_nodes(hash) as (select cert_hash from chains where hash = :chain_hash
+                           union
+                           select cert_hash from built_links where chain_hash = :chain_hash)
+"""
+
+CHAIN_GRAPH_EDGES_QUERY = CHAIN_GRAPH_NODES + """
+select issuer_hash, subject_hash from links
+  where subject_hash in graph_nodes and issuer_hash in graph_nodes
+"""
+
+CHAIN_GRAPH_ROOTS_QUERY = CHAIN_GRAPH_NODES + """
+select distinct cert_hash from roots
+  where trust_flag = :trust_flag and cert_hash in graph_nodes
+"""
+
 def make_chain_graph(chain_hash, built_chain_number=None):
-    nodes = []
-    sent_certs = []
-    built_certs = []
-    built_links = []
+    start = time.time()
+    g = build_chain_graph (chain_hash, built_chain_number)
+    built = time.time()
+    png = draw_png (g)
+    end = time.time()
+    timings = {"build": built - start, "layout": end - built}
+    app.logger.debug ("graph %s/%s: build %.3fs, layout %.3fs" %
+                      (chain_hash, built_chain_number, timings["build"], timings["layout"]))
+    return png, timings
+
+def build_chain_graph(chain_hash, built_chain_number=None):
+    nodes = set()
+    sent_certs = set()
+    built_certs = set()
+    built_links = set()
     names = dict ()
-    
+
     certs = query_db (["position", "cert_hash as hash", "name"], ["chains"],
                       ["certs on cert_hash = certs.hash", "dns on certs.subject_hash = dns.hash"],
                       ["chains.hash = ?"], [chain_hash])
     for cert in certs:
         h = cert['hash']
-        nodes.append(h)
-        if cert['position'] == 0:
-            server_cert = h
-        sent_certs.append(h)
+        nodes.add(h)
+        sent_certs.add(h)
         names[h] = extract_name (h, cert['name'])
 
-    built_links = query_db (["distinct cert_hash as hash", "name"], ["built_links"],
-                            ["certs on cert_hash = certs.hash", "dns on certs.subject_hash = dns.hash"],
-                            ["chain_hash = ?"], [chain_hash])
-    for cert in built_links:
+    built_chain_certs = query_db (["distinct cert_hash as hash", "name"], ["built_links"],
+                                  ["certs on cert_hash = certs.hash", "dns on certs.subject_hash = dns.hash"],
+                                  ["chain_hash = ?"], [chain_hash])
+    for cert in built_chain_certs:
         h = cert['hash']
-        nodes.append(h)
+        nodes.add(h)
         names[h] = extract_name (h, cert['name'])
 
 
@@ -457,27 +1552,17 @@ def make_chain_graph(chain_hash, built_chain_number=None):
         for cert in certs_to_highlight:
             h = cert['hash']
             pos = int(cert['position_in_chain'])
-            built_certs.append (h)
+            built_certs.add (h)
             built_chain[pos] = h
             last = max (last, pos)
         for i in range(last):
-            built_links.append ((built_chain[i+1], built_chain[i]))
-
-    nodes = set(nodes)
-    edges = []
-
-    for subject in nodes:
-        issuers = query_db (["issuer_hash"], ["links"], [],
-                            ["subject_hash = ?"], [subject])
-        for issuer_obj in issuers:
-            issuer = issuer_obj['issuer_hash']
-            if issuer in nodes:
-                edges.append ((issuer, subject))
+            built_links.add ((built_chain[i+1], built_chain[i]))
 
-    roots_obj = query_db (["cert_hash"], ["roots"], [], ["trust_flag = ?"], [trust_flag])
-    roots = set (filter (lambda r : r in nodes, [root_obj['cert_hash'] for root_obj in roots_obj]))
-
-    edges = set(edges)
+    params = {"chain_hash": chain_hash, "trust_flag": trust_flag}
+    edges = set ((e['issuer_hash'], e['subject_hash'])
+                 for e in execute_db (CHAIN_GRAPH_EDGES_QUERY, params)
+                 if e['issuer_hash'] in nodes and e['subject_hash'] in nodes)
+    roots = set (r['cert_hash'] for r in execute_db (CHAIN_GRAPH_ROOTS_QUERY, params))
 
     g = AGraph(directed=True)
 
@@ -508,21 +1593,206 @@ def make_chain_graph(chain_hash, built_chain_number=None):
         else:
             g.add_edge ("_%s" % a, "_%s" % b)
 
+    return g
+
+def draw_png(g):
     pngfile = tempfile.TemporaryFile()
     g.draw (path=pngfile, format="png", prog="dot")
     pngfile.seek(0)
-    return Response (pngfile.read(), mimetype="image/png")
+    return pngfile.read()
+
+
+# Rendered graphs are kept in a cache (in memory, and optionally in
+# GRAPH_CACHE_DIR), addressed by the digest of (chain_hash,
+# built_chain_number, trust_flag, database identity). This digest is
+# also the ETag sent to the clients. The identity includes the
+# generation counter of the database, since an incremental load
+# (load-db.py -a) commits to the WAL file, leaving db.sql untouched.
+
+app.config.setdefault("GRAPH_CACHE_ENTRIES", 256)
+app.config.setdefault("GRAPH_CACHE_DIR", None)
+app.config.setdefault("GRAPH_CACHE_DIR_SIZE", 256 * 1024 * 1024)
+
+graph_cache = None
+graph_legend = None
+
+def get_graph_cache():
+    global graph_cache
+    if graph_cache is None:
+        graph_cache = TieredCache (app.config["GRAPH_CACHE_ENTRIES"],
+                                   directory = app.config["GRAPH_CACHE_DIR"],
+                                   directory_max_bytes = app.config["GRAPH_CACHE_DIR_SIZE"])
+    return graph_cache
+
+# The generation is only read again when the database or its WAL file
+# changed, so that the identity of an unchanged database costs no query.
+
+database_identity_cache = None
+
+def database_identity():
+    global database_identity_cache
+    database = app.config["DATABASE"]
+    st = os.stat(database)
+    try:
+        wal = os.stat(database + "-wal")
+        wal_key = (wal.st_size, wal.st_mtime)
+    except OSError:
+        wal_key = None
+    key = (database, st.st_size, st.st_mtime, wal_key)
+    cached = database_identity_cache
+    if cached is None or cached[0] != key:
+        identity = (os.path.realpath(database), st.st_size, int(st.st_mtime),
+                    database_generation (get_db()))
+        database_identity_cache = cached = (key, identity)
+    return cached[1]
+
+# When LAYOUT_PROCESSES is not 0, the dot layout runs in a pool of
+# worker processes (see piccolo_layout). A request waits at most
+# LAYOUT_WAIT seconds for its graph, then gets a placeholder while the
+# layout goes on (the result is put in the graph cache). A graph whose
+# layout failed or exceeded LAYOUT_TIMEOUT is not laid out again for
+# LAYOUT_FAILURE_TTL seconds: an error image is sent meanwhile.
+
+app.config.setdefault("LAYOUT_PROCESSES", 2)
+app.config.setdefault("LAYOUT_QUEUE_SIZE", 16)
+app.config.setdefault("LAYOUT_TIMEOUT", 60)
+app.config.setdefault("LAYOUT_WAIT", 5)
+app.config.setdefault("LAYOUT_PROG", "dot")
+app.config.setdefault("LAYOUT_FAILURE_TTL", 600)
+
+layout_pool = None
+graph_placeholder = None
+graph_error_image = None
+
+def get_layout_pool():
+    global layout_pool
+    if layout_pool is None and app.config["LAYOUT_PROCESSES"] > 0:
+        layout_pool = LayoutPool (app.config["LAYOUT_PROCESSES"],
+                                  app.config["LAYOUT_QUEUE_SIZE"],
+                                  app.config["LAYOUT_TIMEOUT"],
+                                  app.config["LAYOUT_PROG"],
+                                  app.config["LAYOUT_FAILURE_TTL"])
+    return layout_pool
+
+def chain_graph_digest(chain_hash, built_chain_number=None):
+    return key_digest (("graph", chain_hash, built_chain_number, trust_flag, database_identity()))
+
+def chain_graph_png(chain_hash, built_chain_number=None, wait=None):
+    # Returns (png, timings): png is None when the layout is still
+    # running, and timings is None when the graph comes from the cache.
+    # Raises LayoutError when the layout recently failed
+    digest = chain_graph_digest (chain_hash, built_chain_number)
+    png = get_graph_cache().get (digest)
+    if png is not None:
+        return png, None
+
+    pool = get_layout_pool()
+    if pool is None:
+        png, timings = make_chain_graph (chain_hash, built_chain_number)
+        get_graph_cache().put (digest, png)
+        return png, timings
+
+    timings = dict()
+    job = pool.get_job (digest)
+    if job is None and pool.failed (digest):
+        raise LayoutError ("graph %s/%s: layout failed" % (chain_hash, built_chain_number))
+    if job is None:
+        start = time.time()
+        g = build_chain_graph (chain_hash, built_chain_number)
+        timings["build"] = time.time() - start
+        job = pool.submit (digest, g.string(), lambda png: get_graph_cache().put (digest, png))
+        if job is None:
+            app.logger.warning ("graph %s/%s: layout queue full" % (chain_hash, built_chain_number))
+            return None, timings
+    result = pool.wait (job, wait)
+    if result is None:
+        return None, timings
+    png, timings["layout"] = result
+    return png, timings
+
+def png_response(digest, png_fun, timings=None):
+    if digest in request.if_none_match:
+        response = Response (status=304)
+    else:
+        response = Response (png_fun(), mimetype="image/png")
+    response.set_etag (digest)
+    if timings:
+        response.headers["Server-Timing"] = ", ".join (["graph-%s;dur=%.1f" % (step, timings[step] * 1000)
+                                                        for step in ["build", "layout"] if step in timings])
+    return response
+
+def chain_graph_response(chain_hash, built_chain_number=None):
+    digest = chain_graph_digest (chain_hash, built_chain_number)
+    if digest in request.if_none_match:
+        return png_response (digest, None)
+    try:
+        png, timings = chain_graph_png (chain_hash, built_chain_number, app.config["LAYOUT_WAIT"])
+    except LayoutError:
+        response = Response (get_graph_error_image (), mimetype="image/png")
+        response.headers["Cache-Control"] = "no-store"
+        response.headers["Retry-After"] = "%d" % app.config["LAYOUT_FAILURE_TTL"]
+        return response
+    if png is None:
+        response = Response (get_graph_placeholder (), mimetype="image/png")
+        response.headers["Cache-Control"] = "no-store"
+        response.headers["Retry-After"] = "%d" % app.config["LAYOUT_WAIT"]
+        return response
+    return png_response (digest, lambda: png, timings)
+
+def get_graph_placeholder():
+    global graph_placeholder
+    if graph_placeholder is None:
+        g = AGraph(directed=True)
+        g.add_node ("placeholder", label = "Graph layout in progress,\nplease reload later", shape = "none")
+        graph_placeholder = draw_png (g)
+    return graph_placeholder
+
+def get_graph_error_image():
+    global graph_error_image
+    if graph_error_image is None:
+        g = AGraph(directed=True)
+        g.add_node ("error", label = "Graph layout failed\n(too large or too slow)", shape = "none")
+        graph_error_image = draw_png (g)
+    return graph_error_image
 
 @app.route('/graph/<chain_hash>')
 def make_chain_graph_by_hash_(chain_hash):
-    return make_chain_graph (chain_hash)
+    return chain_graph_response (chain_hash)
 
 @app.route('/graph/<chain_hash>/<int:n>')
 def make_chain_graph_by_hash_and_number(chain_hash, n):
-    return make_chain_graph (chain_hash, built_chain_number = n)
+    return chain_graph_response (chain_hash, built_chain_number = n)
+
+def warm_graph_cache(n_chains):
+    # Renders the graphs shown on the pages of the most answered chains
+    chains = query_db (["chain_hash", "count(*) as n"], ["answers"], [],
+                       ["chain_hash != ''"], group_by = ["chain_hash"],
+                       order_by = ["n DESC"], limit = n_chains)
+    for c in chains:
+        grade = query_db (["built_chain_number"], ["rated_chains"],
+                          [], ["trust_flag = ?", "chain_hash = ?"],
+                          [trust_flag, c["chain_hash"]],
+                          order_by = ["grade ASC"], limit = 1)
+        n = 0
+        if grade:
+            n = int(grade[0]['built_chain_number'])
+        try:
+            chain_graph_png (c["chain_hash"], n)
+        except LayoutError as e:
+            app.logger.warning ("graph %s/%s: %s" % (c["chain_hash"], n, e))
+    return len(chains)
 
 @app.route('/graph-legend')
 def make_chain_graph_legend ():
+    # The legend is static: it is only rendered once per process
+    global graph_legend
+    if graph_legend is None:
+        png = make_chain_graph_legend_png ()
+        graph_legend = (key_digest (("graph-legend", png)), png)
+    digest, png = graph_legend
+    return png_response (digest, lambda: png)
+
+def make_chain_graph_legend_png ():
     g = AGraph(directed=True)
 
     source = g.add_subgraph([], rank="source")
@@ -541,10 +1811,7 @@ def make_chain_graph_legend ():
     sink.add_node ("subject")
     sink.add_node("sent")
 
-    pngfile = tempfile.TemporaryFile()
-    g.draw (path=pngfile, format="png", prog="dot")
-    pngfile.seek(0)
-    return Response (pngfile.read(), mimetype="image/png")
+    return draw_png (g)
 
 
 
@@ -562,14 +1829,226 @@ def make_graph_legend():
     return make_graph_legend_image ()
 
 
+@app.route('/_stats')
+def query_statistics():
+    return jsonify (shapes = get_query_stats().snapshot())
+
+
+# The stages run by maestro.py on the data-dirs of the database, with
+# the resources they used (see OPERATIONS_COLUMNS in maestro.py).
+
+@app.route('/operations')
+@cached_page
+def operations():
+    runs = []
+    if has_table ("operations"):
+        rv = query_db (["data_dir", "run", "stage", "status", "command", "shards", "started", "finished",
+                        "wall_time", "cpu_time", "max_rss", "rows"],
+                       ["operations"], [], [], order_by=["data_dir", "run", "started", "rowid"])
+        for op in rv:
+            if not runs or (runs[-1]["data_dir"], runs[-1]["run"]) != (op["data_dir"], op["run"]):
+                runs.append ({"data_dir": op["data_dir"], "run": op["run"], "operations": [],
+                              "started": float (op["started"]), "finished": float (op["finished"]),
+                              "cpu_time": 0.0, "status": "ok"})
+            run = runs[-1]
+            run["operations"].append (op)
+            run["started"] = min (run["started"], float (op["started"]))
+            run["finished"] = max (run["finished"], float (op["finished"]))
+            run["cpu_time"] += float (op["cpu_time"])
+            if op["status"] == "failed":
+                run["status"] = "failed"
+        for run in runs:
+            run["wall_time"] = run["finished"] - run["started"]
+        runs.reverse ()
+    return render_template ("operations.html", runs=runs)
+
+
+# Statistics dashboards, over the stats_* tables of add-stats-tables.sh
+# (see piccolo_stats), read from STATS_DATABASE, from the stats-db.sql
+# file next to the database, or else from the database itself. The
+# summaries are built once for each state of this database, and kept
+# for the whole process: the pages are computed from them, without any
+# query (they are not kept in the page cache, whose keys only depend on
+# the main database).
+
+app.config.setdefault("STATS_DATABASE", None)
+
+stats_summaries = None
+
+def stats_database():
+    path = app.config["STATS_DATABASE"]
+    if path is None:
+        sibling = os.path.join (os.path.dirname (os.path.abspath (app.config["DATABASE"])), "stats-db.sql")
+        if os.path.exists (sibling):
+            path = sibling
+    return path
+
+def get_stats_summaries():
+    global stats_summaries
+    path = stats_database ()
+    if path is None:
+        key = (None, database_identity ())
+    else:
+        st = os.stat (path)
+        key = (path, st.st_size, st.st_mtime)
+    cached = stats_summaries
+    if cached is None or cached[0] != key:
+        db = connect_ro (path or app.config["DATABASE"], immutable = False)
+        try:
+            summaries = load_summaries (db)
+        finally:
+            db.close ()
+        stats_summaries = cached = (key, summaries)
+    return cached[1]
+
+@app.route('/stats')
+def stats_index():
+    summaries = get_stats_summaries ()
+    return render_template ("stats.html", summaries=summaries.values (),
+                            campaign_str=campaign_str)
+
+@app.route('/stats/<kind>')
+def stats_dashboard(kind):
+    summary = get_stats_summaries ().get (kind)
+    if summary is None:
+        abort (404)
+    flag = request.args.get ("trust_flag", "")
+    if flag not in summary.trust_flags:
+        if "trust_flag" in request.args or not summary.trust_flags:
+            abort (404)
+        flag = summary.trust_flags[0]
+    requested = request.args.get ("campaigns")
+    if requested:
+        by_str = dict ((str (c), c) for c in summary.campaigns)
+        campaigns = [by_str[c] for c in requested.split (",") if c in by_str]
+    else:
+        campaigns = summary.campaigns
+    group = request.args.get ("group")
+    if group not in STATS_KINDS[kind][4]:
+        group = None
+    rows, totals = summary.table (flag, campaigns, group)
+    return render_template ("stats_dashboard.html", summary=summary, trust_flag=flag,
+                            campaigns=campaigns, group=group, groups=STATS_KINDS[kind][4],
+                            rows=rows, totals=totals, campaign_str=campaign_str)
+
+
+# Revisions of the Mozilla certificate store (see extract-ev-certdata.py)
+
+TRUST_STORES_QUERY = """
+select revision, number, name, description,
+       (select count(*) from store_roots
+          where store_roots.certdata_hash = trust_store_revisions.certdata_hash) as roots,
+       (select count(*) from store_roots
+          where store_roots.certdata_hash = trust_store_revisions.certdata_hash
+            and server_auth = 'trusted') as trusted,
+       (select count(distinct cert_hash) from ev_roots
+          where ev_roots.ev_hash = trust_store_revisions.ev_hash) as ev
+  from trust_store_revisions
+  order by number, revision
+"""
+
+TRUST_STORE_ROOTS_QUERY = """
+select store_roots.cert_hash as cert_hash, label, server_auth, email_protection, code_signing,
+       (select group_concat(oid_name, ', ') from ev_roots
+          where ev_roots.ev_hash = trust_store_revisions.ev_hash
+            and ev_roots.cert_hash = store_roots.cert_hash) as ev,
+       exists (select 1 from certs where certs.hash = store_roots.cert_hash) as known
+  from trust_store_revisions
+  join store_roots on store_roots.certdata_hash = trust_store_revisions.certdata_hash
+  where revision = :revision
+  order by label
+"""
+
+@app.route('/trust-stores')
+@cached_page
+def trust_stores():
+    revisions = []
+    if has_table ("trust_store_revisions"):
+        revisions = list (execute_db (TRUST_STORES_QUERY))
+    return render_template ("trust_stores.html", revisions=revisions)
+
+@app.route('/trust-stores/<revision>')
+@cached_page
+def trust_store(revision):
+    if not has_table ("trust_store_revisions"):
+        abort (404)
+    rv = query_db (["revision", "number", "name", "description"], ["trust_store_revisions"], [],
+                   ["revision = ?"], [revision])
+    if not rv:
+        abort (404)
+    roots = list (execute_db (TRUST_STORE_ROOTS_QUERY, {"revision": revision}))
+    return render_template ("trust_store.html", revision=rv[0], roots=roots)
+
+
 @app.route('/')
+@cached_page
 def home():
-    rv = query_db (["distinct campaign as id", "count(ip) as n"], ["answers"], [], [], group_by=["campaign"])
+    try:
+        rv = query_db (["campaign as id", "answers as n", "ips", "first_timestamp", "last_timestamp"],
+                       ["campaign_summaries"], [], [], order_by=["campaign"])
+    except sqlite3.OperationalError:
+        # Databases built before the summary tables
+        rv = query_db (["distinct campaign as id", "count(ip) as n"], ["answers"], [], [], group_by=["campaign"])
+    for campaign in rv:
+        for ts in ["first_timestamp", "last_timestamp"]:
+            if campaign.get (ts) is not None:
+                campaign[ts + "_str"] = time_str (int(campaign[ts]))
     return render_template ("home.html", campaigns=rv)
 
 
+def create_app(database=None, **config):
+    """Returns the piccolo application serving database, e.g. for a
+    WSGI server: gunicorn -w 4 'piccolo:create_app("db.sql")'.
+    The database can also be given using the PICCOLO_DATABASE
+    environment variable."""
+    global db_pool, query_stats, database_schema, transitive_links_mode, pack_store, search_index_available
+    global page_cache, database_identity_cache, database_tables, stats_summaries
+    if database is not None:
+        app.config["DATABASE"] = database
+    app.config.update(config)
+    if app.config["DATABASE"] is None:
+        raise ValueError("piccolo: no database given")
+    db_pool = None
+    query_stats = None
+    database_schema = None
+    transitive_links_mode = None
+    pack_store = None
+    search_index_available = None
+    page_cache = None
+    database_identity_cache = None
+    database_tables = None
+    stats_summaries = None
+    return app
+
+
+def usage():
+    print ("Usage: piccolo.py [--graph-cache-dir DIR] [--page-cache-dir DIR] [--stats-database STATS_DB]\n"
+           "                  [--warm-graphs N] DATABASE [HOST]")
+    sys.exit (1)
+
 if __name__ == '__main__':
-    if len (sys.argv) == 3:
-        app.run(debug=True, host=sys.argv[2])
+    try:
+        opts, args = getopt.getopt (sys.argv[1:], "", ["graph-cache-dir=", "page-cache-dir=", "stats-database=",
+                                                           "warm-graphs="])
+    except getopt.GetoptError:
+        usage ()
+    if len (args) not in [1, 2]:
+        usage ()
+    create_app (args[0])
+    warm_graphs = 0
+    for (o, v) in opts:
+        if o == "--graph-cache-dir":
+            app.config["GRAPH_CACHE_DIR"] = v
+        elif o == "--page-cache-dir":
+            app.config["PAGE_CACHE_DIR"] = v
+        elif o == "--stats-database":
+            app.config["STATS_DATABASE"] = v
+        elif o == "--warm-graphs":
+            warm_graphs = int(v)
+    if warm_graphs > 0:
+        with app.app_context():
+            print ("%d chain graphs rendered" % warm_graph_cache (warm_graphs))
+    if len (args) == 2:
+        app.run(debug=True, threaded=True, host=args[1])
     else:
-        app.run(debug=True)
+        app.run(debug=True, threaded=True)
@@ -0,0 +1,293 @@
+"""
+Route-level latency measurement for piccolo: one sample URL per route
+is derived from the contents of a database, and each URL is requested
+several times through Flask's test client.
+
+For load tests (bench-routes.py), a weighted mix of routes is replayed
+by concurrent clients, with URLs drawn from answers sampled uniformly,
+so that chains, certificates and IPs are requested as often as they
+are answered.
+"""
+
+import math
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from piccolo_db import schema_kind, from_db, compact_args
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+
+# (label, URL pattern) for every route; patterns are filled with the
+# values returned by sample_values, and routes needing a value absent
+# from the database are skipped
+ROUTES = [
+    ("/", "/"),
+    ("/certs/<certhash> (leaf)", "/certs/%(leaf)s"),
+    ("/certs/<certhash> (CA)", "/certs/%(ca)s"),
+    ("/certs/by-subject/<subject>", "/certs/by-subject/%(subject)s"),
+    ("/certs/by-subject-hash/<subject_hash>", "/certs/by-subject-hash/%(subject_hash)s"),
+    ("/certs/by-https-name/<name>", "/certs/by-https-name/%(name)s"),
+    ("/certs/by-https-name/<type>/<name>", "/certs/by-https-name/%(name_type)s/%(name)s"),
+    ("/certs/by-exact-https-name/<name>", "/certs/by-exact-https-name/%(name)s"),
+    ("/certs/by-exact-https-name/<type>/<name>", "/certs/by-exact-https-name/%(name_type)s/%(name)s"),
+    ("/chains/by-hash/<chainhash>", "/chains/by-hash/%(chain)s"),
+    ("/chains/by-hash/<chainhash>/<pos>", "/chains/by-hash/%(chain)s/0"),
+    ("/chains/by-ip/<ip>", "/chains/by-ip/%(ip)s"),
+    ("/chains/by-ip/<ip>/<pos>", "/chains/by-ip/%(ip)s/0"),
+    ("/chains/by-subject-in-chain/<subject>", "/chains/by-subject-in-chain/%(ca_subject)s"),
+    ("/answers/<cid>", "/answers/%(campaign)s"),
+    ("/answers/<cid>/by-ip/<ip>", "/answers/%(campaign)s/by-ip/%(ip)s"),
+    ("/answers/<cid>/<start>/<n>", "/answers/%(campaign)s/100/100"),
+    ("/graph/<chain_hash>", "/graph/%(chain)s"),
+]
+
+
+def sample_values(db):
+    """Returns a dict of values to build the route URLs from: an
+    answer (campaign, ip, chain), a leaf certificate, the CA issuing
+    the most certificates, their subjects and a certificate name."""
+    values = dict()
+    compact = schema_kind(db) == "compact"
+    cur = db.cursor()
+    cur.row_factory = None
+
+    def fetch(query, names, args=()):
+        if compact:
+            args = compact_args(args)
+        row = cur.execute(query, args).fetchone()
+        if row is not None:
+            for name, value in zip(names, row):
+                if value is not None:
+                    values[name] = quote(str(from_db(value)), safe="")
+
+    fetch("select campaign, ip, chain_hash from answers where chain_hash != '' limit 1",
+          ["campaign", "ip", "chain"])
+    fetch("select hash, subject_hash from certs where isCA = 0 limit 1", ["leaf", "subject_hash"])
+    fetch("select issuer_hash from links where issuer_hash != subject_hash "
+          "group by issuer_hash order by count(*) desc limit 1", ["ca"])
+    fetch("select type, name from names limit 1", ["name_type", "name"])
+    if "subject_hash" in values:
+        fetch("select name from dns where hash = ?", ["subject"], [values["subject_hash"]])
+    if "ca" in values:
+        fetch("select dns.name from certs join dns on certs.subject_hash = dns.hash "
+              "where certs.hash = ?", ["ca_subject"], [values["ca"]])
+    return values
+
+
+def sample_routes(db):
+    """Returns the list of (label, url) that can be measured on db."""
+    values = sample_values(db)
+    routes = []
+    for label, pattern in ROUTES:
+        try:
+            routes.append((label, pattern % values))
+        except KeyError:
+            pass
+    return routes
+
+
+# The configuration disabling the page cache, without which every
+# request of a URL but the first would only measure a cache hit
+NO_PAGE_CACHE = {"PAGE_CACHE_ENTRIES": 0, "PAGE_CACHE_DIR": None}
+
+
+def measure_routes(app, routes, repeat):
+    """Requests each URL repeat times, and returns an OrderedDict
+    mapping labels to (status, median_ms, max_ms). The app should be
+    created with NO_PAGE_CACHE."""
+    client = app.test_client()
+    results = OrderedDict()
+    for label, url in routes:
+        timings = []
+        for _ in range(repeat):
+            start = time.time()
+            response = client.get(url)
+            # Streamed pages are only generated when read
+            response.get_data()
+            timings.append(time.time() - start)
+            response.close()
+        timings.sort()
+        results[label] = (response.status_code, timings[len(timings) // 2] * 1000, timings[-1] * 1000)
+    return results
+
+
+# (name, weight, URL pattern) of the routes replayed by bench-routes.py,
+# the patterns being filled with the values derived from an answer
+ROUTE_MIX = [
+    ("home", 1, "/"),
+    ("cert", 20, "/certs/%(leaf)s"),
+    ("ca", 4, "/certs/%(ca)s"),
+    ("chain", 15, "/chains/by-hash/%(chain)s/0"),
+    ("chains-by-ip", 15, "/chains/by-ip/%(ip)s/0"),
+    ("answers", 3, "/answers/%(campaign)s"),
+    ("answers-by-ip", 10, "/answers/%(campaign)s/by-ip/%(ip)s"),
+    ("https-name", 5, "/certs/by-https-name/%(name)s"),
+    ("search", 2, "/search?q=%(domain)s"),
+    ("graph", 10, "/graph/%(chain)s"),
+]
+
+SAMPLE_BATCH = 500
+
+
+def sample_answers(db, size, seed=0):
+    """Returns up to size dicts of values (campaign, ip, chain, leaf,
+    ca, name, domain) derived from answers with a chain, drawn
+    uniformly by rowid."""
+    rnd = random.Random(seed)
+    compact = schema_kind(db) == "compact"
+    cur = db.cursor()
+    cur.row_factory = None
+
+    def fetch(query, args):
+        if compact:
+            args = compact_args(args)
+        row = cur.execute(query, args).fetchone()
+        return None if row is None else [str(from_db(v)) for v in row]
+
+    max_rowid = cur.execute("select max(rowid) from answers").fetchone()[0] or 0
+    samples = []
+    for _ in range(4):
+        if len(samples) >= size or max_rowid == 0:
+            break
+        rowids = [rnd.randint(1, max_rowid) for _ in range(2 * (size - len(samples)))]
+        for i in range(0, len(rowids), SAMPLE_BATCH):
+            batch = rowids[i:i + SAMPLE_BATCH]
+            query = ("select campaign, ip, chain_hash from answers "
+                     "where rowid in (%s) and chain_hash != ''" % ", ".join("?" * len(batch)))
+            for row in cur.execute(query, batch).fetchall():
+                samples.append(dict(zip(["campaign", "ip", "chain"], [str(from_db(v)) for v in row])))
+    samples = samples[:size]
+
+    for sample in samples:
+        leaf = fetch("select cert_hash from chains where hash = ? and position = 0", [sample["chain"]])
+        if leaf is None:
+            continue
+        sample["leaf"] = leaf[0]
+        ca = fetch("select issuer_hash from links where subject_hash = ? "
+                   "and issuer_hash != subject_hash limit 1", [leaf[0]])
+        if ca is not None:
+            sample["ca"] = ca[0]
+        name = fetch("select name from names where cert_hash = ? limit 1", [leaf[0]])
+        if name is not None:
+            sample["name"] = name[0]
+            labels = name[0].lstrip("*.").split(".")
+            sample["domain"] = max(labels, key=len)
+    for sample in samples:
+        for key, value in list(sample.items()):
+            sample[key] = quote(value, safe="")
+    return samples
+
+
+def route_requests(samples, mix, n, seed=0):
+    """Returns n (name, url) drawn from mix, routes whose pattern
+    cannot be filled by any sample being left out."""
+    rnd = random.Random(seed)
+    urls = dict()
+    for name, weight, pattern in mix:
+        candidates = []
+        for sample in samples:
+            try:
+                candidates.append(pattern % sample)
+            except KeyError:
+                pass
+        if candidates and weight > 0:
+            urls[name] = (weight, candidates)
+    names = sorted(urls)
+    total = sum(urls[name][0] for name in names)
+    requests = []
+    for _ in range(n):
+        x = rnd.uniform(0, total)
+        for name in names:
+            x -= urls[name][0]
+            if x <= 0:
+                break
+        requests.append((name, rnd.choice(urls[name][1])))
+    return requests
+
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+def replay(app, requests, concurrency):
+    """Sends the (name, url) requests with concurrency threads, each
+    using its own test client, and returns the list of (name, status,
+    seconds) in completion order, with the elapsed time."""
+    results = []
+    lock = threading.Lock()
+    pending = iter(requests)
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                request = next(pending, None)
+            if request is None:
+                return
+            name, url = request
+            start = timer()
+            response = client.get(url)
+            response.get_data()
+            elapsed = timer() - start
+            response.close()
+            with lock:
+                results.append((name, response.status_code, elapsed))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, timer() - start
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(math.ceil(p * len(sorted_values) / 100.0)) - 1))
+    return sorted_values[rank]
+
+
+def latency_summary(results):
+    """Returns an OrderedDict mapping each route name (and "all") to
+    its count, errors (status >= 400), p50, p95, p99 and max in ms."""
+    by_name = OrderedDict()
+    for name, status, elapsed in sorted(results, key=lambda r: r[0]):
+        by_name.setdefault(name, []).append((elapsed, status))
+    by_name["all"] = [(elapsed, status) for _, status, elapsed in results]
+    summary = OrderedDict()
+    for name, values in by_name.items():
+        timings = sorted(elapsed * 1000 for elapsed, _ in values)
+        summary[name] = OrderedDict([
+            ("count", len(values)),
+            ("errors", sum(1 for _, status in values if status >= 400)),
+            ("p50", percentile(timings, 50)),
+            ("p95", percentile(timings, 95)),
+            ("p99", percentile(timings, 99)),
+            ("max", timings[-1])])
+    return summary
+
+
+def peak_rss_kb():
+    """Returns the peak resident set size of the process and of its
+    (waited for) children, in kB, or None where it is not available."""
+    if resource is None:
+        return None
+    usage = [resource.getrusage(who).ru_maxrss
+             for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    if sys.platform == "darwin":
+        usage = [u // 1024 for u in usage]
+    return tuple(usage)
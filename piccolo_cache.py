@@ -0,0 +1,153 @@
+"""
+Caches used by piccolo to keep rendered results (graphs, pages).
+
+Entries are addressed by the SHA-1 digest of their key, which is also
+used as the ETag of the corresponding responses. A TieredCache keeps
+the most recently used entries in memory (LRUCache) and, optionally,
+every entry in a size-capped directory (DiskCache) that can be shared
+by several processes.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def key_digest(key):
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+
+class LRUCache(object):
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, digest):
+        with self.lock:
+            value = self.entries.pop(digest, None)
+            if value is not None:
+                self.entries[digest] = value
+            return value
+
+    def put(self, digest, value):
+        with self.lock:
+            old_value = self.entries.pop(digest, None)
+            if old_value is not None:
+                self.size -= len(old_value)
+            self.entries[digest] = value
+            self.size += len(value)
+            while self.entries and (len(self.entries) > self.max_entries or
+                                    (self.max_bytes is not None and self.size > self.max_bytes)):
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class DiskCache(object):
+    """Stores each entry in <directory>/<digest[:2]>/<digest>. Files are
+    written atomically (temporary file + rename), so concurrent
+    processes may share a directory. When the directory grows beyond
+    max_bytes, the least recently used files are removed (but not the
+    temporary files being written). A failed write is ignored."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = sum(size for (_, _, size) in self._list_files())
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _list_files(self):
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith(".tmp-"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield (st.st_mtime, path, st.st_size)
+
+    def get(self, digest):
+        path = self._path(digest)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path, None)
+            return value
+        except (IOError, OSError):
+            return None
+
+    def put(self, digest, value):
+        path = self._path(digest)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(value)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return
+        with self.lock:
+            self.size += len(value) - old_size
+            if self.size > self.max_bytes:
+                self._trim()
+
+    def _trim(self):
+        # The directory may be shared: its real size is recomputed
+        # before evicting anything
+        files = sorted(self._list_files())
+        self.size = sum(size for (_, _, size) in files)
+        target = self.max_bytes * 3 // 4
+        for (_, path, size) in files:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+
+class TieredCache(object):
+    def __init__(self, max_entries, max_bytes=None, directory=None, directory_max_bytes=None):
+        self.memory = LRUCache(max_entries, max_bytes)
+        if directory is None:
+            self.disk = None
+        else:
+            self.disk = DiskCache(directory, directory_max_bytes)
+
+    def get(self, digest):
+        value = self.memory.get(digest)
+        if value is None and self.disk is not None:
+            value = self.disk.get(digest)
+            if value is not None:
+                self.memory.put(digest, value)
+        return value
+
+    def put(self, digest, value):
+        self.memory.put(digest, value)
+        if self.disk is not None:
+            self.disk.put(digest, value)
@@ -0,0 +1,229 @@
+"""
+Database access layer of piccolo: a pool of long-lived read-only
+SQLite connections, reused across requests, the instrumentation of the
+queries run through them, and the conversion of the values stored in
+compact databases (see db-compact.txt).
+"""
+
+import binascii
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from urllib import pathname2url
+except ImportError:
+    from urllib.request import pathname2url
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+try:
+    BLOB_TYPES = (buffer, bytearray)
+    STRING_TYPES = (str, unicode)
+except NameError:
+    BLOB_TYPES = (bytes, bytearray, memoryview)
+    STRING_TYPES = (str,)
+
+
+def connect_ro(path, immutable=True, cache_size_kib=None, mmap_size=None, cached_statements=256):
+    """Opens path in read-only mode. immutable tells sqlite the file
+    will not change while it is open, which avoids any locking, but
+    must not be used if the database may be updated while served."""
+    uri = "file:%s?mode=ro" % pathname2url(os.path.abspath(path))
+    if immutable:
+        uri += "&immutable=1"
+    try:
+        db = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                             cached_statements=cached_statements)
+    except TypeError:
+        # Python 2's sqlite3 module does not handle URIs
+        db = sqlite3.connect(path, check_same_thread=False,
+                             cached_statements=cached_statements)
+        db.execute("pragma query_only = 1")
+    if cache_size_kib is not None:
+        db.execute("pragma cache_size = -%d" % cache_size_kib)
+    if mmap_size is not None:
+        db.execute("pragma mmap_size = %d" % mmap_size)
+    return db
+
+
+class ConnectionPool(object):
+    """Keeps up to size idle connections. Connections are created on
+    demand when none is available, and the pool is emptied after a
+    fork, since sqlite connections must not cross processes."""
+
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.idle = Queue(size)
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.idle = Queue(self.size)
+                    self.pid = os.getpid()
+
+    def acquire(self):
+        self._check_pid()
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            return self.connect()
+
+    def release(self, db):
+        if self.pid != os.getpid():
+            return
+        try:
+            self.idle.put_nowait(db)
+        except Full:
+            db.close()
+
+
+class QueryStats(object):
+    """Per query shape (i.e. SQL text, the parameters being bound
+    separately) statistics: number of executions, time spent fetching
+    rows, number of rows, and the query plan, captured with EXPLAIN
+    QUERY PLAN the first time the shape is seen. At most max_shapes
+    shapes are kept (the least recently used ones are forgotten)."""
+
+    def __init__(self, max_shapes=512, slow_query_threshold=None, slow_query_logger=None):
+        self.max_shapes = max_shapes
+        self.slow_query_threshold = slow_query_threshold
+        self.slow_query_logger = slow_query_logger
+        self.shapes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def execute(self, db, query, args):
+        """Runs query on db and yields its rows, recording the time
+        spent in sqlite (the time spent by the caller between two rows
+        is not accounted for)."""
+        start = time.time()
+        duration = 0.0
+        n_rows = 0
+        cur = db.execute(query, args)
+        try:
+            while True:
+                try:
+                    row = next(cur)
+                except StopIteration:
+                    break
+                duration += time.time() - start
+                n_rows += 1
+                yield row
+                start = time.time()
+            duration += time.time() - start
+        finally:
+            cur.close()
+            self.record(db, query, args, duration, n_rows)
+
+    def record(self, db, query, args, duration, n_rows):
+        with self.lock:
+            shape = self.shapes.pop(query, None)
+            if shape is None:
+                shape = {"query": " ".join(query.split()), "count": 0, "rows": 0,
+                         "total_time": 0.0, "max_time": 0.0, "plan": None}
+            self.shapes[query] = shape
+            while len(self.shapes) > self.max_shapes:
+                self.shapes.popitem(last=False)
+            shape["count"] += 1
+            shape["rows"] += n_rows
+            shape["total_time"] += duration
+            shape["max_time"] = max(shape["max_time"], duration)
+            new_shape = shape["plan"] is None
+            if new_shape:
+                shape["plan"] = []
+
+        if new_shape:
+            shape["plan"] = explain(db, query, args)
+        if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+            if self.slow_query_logger is not None:
+                self.slow_query_logger.warning("slow query (%.1f ms, %d rows): %s %r\n  plan: %s" %
+                                               (duration * 1000, n_rows, shape["query"], list(args),
+                                                "; ".join(shape["plan"])))
+
+    def snapshot(self):
+        with self.lock:
+            shapes = [dict(s) for s in self.shapes.values()]
+        for s in shapes:
+            s["mean_time"] = s["total_time"] / s["count"]
+            s["full_scans"] = full_scans(s["plan"] or [])
+        shapes.sort(key=lambda s: s["total_time"], reverse=True)
+        return shapes
+
+
+def explain(db, query, args):
+    cur = db.cursor()
+    cur.row_factory = None
+    try:
+        return [row[-1] for row in cur.execute("explain query plan " + query, args)]
+    except sqlite3.Error as e:
+        return ["(no plan: %s)" % e]
+    finally:
+        cur.close()
+
+
+def full_scans(plan):
+    """Returns the plan steps reading a whole table (SCAN steps not
+    using an index)."""
+    return [step for step in plan
+            if step.startswith("SCAN") and "INDEX" not in step
+            and "CONSTANT ROW" not in step and "SUBQUERY" not in step]
+
+
+# Compact databases store hashes as blobs, while piccolo shows them,
+# and receives them in URLs, as hexadecimal strings: blobs read are
+# converted to hex (from_db, also usable as a SQL function), and the
+# hex hashes given as parameters are converted to blobs (compact_args).
+
+HEX_HASH_RE = re.compile("^[0-9a-fA-F]{40}$")
+
+
+def schema_kind(db):
+    """Returns "compact" for databases built with db-compact.txt, and
+    "text" for the ones built with db.txt."""
+    try:
+        row = db.execute("select value from concerto_meta where key = 'schema'").fetchone()
+    except sqlite3.OperationalError:
+        return "text"
+    if row is None:
+        return "text"
+    return row["value"] if isinstance(row, dict) else row[0]
+
+
+def database_generation(db):
+    """Returns the generation counter incremented by load-db.py at
+    each load of the database (0 for databases built otherwise)."""
+    try:
+        row = db.execute("select value from concerto_meta where key = 'generation'").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    if row is None:
+        return 0
+    return int(row["value"] if isinstance(row, dict) else row[0])
+
+
+def from_db(value):
+    if isinstance(value, BLOB_TYPES):
+        return binascii.hexlify(value).decode("ascii")
+    return value
+
+
+def to_compact(value):
+    if isinstance(value, STRING_TYPES) and HEX_HASH_RE.match(value):
+        return sqlite3.Binary(binascii.unhexlify(value))
+    return value
+
+
+def compact_args(args):
+    if isinstance(args, dict):
+        return dict((k, to_compact(v)) for (k, v) in args.items())
+    return [to_compact(a) for a in args]
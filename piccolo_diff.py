@@ -0,0 +1,123 @@
+"""
+Comparison of the answers of the same hosts across campaigns.
+
+A host is an (ip, name) pair. The answers of each campaign are read in
+ip order (using the answers (campaign, ip, ...) index), and the
+streams are merged on the ip, as in a sort-merge join: the answers of
+one ip are grouped by name in memory, so the memory used only depends
+on the number of answers of a single ip. When a host has several
+answers in a campaign (e.g. on several ports), the one on the lowest
+port is kept.
+
+Each host then yields a transition for each difference between two
+consecutive campaigns: it appeared or disappeared, its answer type
+changed, its protocol version went down or up (between handshakes),
+its certificate chain changed, or the best grade of its chain did.
+"""
+
+HANDSHAKE_TYPES = (20, 21)
+
+TRANSITION_KINDS = ["appeared", "disappeared", "answer_type",
+                    "version_downgrade", "version_upgrade", "chain", "grade"]
+
+
+def _groups_by_ip(rows):
+    """Yields (ip, rows) for each run of rows with the same ip."""
+    ip, group = None, []
+    for row in rows:
+        if row["ip"] != ip and group:
+            yield ip, group
+            group = []
+        ip = row["ip"]
+        group.append(row)
+    if group:
+        yield ip, group
+
+
+def merge_hosts(streams):
+    """Merges streams of answers sorted by ip (one per campaign), and
+    yields (ip, name, states) in (ip, name) order, states holding the
+    answer of the host in each campaign (or None)."""
+    groups = [_groups_by_ip(s) for s in streams]
+    heads = [next(g, None) for g in groups]
+    while any(h is not None for h in heads):
+        ip = min(h[0] for h in heads if h is not None)
+        hosts = dict()
+        for i, head in enumerate(heads):
+            if head is None or head[0] != ip:
+                continue
+            for row in head[1]:
+                states = hosts.setdefault(row["name"], [None] * len(streams))
+                if states[i] is None or row["port"] < states[i]["port"]:
+                    states[i] = row
+            heads[i] = next(groups[i], None)
+        for name in sorted(hosts):
+            yield ip, name, hosts[name]
+
+
+def protocol_version(answer):
+    if answer["answer_type"] == 20:
+        return 2
+    return answer["version"]
+
+
+def transitions(states):
+    """Returns the (kind, i, before, after) differences between the
+    states i - 1 and i of a host."""
+    result = []
+    for i in range(1, len(states)):
+        before, after = states[i - 1], states[i]
+        if before is None and after is None:
+            continue
+        if before is None:
+            result.append(("appeared", i, None, after))
+            continue
+        if after is None:
+            result.append(("disappeared", i, before, None))
+            continue
+        if before["answer_type"] != after["answer_type"]:
+            result.append(("answer_type", i, before, after))
+        if before["answer_type"] in HANDSHAKE_TYPES and after["answer_type"] in HANDSHAKE_TYPES:
+            v_before, v_after = protocol_version(before), protocol_version(after)
+            if v_after < v_before:
+                result.append(("version_downgrade", i, before, after))
+            elif v_after > v_before:
+                result.append(("version_upgrade", i, before, after))
+        if before["chain_hash"] and after["chain_hash"] and before["chain_hash"] != after["chain_hash"]:
+            result.append(("chain", i, before, after))
+        if before["grade"] != after["grade"] and (before["grade"] or after["grade"]):
+            result.append(("grade", i, before, after))
+    return result
+
+
+class DiffSummary(object):
+    """Counts the hosts compared and the transitions between each pair
+    of consecutive campaigns, by kind and by (before, after) values as
+    given by describe(kind, answer)."""
+
+    def __init__(self, n_campaigns, describe):
+        self.describe = describe
+        self.hosts = [0] * n_campaigns
+        self.kinds = dict()
+        self.values = dict()
+
+    def add(self, states, host_transitions):
+        for i, state in enumerate(states):
+            if state is not None:
+                self.hosts[i] += 1
+        for kind, i, before, after in host_transitions:
+            self.kinds[(i, kind)] = self.kinds.get((i, kind), 0) + 1
+            key = (i, kind, self.describe(kind, before), self.describe(kind, after))
+            self.values[key] = self.values.get(key, 0) + 1
+
+    def top_values(self, n):
+        """Returns the n most frequent (i, kind, before, after, count)
+        for each kind."""
+        by_kind = dict()
+        for (i, kind, before, after), count in self.values.items():
+            by_kind.setdefault(kind, []).append((count, i, before, after))
+        result = []
+        for kind in TRANSITION_KINDS:
+            for count, i, before, after in sorted(by_kind.get(kind, []), reverse=True)[:n]:
+                result.append((i, kind, before, after, count))
+        return result
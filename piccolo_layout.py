@@ -0,0 +1,115 @@
+"""
+Pool of worker processes running the Graphviz layout of piccolo's
+graphs, so that a large graph does not block a request thread.
+
+Jobs are identified by a digest: concurrent requests for the same
+graph share a single job. The number of pending jobs is bounded
+(submit returns None when the queue is full) and each dot process is
+killed after a per-job timeout. A job which failed or timed out is
+remembered for failure_ttl seconds, during which its graph is not laid
+out again.
+"""
+
+import multiprocessing
+import subprocess
+import threading
+import time
+
+
+class LayoutError(Exception):
+    pass
+
+
+def layout_png(dot_source, prog, timeout):
+    # Runs in a worker process
+    start = time.time()
+    proc = subprocess.Popen([prog, "-Tpng"], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+    try:
+        png, err = proc.communicate(dot_source)
+    finally:
+        timer.cancel()
+    if proc.returncode != 0:
+        raise LayoutError("%s exited with code %d: %s" % (prog, proc.returncode, err))
+    return png, time.time() - start
+
+
+class LayoutPool(object):
+    def __init__(self, processes, max_queue, timeout, prog="dot", failure_ttl=600):
+        self.pool = multiprocessing.Pool(processes)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.prog = prog
+        self.failure_ttl = failure_ttl
+        self.jobs = dict()
+        self.failures = dict()
+        self.lock = threading.Lock()
+
+    def _collect_failures(self):
+        # Moves the failed jobs to failures, and forgets the failures
+        # older than failure_ttl (called with the lock held)
+        now = time.time()
+        for d in [d for (d, j) in self.jobs.items() if j.ready() and not j.successful()]:
+            del self.jobs[d]
+            self.failures[d] = now
+        for d in [d for (d, t) in self.failures.items() if t + self.failure_ttl < now]:
+            del self.failures[d]
+
+    def failed(self, digest):
+        """Tells whether the layout of digest failed less than
+        failure_ttl seconds ago."""
+        with self.lock:
+            self._collect_failures()
+            return digest in self.failures
+
+    def get_job(self, digest):
+        with self.lock:
+            self._collect_failures()
+            return self.jobs.get(digest)
+
+    def submit(self, digest, dot_source, callback=None):
+        """Returns the job computing the layout of dot_source, or None if
+        too many jobs are already pending or if it recently failed.
+        callback is called with the PNG contents once the layout is
+        done."""
+
+        def on_success(result):
+            # The job is only forgotten once callback stored the PNG, so
+            # that a concurrent request finds one or the other
+            with self.lock:
+                try:
+                    if callback is not None:
+                        callback(result[0])
+                finally:
+                    self.jobs.pop(digest, None)
+
+        if not isinstance(dot_source, bytes):
+            dot_source = dot_source.encode("utf-8")
+        with self.lock:
+            self._collect_failures()
+            job = self.jobs.get(digest)
+            if job is not None:
+                return job
+            if digest in self.failures or len(self.jobs) >= self.max_queue:
+                return None
+            job = self.pool.apply_async(layout_png, (dot_source, self.prog, self.timeout),
+                                        callback=on_success)
+            self.jobs[digest] = job
+            return job
+
+    def wait(self, job, timeout):
+        """Returns (png, layout_duration) if the job completes within
+        timeout seconds (None meaning no limit), or None otherwise.
+        Raises LayoutError if the job failed."""
+        job.wait(timeout)
+        if not job.ready():
+            return None
+        if not job.successful():
+            raise LayoutError("layout failed or timed out")
+        return job.get()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
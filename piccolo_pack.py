@@ -0,0 +1,244 @@
+"""
+Read access to the binary files of a data-dir: raw/<filetype>/<prefix>.pack
+files, written by fileOps.ml, where each record is a 2-byte name length,
+the name, a 4-byte contents length and the contents (big-endian), the
+prefix being the first two characters of the name.
+
+A PackStore keeps the position of every record in raw/<filetype>.index
+(as described in the TODO), so that packs are only scanned once: when
+a pack has grown since it was indexed, only the new records are read,
+and a pack which shrank (i.e. was rewritten) is scanned again. Packs
+are memory-mapped, and records are returned as memoryview slices of
+the mappings (buffer objects under Python 2), without copying them.
+
+The index file starts with INDEX_MAGIC; then, for each pack, comes a
+header (2-byte prefix length, prefix, 8-byte indexed size of the pack,
+4-byte number of records) followed by its records (2-byte name length,
+name, 8-byte offset of the contents, 4-byte contents length).
+
+Usage (to build or update the index): python piccolo_pack.py DATA_DIR [FILETYPE]
+"""
+
+from __future__ import print_function
+
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+
+INDEX_MAGIC = b"concerto pack index 1\n"
+
+NAME_LEN = struct.Struct(">H")
+CONTENTS_LEN = struct.Struct(">I")
+PACK_HEADER = struct.Struct(">QI")
+RECORD = struct.Struct(">QI")
+
+try:
+    memoryview(mmap.mmap(-1, 1))
+    def _slice(mapping, offset, length):
+        return memoryview(mapping)[offset:offset + length]
+except TypeError:
+    # Python 2's mmap objects only support the old buffer interface
+    def _slice(mapping, offset, length):
+        return buffer(mapping, offset, length)
+
+
+def prefix_of(name):
+    return name[:2] if len(name) >= 2 else "_"
+
+
+def _decode(name):
+    # Names are hashes in hex, but any byte is kept
+    return name.decode("latin-1")
+
+
+def _encode(name):
+    return name.encode("latin-1")
+
+
+def pack_record(name, contents):
+    """Returns a record, as fileOps.ml writes it in a pack."""
+    n = _encode(name)
+    return NAME_LEN.pack(len(n)) + n + CONTENTS_LEN.pack(len(contents)) + contents
+
+
+def scan_pack(f, start, end):
+    """Yields the (name, offset, length) of the records of the pack f
+    between start and end, and finally the position following the
+    last complete record (a record being written is ignored)."""
+    f.seek(start)
+    pos = start
+    while pos + NAME_LEN.size <= end:
+        name_len, = NAME_LEN.unpack(f.read(NAME_LEN.size))
+        header_end = pos + NAME_LEN.size + name_len + CONTENTS_LEN.size
+        if header_end > end:
+            break
+        name = f.read(name_len)
+        length, = CONTENTS_LEN.unpack(f.read(CONTENTS_LEN.size))
+        if header_end + length > end:
+            break
+        yield _decode(name), header_end, length
+        pos = header_end + length
+        f.seek(pos)
+    yield pos
+
+
+class Pack(object):
+    def __init__(self, path):
+        self.path = path
+        self.indexed_size = 0
+        self.records = dict()
+        self.mapping = None
+        self.mapped_size = 0
+
+    def update(self):
+        """Indexes the records appended since the last update (or the
+        whole pack if it shrank), and returns whether any was found."""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size == self.indexed_size:
+            return False
+        changed = size < self.indexed_size
+        if changed:
+            # The pack was rewritten: the old mapping no longer matches
+            # the records (and may be truncated)
+            self.indexed_size = 0
+            self.records = dict()
+            self.mapping = None
+            self.mapped_size = 0
+        with open(self.path, "rb") as f:
+            for record in scan_pack(f, self.indexed_size, size):
+                if isinstance(record, tuple):
+                    name, offset, length = record
+                    # As fileOps, the first record of a name is used
+                    self.records.setdefault(name, (offset, length))
+                else:
+                    changed = changed or record != self.indexed_size
+                    self.indexed_size = record
+        return changed
+
+    def get(self, name):
+        record = self.records.get(name)
+        if record is None:
+            return None
+        offset, length = record
+        if self.mapping is None or offset + length > self.mapped_size:
+            with open(self.path, "rb") as f:
+                # The previous mapping is released once the slices
+                # taken from it are
+                self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped_size = len(self.mapping)
+        return _slice(self.mapping, offset, length)
+
+
+class PackStore(object):
+    """Records of the raw/<filetype>/*.pack files of data_dir, by name.
+    The index is loaded (and updated with the packs) on first access;
+    it is saved back when it changed and save_index is set."""
+
+    def __init__(self, data_dir, filetype="certs", save_index=True):
+        self.directory = os.path.join(data_dir, "raw", filetype)
+        self.index_path = os.path.join(data_dir, "raw", filetype + ".index")
+        self.save_index = save_index
+        self.packs = None
+        self.lock = threading.Lock()
+
+    def _pack_path(self, prefix):
+        return os.path.join(self.directory, prefix + ".pack")
+
+    def _load(self):
+        self.packs = dict()
+        try:
+            with open(self.index_path, "rb") as f:
+                self._read_index(f)
+        except (IOError, OSError, ValueError, struct.error):
+            # A missing or damaged index is rebuilt from the packs
+            self.packs = dict()
+        changed = False
+        try:
+            prefixes = [n[:-5] for n in os.listdir(self.directory) if n.endswith(".pack")]
+        except OSError:
+            prefixes = []
+        for prefix in set(prefixes) - set(self.packs):
+            self.packs[prefix] = Pack(self._pack_path(prefix))
+        for prefix in sorted(self.packs):
+            if self.packs[prefix].update():
+                changed = True
+        if changed and self.save_index:
+            self._write_index()
+
+    def _read_index(self, f):
+        if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError("invalid index file %s" % self.index_path)
+        while True:
+            data = f.read(NAME_LEN.size)
+            if not data:
+                break
+            prefix = _decode(f.read(NAME_LEN.unpack(data)[0]))
+            pack = Pack(self._pack_path(prefix))
+            pack.indexed_size, n_records = PACK_HEADER.unpack(f.read(PACK_HEADER.size))
+            for _ in range(n_records):
+                name = _decode(f.read(NAME_LEN.unpack(f.read(NAME_LEN.size))[0]))
+                pack.records[name] = RECORD.unpack(f.read(RECORD.size))
+            self.packs[prefix] = pack
+
+    def _write_index(self):
+        # The new index is written aside, then renamed
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.index_path))
+        except OSError:
+            return
+        with os.fdopen(fd, "wb") as f:
+            f.write(INDEX_MAGIC)
+            for prefix, pack in sorted(self.packs.items()):
+                p = _encode(prefix)
+                f.write(NAME_LEN.pack(len(p)) + p)
+                f.write(PACK_HEADER.pack(pack.indexed_size, len(pack.records)))
+                for name, (offset, length) in pack.records.items():
+                    n = _encode(name)
+                    f.write(NAME_LEN.pack(len(n)) + n + RECORD.pack(offset, length))
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, self.index_path)
+
+    def get(self, name):
+        """Returns the contents of the record name, as a memoryview (a
+        buffer under Python 2), or None if it does not exist."""
+        with self.lock:
+            if self.packs is None:
+                self._load()
+            prefix = prefix_of(name)
+            pack = self.packs.get(prefix)
+            if pack is None:
+                if not os.path.exists(self._pack_path(prefix)):
+                    return None
+                pack = self.packs[prefix] = Pack(self._pack_path(prefix))
+            result = pack.get(name)
+            if result is None and pack.update():
+                # The record may have been appended since the pack was
+                # indexed
+                if self.save_index:
+                    self._write_index()
+                result = pack.get(name)
+            return result
+
+    def names(self):
+        with self.lock:
+            if self.packs is None:
+                self._load()
+            return [name for pack in self.packs.values() for name in pack.records]
+
+
+def main():
+    if len(sys.argv) not in [2, 3]:
+        print("Usage: python piccolo_pack.py DATA_DIR [FILETYPE]", file=sys.stderr)
+        sys.exit(1)
+    store = PackStore(*sys.argv[1:])
+    print("%d records indexed in %s" % (len(store.names()), store.index_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Summaries of the statistics tables of add-stats-tables.sh (stats_*,
+counts by campaign, trust flag and value), for the dashboards of
+piccolo.
+
+Each table is read once, with a single aggregate query, into a
+StatsSummary: the sorted campaigns, trust flags and values, and, for
+each (trust flag, value), an array of counts indexed by campaign (with
+the totals by trust flag). Proportions and comparisons between
+campaigns are then computed on these arrays, without any query. Values
+are named with the reference tables of reference/add-reference-tables.sh
+when they are available.
+
+The "" trust flag stands for all the answers (see stats-requests.txt).
+"""
+
+from array import array
+from collections import OrderedDict
+
+# name: (table, value column, title, reference (table, key, name),
+#        attributes of the reference table values can be grouped by)
+STATS_KINDS = OrderedDict([
+    ("answer-types", ("stats_answertypes", "answer_type", "Answer types",
+                      ("answer_types", "answer_type", "name"), [])),
+    ("versions", ("stats_versions", "version", "Negotiated versions",
+                  ("tls_versions", "version", "name"), [])),
+    ("ciphersuites", ("stats_ciphersuites", "ciphersuite", "Negotiated ciphersuites",
+                      ("tls_ciphersuites", "ciphersuite", "name"), ["kind", "pfs"])),
+    ("rfc5746", ("stats_rfc5746", "rfc5746_supported", "RFC 5746 support", None, [])),
+    ("chain-quality", ("stats_chain_quality", "best_quality", "Best chain quality",
+                       ("chain_quality", "quality", "name"), [])),
+    ("key-robustness", ("stats_key_robustness", "robustness", "Key robustness", None, [])),
+    ("validity-period", ("stats_validity_period", "validity_period", "Validity period", None, [])),
+])
+
+COUNT_TYPE = "l"
+
+
+def _tables(db):
+    return set(row[0] for row in db.execute("select name from sqlite_master where type = 'table'"))
+
+
+def _sort_key(value):
+    # Values of a column may mix integers and strings (e.g. after a
+    # CSV import): integers come first
+    return (not isinstance(value, (int, float)), value)
+
+
+class StatsSummary(object):
+    """The counts of a stats table, as per-campaign arrays."""
+
+    def __init__(self, kind, rows, labels=None, attributes=None):
+        self.kind = kind
+        self.title = STATS_KINDS[kind][2]
+        self.labels = labels or dict()
+        self.attributes = attributes or dict()
+        rows = list(rows)
+        self.campaigns = sorted(set(r[0] for r in rows))
+        self.trust_flags = sorted(set(r[1] for r in rows))
+        self.values = sorted(set(r[2] for r in rows), key=_sort_key)
+        index = dict((c, i) for i, c in enumerate(self.campaigns))
+        n = len(self.campaigns)
+        self.counts = dict()
+        self.totals = dict((t, array(COUNT_TYPE, [0] * n)) for t in self.trust_flags)
+        for campaign, flag, value, count in rows:
+            counts = self.counts.get((flag, value))
+            if counts is None:
+                counts = self.counts[(flag, value)] = array(COUNT_TYPE, [0] * n)
+            counts[index[campaign]] += count
+            self.totals[flag][index[campaign]] += count
+
+    def label(self, value):
+        return self.labels.get(value, value)
+
+    def vectors(self, trust_flag, group=None):
+        """Returns the (label, counts) of the values for trust_flag, the
+        values being grouped by an attribute of the reference table when
+        group is given."""
+        result = OrderedDict()
+        for value in self.values:
+            counts = self.counts.get((trust_flag, value))
+            if counts is None:
+                continue
+            if group is None:
+                key = self.label(value)
+            else:
+                key = self.attributes.get(group, dict()).get(value)
+            if key in result:
+                result[key] = array(COUNT_TYPE, [a + b for a, b in zip(result[key], counts)])
+            else:
+                result[key] = counts
+        return list(result.items())
+
+    def table(self, trust_flag, campaigns, group=None):
+        """Returns the rows comparing campaigns for trust_flag: (label,
+        [(count, proportion)...], difference in points between the last
+        and the first campaign)."""
+        columns = [self.campaigns.index(c) for c in campaigns]
+        totals = self.totals.get(trust_flag, array(COUNT_TYPE, [0] * len(self.campaigns)))
+        rows = []
+        for label, counts in self.vectors(trust_flag, group):
+            cells = []
+            for i in columns:
+                proportion = counts[i] * 100.0 / totals[i] if totals[i] else None
+                cells.append((counts[i], proportion))
+            difference = None
+            if len(cells) > 1 and cells[0][1] is not None and cells[-1][1] is not None:
+                difference = cells[-1][1] - cells[0][1]
+            rows.append((label, cells, difference))
+        return rows, [totals[i] for i in columns]
+
+
+def load_summaries(db):
+    """Returns the StatsSummary of each stats table of db (a sqlite3
+    connection), by kind."""
+    tables = _tables(db)
+    summaries = OrderedDict()
+    for kind, (table, column, _, reference, groups) in STATS_KINDS.items():
+        if table not in tables:
+            continue
+        rows = db.execute("select campaign, trust_flag, %s, coalesce(sum(count), 0) from %s group by 1, 2, 3"
+                          % (column, table))
+        labels, attributes = dict(), dict()
+        if reference is not None and reference[0] in tables:
+            ref_table, key, name = reference
+            fields = [key, name] + groups
+            for row in db.execute("select %s from %s" % (", ".join(fields), ref_table)):
+                labels[row[0]] = row[1]
+                for group, value in zip(groups, row[2:]):
+                    attributes.setdefault(group, dict())[row[0]] = value
+        summaries[kind] = StatsSummary(kind, rows, labels, attributes)
+    return summaries
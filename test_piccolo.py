@@ -0,0 +1,70 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Regression tests for piccolo, run on a synthetic database generated
+with bench-certs.py.
+
+Usage: python test_piccolo.py
+"""
+
+import imp
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BIN_DIR)
+
+import piccolo
+
+bench_certs = imp.load_source("bench_certs", os.path.join(BIN_DIR, "bench-certs.py"))
+
+POOL_SIZE = 2
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, "db.sql")
+        bench_certs.build_database(self.database, 20, 200)
+        db = sqlite3.connect(self.database)
+        db.execute("insert into rated_chains select distinct chain_hash, 0, 'trusted', 'A' from answers")
+        db.commit()
+        db.close()
+        self.app = piccolo.create_app(self.database, DATABASE_POOL_SIZE=POOL_SIZE,
+                                      PAGE_CACHE_ENTRIES=0, LAYOUT_PROCESSES=0)
+        self.released = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def count_releases(self):
+        pool = piccolo.db_pool
+        release = pool.release
+        def counting_release(db):
+            self.released.append(db)
+            release(db)
+        pool.release = counting_release
+
+    def test_streamed_pages_release_once(self):
+        # More streamed pages than pooled connections: each connection
+        # must go back to the pool once, and never be queued twice
+        client = self.app.test_client()
+        n = POOL_SIZE * 10
+        for i in range(n + 1):
+            response = client.get("/answers/2014010100?n=5&i=%d" % i)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b"<table", response.get_data())
+            response.close()
+            if i == 0:
+                self.count_releases()
+        self.assertEqual(len(self.released), n)
+        idle = list(piccolo.db_pool.idle.queue)
+        self.assertEqual(len(idle), len(set(map(id, idle))))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Fill the transitive_links table of a database (built with db.txt or
+db-compact.txt) with the transitive closure of the links table.
+
+For every certificate, transitive_links holds each of its (direct or
+indirect) issuers, with the length of the shortest path in links, and
+self-signed certificates are linked to themselves with a distance of 0.
+
+As computeComponents, the certificates are first split in connected
+components of the links graph (using a union-find structure). Links
+are then read back grouped by component, and the closure of each
+component is computed in memory and written before the next one is
+read, so that the memory used is bounded by the largest component
+instead of the size of the closure.
+
+The table is replaced in a single transaction, so piccolo can keep
+serving the database meanwhile (unless DATABASE_IMMUTABLE is set).
+
+Usage: transitive-links.py [-d MAX_DISTANCE] DATABASE
+"""
+from __future__ import print_function
+
+import getopt
+import sqlite3
+import sys
+import time
+from collections import deque
+
+WRITE_BATCH = 10000
+
+
+class Components(object):
+    """Union-find structure over certificate hashes."""
+
+    def __init__(self):
+        self.parent = dict()
+
+    def find(self, x):
+        parent = self.parent
+        root = parent.setdefault(x, x)
+        while root != parent[root]:
+            # Path halving
+            parent[root] = parent[parent[root]]
+            root = parent[root]
+        return root
+
+    def union(self, x, y):
+        rx, ry = self.find(x), self.find(y)
+        if rx != ry:
+            self.parent[rx] = ry
+
+    def numbering(self):
+        """Yields (hash, component number) for every hash."""
+        numbers = dict()
+        for x in self.parent:
+            yield x, numbers.setdefault(self.find(x), len(numbers))
+
+
+def component_closure(issuers, self_signed, max_distance):
+    """Yields the (issuer, subject, distance) of the closure of one
+    component, issuers mapping each subject to its direct issuers."""
+    for subject in self_signed:
+        yield subject, subject, 0
+    for subject in issuers:
+        # Breadth-first search, which finds the shortest distances
+        seen = set([subject])
+        queue = deque([(subject, 0)])
+        while queue:
+            node, distance = queue.popleft()
+            if max_distance is not None and distance >= max_distance:
+                continue
+            for issuer in issuers.get(node, ()):
+                if issuer not in seen:
+                    seen.add(issuer)
+                    queue.append((issuer, distance + 1))
+                    yield issuer, subject, distance + 1
+
+
+def component_links(db):
+    """Yields, for each component, the list of its (subject_hash,
+    issuer_hash) links."""
+    current, links = None, []
+    for subject, issuer, component in db.execute(
+            "select links.subject_hash, links.issuer_hash, components.component "
+            "from links join temp.components on components.hash = links.subject_hash "
+            "order by components.component"):
+        if component != current and links:
+            yield links
+            links = []
+        current = component
+        links.append((subject, issuer))
+    if links:
+        yield links
+
+
+def usage():
+    print("Usage: transitive-links.py [-d MAX_DISTANCE] DATABASE", file=sys.stderr)
+    sys.exit(1)
+
+
+def main():
+    max_distance = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "d:")
+    except getopt.GetoptError:
+        usage()
+    for o, v in opts:
+        if o == "-d":
+            max_distance = int(v)
+    if len(args) != 1:
+        usage()
+
+    # Hashes are written back as read (as text or blobs)
+    db = sqlite3.connect(args[0])
+    start = time.time()
+
+    components = Components()
+    for subject, issuer in db.execute("select subject_hash, issuer_hash from links"):
+        components.union(subject, issuer)
+    db.execute("create temp table components (hash primary key, component int)")
+    db.executemany("insert into temp.components values (?, ?)", components.numbering())
+    n_components = db.execute("select count(distinct component) from temp.components").fetchone()[0]
+    components = None
+    print("%d components found in %.1f s" % (n_components, time.time() - start))
+    sys.stdout.flush()
+
+    db.isolation_level = None
+    db.execute("begin immediate")
+    try:
+        db.execute("delete from transitive_links")
+        n_rows, batch = 0, []
+        for links in component_links(db):
+            issuers, self_signed = dict(), []
+            for subject, issuer in links:
+                if subject == issuer:
+                    self_signed.append(subject)
+                else:
+                    issuers.setdefault(subject, []).append(issuer)
+            for row in component_closure(issuers, self_signed, max_distance):
+                batch.append(row)
+                if len(batch) >= WRITE_BATCH:
+                    db.executemany("insert into transitive_links values (?, ?, ?)", batch)
+                    n_rows += len(batch)
+                    batch = []
+        db.executemany("insert into transitive_links values (?, ?, ?)", batch)
+        n_rows += len(batch)
+        db.execute("commit")
+    except BaseException:
+        db.execute("rollback")
+        raise
+    db.close()
+    print("%d transitive links written in %.1f s" % (n_rows, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()